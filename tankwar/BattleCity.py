@@ -2,18 +2,56 @@
 """
 python+pygameg實現經典的《坦克大戰》遊戲
 """
+import argparse
 import os
-import uuid
+import copy
+import heapq
 import random
+import zlib
+import functools
 import pygame
 import time
-import threading
+import struct
+import sys
+
+import atlas
+import audio
+import levelpack
+import text
+from replay import Replay
+from profiler import Profiler
+
+# 批量推進砲彈需要numpy，沒有安裝時逐個更新砲彈
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# 遊戲窗口
+screen = None
+# 快速存檔文件
+QUICK_SAVE = os.path.join("saves", "quicksave.sav")
+# 是否播放聲音
+play_sounds = True
+# 所有聲音
+sounds = {}
 
 
 class Timer(object):
-    """ 計時器，定時執行回調函數"""
+    """
+    計時器，定時執行回調函數
+    計時器按到期時間保存在最小堆中，每次只處理到期的計時器
+    """
     def __init__(self):
-        self.timers = []
+        # 最小堆，元素為(到期時間, 計時器id)
+        self.queue = []
+        # 還沒被移除的計時器，key為計時器id
+        self.timers = {}
+        # 計時器的當前時間，單位ms
+        self.time = 0
+        # 下一個計時器id
+        self.next_id = 1
 
     def add(self, interval, f, repeat = -1):
         timer = {
@@ -21,60 +59,70 @@ class Timer(object):
             "callback"    : f,  #回調函数
             "repeat"        : repeat,   #重複調用次数
             "times"            : 0,     #當前調用次数
-            "time"            : 0,      #計時
-            "uuid"            : uuid.uuid4()    #唯一id
+            "due"            : self.time + interval,    #到期時間
+            "id"            : self.next_id    #唯一id
         }
-        self.timers.append(timer)
-        return timer["uuid"]
+        self.next_id += 1
+        self.timers[timer["id"]] = timer
+        heapq.heappush(self.queue, (timer["due"], timer["id"]))
+        return timer["id"]
 
-    def destroy(self, uuid_nr):
-        for timer in self.timers:
-            if timer["uuid"] == uuid_nr:
-                self.timers.remove(timer)
-                return
+    def destroy(self, timer_id):
+        """ 移除計時器，堆中的元素到期時才丟棄 """
+        self.timers.pop(timer_id, None)
+
+    def clear(self):
+        """ 移除所有計時器 """
+        del self.queue[:]
+        self.timers.clear()
 
     def update(self, time_passed):
-        for timer in self.timers:
-            timer["time"] += time_passed
-            # 夠間隔時間就調用回調函數並重新計時
-            if timer["time"] >= timer["interval"]:
-                timer["time"] -= timer["interval"]
-                timer["times"] += 1
-                # 調用次數滿就移除該回調函數的計時器，否則調用該回調函數
-                if timer["repeat"] > -1 and timer["times"] == timer["repeat"]:
-                    self.timers.remove(timer)
-                try:
-                    timer["callback"]()
-                except:
-                    try:
-                        self.timers.remove(timer)
-                    except:
-                        pass
+        self.time += time_passed
+        queue = self.queue
+        # 按到期時間依次調用回調函數，回調函數中添加或移除的計時器也按到期時間處理
+        while queue and queue[0][0] <= self.time:
+            due, timer_id = heapq.heappop(queue)
+            timer = self.timers.get(timer_id)
+            # 已被移除的計時器
+            if timer == None:
+                continue
+            timer["times"] += 1
+            # 調用次數滿就移除該回調函數的計時器，否則重新計時
+            if timer["repeat"] > -1 and timer["times"] == timer["repeat"]:
+                del self.timers[timer_id]
+            else:
+                timer["due"] = due + timer["interval"]
+                heapq.heappush(queue, (timer["due"], timer_id))
+            try:
+                timer["callback"]()
+            except Exception:
+                self.destroy(timer_id)
 
 
 class Castle(object):
     """ 玩家基地 """
     (STATE_STANDING, STATE_DESTROYED, STATE_EXPLODING) = range(3)
 
-    def __init__(self):
-        global sprites
+    def __init__(self, world):
+        self.world = world
 
         # 未被消滅的玩家基地圖像
-        self.img_undamaged = sprites.subsurface(0, 15*2, 16*2, 16*2)
+        self.img_undamaged = atlas.image(atlas.CASTLE[0])
         # 被消滅後的玩家基地圖像
-        self.img_destroyed = sprites.subsurface(16*2, 15*2, 16*2, 16*2)
+        self.img_destroyed = atlas.image(atlas.CASTLE[1])
 
-        # 玩家基地位置和大小
-        self.rect = pygame.Rect(12*16, 24*16, 32, 32)
+        # 玩家基地位置和大小，位於地圖最下面一行的中間
+        x, y = world.castlePosition()
+        self.rect = pygame.Rect(x*16, y*16, 32, 32)
 
         # 初始顯示為未被消滅的玩家基地圖像
         self.rebuild()
 
     def draw(self):
-        """ 畫玩家基地 """
+        """ 畫玩家基地，返回畫過的區域 """
         global screen
 
-        screen.blit(self.image, self.rect.topleft)
+        rect = screen.blit(self.image, self.rect.topleft)
 
         if self.state == self.STATE_EXPLODING:
             # 爆炸完了
@@ -83,7 +131,8 @@ class Castle(object):
                 del self.explosion
             # 現在開始爆炸
             else:
-                self.explosion.draw()
+                rect = rect.union(self.explosion.draw())
+        return rect
 
     def rebuild(self):
         """ 玩家基地 """
@@ -95,7 +144,7 @@ class Castle(object):
         """ 被炮彈擊毁後的玩家基地 """
         # 標記為爆炸
         self.state = self.STATE_EXPLODING
-        self.explosion = Explosion(self.rect.topleft)
+        self.explosion = Explosion(self.world, self.rect.topleft)
         # 基地被擊毀後的圖像
         self.image = self.img_destroyed
         self.active = False
@@ -116,8 +165,6 @@ class Bonus(object):
     (BONUS_GRENADE, BONUS_HELMET, BONUS_SHOVEL, BONUS_STAR, BONUS_TANK, BONUS_TIMER, BONUS_BIGGER) = range(7)
 
     def __init__(self, level):
-        global sprites
-
         self.level = level
 
         self.active = True
@@ -126,10 +173,12 @@ class Bonus(object):
         self.visible = True
 
         # 隨機生成寶物出現位置
-        self.rect = pygame.Rect(random.randint(0, 416-32), random.randint(0, 416-32), 32, 32)
+        rng = level.world.random
+        size = level.pixel_size
+        self.rect = pygame.Rect(rng.randint(0, size-32), rng.randint(0, size-32), 32, 32)
 
         # 隨機生成出現的寶物類型
-        self.bonus = random.choice([
+        self.bonus = rng.choice([
             self.BONUS_GRENADE,
             self.BONUS_HELMET,
             self.BONUS_SHOVEL,
@@ -138,18 +187,22 @@ class Bonus(object):
             self.BONUS_TIMER
         ])
         # 寶物圖像
-        self.image = sprites.subsurface(16*2*self.bonus, 32*2, 16*2, 15*2)
+        self.image = atlas.image((16*2*self.bonus, 32*2, 16*2, 15*2))
 
     def draw(self):
-        """ 畫寶物到屏幕上 """
+        """ 畫寶物到屏幕上，返回畫過的區域 """
         global screen
         if self.visible:
-            screen.blit(self.image, self.rect.topleft)
+            return screen.blit(self.image, self.rect.topleft)
 
     def toggleVisibility(self):
         """ 切換寶物是否可見 """
         self.visible = not self.visible
 
+    def destroy(self):
+        """ 寶物出現一段時間後消失 """
+        self.active = False
+
 
 class Bullet(object):
     """ 坦克炮彈 """
@@ -161,9 +214,8 @@ class Bullet(object):
     (OWNER_PLAYER, OWNER_ENEMY) = range(2)
 
     def __init__(self, level, position, direction, damage = 100, speed = 5):
-        global sprites
-
         self.level = level
+        self.world = level.world
         # 砲彈方向
         self.direction = direction
         # 砲彈傷害
@@ -176,41 +228,35 @@ class Bullet(object):
         self.power = 1
 
         # 砲彈圖像
-        self.image = sprites.subsurface(75*2, 74*2, 3*2, 4*2)
+        self.image = atlas.directions(atlas.BULLET)[direction]
 
         # 重新計算炮彈方向和座標
         if direction == self.DIR_UP:
             self.rect = pygame.Rect(position[0] + 11, position[1] - 8, 6, 8)
         elif direction == self.DIR_RIGHT:
-            self.image = pygame.transform.rotate(self.image, 270)
             self.rect = pygame.Rect(position[0] + 26, position[1] + 11, 8, 6)
         elif direction == self.DIR_DOWN:
-            self.image = pygame.transform.rotate(self.image, 180)
             self.rect = pygame.Rect(position[0] + 11, position[1] + 26, 6, 8)
         elif direction == self.DIR_LEFT:
-            self.image = pygame.transform.rotate(self.image, 90)
             self.rect = pygame.Rect(position[0] - 8 , position[1] + 11, 8, 6)
 
         # 砲彈爆炸效果圖
-        self.explosion_images = [
-            sprites.subsurface(0, 80*2, 32*2, 32*2),
-            sprites.subsurface(32*2, 80*2, 32*2, 32*2),
-        ]
+        self.explosion_images = atlas.frames(atlas.EXPLOSION[:2])
         # 砲彈移動速度
         self.speed = speed
 
         self.state = self.STATE_ACTIVE
 
     def draw(self):
-        """ 畫砲彈 """
+        """ 畫砲彈，返回畫過的區域 """
         global screen
         if self.state == self.STATE_ACTIVE:
-            screen.blit(self.image, self.rect.topleft)
+            return screen.blit(self.image, self.rect.topleft)
         elif self.state == self.STATE_EXPLODING:
-            self.explosion.draw()
+            return self.explosion.draw()
 
     def update(self):
-        global castle, players, enemies, bullets
+        world = self.world
 
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
@@ -224,101 +270,185 @@ class Bullet(object):
         if self.direction == self.DIR_UP:
             self.rect.topleft = [self.rect.left, self.rect.top - self.speed]
             if self.rect.top < 0:
-                if play_sounds and self.owner == self.OWNER_PLAYER:
-                    sounds["steel"].play()
+                if self.owner == self.OWNER_PLAYER:
+                    world.playSound("steel")
                 self.explode()
                 return
         elif self.direction == self.DIR_RIGHT:
             self.rect.topleft = [self.rect.left + self.speed, self.rect.top]
-            if self.rect.left > (416 - self.rect.width):
-                if play_sounds and self.owner == self.OWNER_PLAYER:
-                    sounds["steel"].play()
+            if self.rect.left > (self.level.pixel_size - self.rect.width):
+                if self.owner == self.OWNER_PLAYER:
+                    world.playSound("steel")
                 self.explode()
                 return
         elif self.direction == self.DIR_DOWN:
             self.rect.topleft = [self.rect.left, self.rect.top + self.speed]
-            if self.rect.top > (416 - self.rect.height):
-                if play_sounds and self.owner == self.OWNER_PLAYER:
-                    sounds["steel"].play()
+            if self.rect.top > (self.level.pixel_size - self.rect.height):
+                if self.owner == self.OWNER_PLAYER:
+                    world.playSound("steel")
                 self.explode()
                 return
         elif self.direction == self.DIR_LEFT:
             self.rect.topleft = [self.rect.left - self.speed, self.rect.top]
             if self.rect.left < 0:
-                if play_sounds and self.owner == self.OWNER_PLAYER:
-                    sounds["steel"].play()
+                if self.owner == self.OWNER_PLAYER:
+                    world.playSound("steel")
                 self.explode()
                 return
 
         has_collided = False
 
         # 砲彈擊中地形
-        rects = self.level.obstacle_rects
-        collisions = self.rect.collidelistall(rects)
-        if collisions != []:
-            for i in collisions:
-                if self.level.hitTile(rects[i].topleft, self.power, self.owner == self.OWNER_PLAYER):
-                    has_collided = True
+        for rect in self.level.obstaclesAt(self.rect):
+            if self.level.hitTile(rect.topleft, self.power, self.owner == self.OWNER_PLAYER):
+                has_collided = True
         if has_collided:
             self.explode()
             return
 
         #   砲彈相互碰撞，則爆炸並移走該砲彈
-        for bullet in bullets:
+        for bullet in world.nearbyBullets(self.rect):
             if self.state == self.STATE_ACTIVE and bullet.owner != self.owner and bullet != self and self.rect.colliderect(bullet.rect):
                 self.destroy()
                 self.explode()
                 return
 
         # 砲彈擊中玩家坦克
-        for player in players:
+        for player in world.players:
             if player.state == player.STATE_ALIVE and self.rect.colliderect(player.rect):
                 if player.bulletImpact(self.owner == self.OWNER_PLAYER, self.damage, self.owner_class):
                     self.destroy()
                     return
 
         # 砲彈擊中對方坦克
-        for enemy in enemies:
+        for enemy in world.nearbyEnemies(self.rect):
             if enemy.state == enemy.STATE_ALIVE and self.rect.colliderect(enemy.rect):
                 if enemy.bulletImpact(self.owner == self.OWNER_ENEMY, self.damage, self.owner_class):
                     self.destroy()
                     return
 
         # 砲彈擊中玩家基地
-        if castle.active and self.rect.colliderect(castle.rect):
-            castle.destroy()
+        if world.castle.active and self.rect.colliderect(world.castle.rect):
+            world.castle.destroy()
             self.destroy()
             return
 
     def explode(self):
         """ 砲彈爆炸 """
-        global screen
         if self.state != self.STATE_REMOVED:
             self.state = self.STATE_EXPLODING
-            self.explosion = Explosion([self.rect.left-13, self.rect.top-13], None, self.explosion_images)
+            self.explosion = Explosion(self.world, [self.rect.left-13, self.rect.top-13], None, self.explosion_images)
 
     def destroy(self):
         """ 標記砲彈為移除狀態 """
         self.state = self.STATE_REMOVED
 
 
+class BulletManager(object):
+    """
+    用numpy批量推進砲彈
+    每一步把所有砲彈的座標、尺寸、方向、速度和屬性放進數組，一次算出所有砲彈的新座標，
+    再一次查出可能撞到邊界、地形、坦克、基地或對方砲彈的砲彈。
+    不可能撞到任何東西的砲彈直接移動到新座標，其餘砲彈仍按原來的順序調用Bullet.update()，
+    所以結果和逐個更新砲彈完全一樣
+    """
+
+    def __init__(self, world):
+        self.world = world
+        # 四個方向每步移動一個像素時座標的變化
+        self.dx = numpy.array([0, 1, 0, -1])
+        self.dy = numpy.array([-1, 0, 1, 0])
+
+    def update(self):
+        """ 更新所有砲彈，代替World.step()中逐個更新砲彈的循環 """
+        bullets = self.world.bullets
+
+        moved = set()
+        if len(bullets) > 0:
+            moved = self.moveFree()
+
+        for bullet in bullets[:]:
+            if bullet.state == bullet.STATE_REMOVED:
+                bullets.remove(bullet)
+            elif id(bullet) not in moved:
+                bullet.update()
+
+    def moveFree(self):
+        """ 移動所有不可能撞到東西的砲彈，返回這些砲彈的id """
+        world = self.world
+        bullets = world.bullets
+
+        # 每顆砲彈一行：x, y, 寬, 高, 方向, 速度, 屬性, 是否正在飛行
+        data = numpy.array([
+            (b.rect.left, b.rect.top, b.rect.width, b.rect.height, b.direction, b.speed,
+             -1 if b.owner == None else b.owner, b.state == b.STATE_ACTIVE)
+            for b in bullets
+        ])
+        x, y, w, h, direction, speed, owner, active = data.T
+        active = active.astype(bool)
+
+        # 飛行中的砲彈的新座標，其餘砲彈不動
+        nx = numpy.where(active, x + self.dx[direction] * speed, x)
+        ny = numpy.where(active, y + self.dy[direction] * speed, y)
+
+        # 撞到邊界
+        level = world.level
+        hit = (nx < 0) | (ny < 0) | (nx > level.pixel_size - w) | (ny > level.pixel_size - h)
+
+        # 撞到地形：新位置覆蓋的格子中有障礙物，砲彈最多覆蓋2x2個格子
+        size = level.grid_size
+        mask = numpy.frombuffer(level.obstacle_mask, dtype=numpy.uint8).reshape(size, size)
+        x1 = numpy.clip(nx // level.TILE_SIZE, 0, size - 1)
+        y1 = numpy.clip(ny // level.TILE_SIZE, 0, size - 1)
+        x2 = numpy.clip((nx + w - 1) // level.TILE_SIZE, 0, size - 1)
+        y2 = numpy.clip((ny + h - 1) // level.TILE_SIZE, 0, size - 1)
+        hit |= (mask[y1, x1] | mask[y1, x2] | mask[y2, x1] | mask[y2, x2]).astype(bool)
+
+        # 撞到坦克或基地
+        targets = [p.rect for p in world.players if p.state == p.STATE_ALIVE]
+        targets += [e.rect for e in world.enemies if e.state == e.STATE_ALIVE]
+        if world.castle.active:
+            targets.append(world.castle.rect)
+        if len(targets) > 0:
+            tx, ty, tw, th = numpy.array([tuple(rect) for rect in targets]).T
+            hit |= ((nx[:, None] < tx + tw) & (tx < (nx + w)[:, None]) &
+                    (ny[:, None] < ty + th) & (ty < (ny + h)[:, None])).any(axis = 1)
+
+        # 撞到對方砲彈：新舊位置覆蓋的範圍有重疊，不管兩顆砲彈誰先移動都不會相撞
+        left = numpy.minimum(x, nx)
+        top = numpy.minimum(y, ny)
+        right = numpy.maximum(x, nx) + w
+        bottom = numpy.maximum(y, ny) + h
+        overlap = ((left[:, None] < right) & (left < right[:, None]) &
+                   (top[:, None] < bottom) & (top < bottom[:, None]) &
+                   (owner[:, None] != owner))
+        hit |= overlap.any(axis = 1)
+
+        moved = set()
+        for i in numpy.flatnonzero(active & ~hit):
+            bullet = bullets[i]
+            bullet.rect.topleft = [int(nx[i]), int(ny[i])]
+            moved.add(id(bullet))
+        return moved
+
+
 class Label(object):
-    def __init__(self, position, text = "", duration = None):
+    def __init__(self, world, position, text = "", duration = None):
+        self.world = world
+
         self.position = position
 
         self.active = True
 
         self.text = text
 
-        self.font = pygame.font.SysFont("Arial", 13)
-
         if duration != None:
-            gtimer.add(duration, lambda :self.destroy(), 1)
+            world.timer.add(duration, self.destroy, 1)
 
     def draw(self):
         global screen
-        screen.blit(self.font.render(self.text, False, (200,200,200)), \
-                    [self.position[0]+4, self.position[1]+8])
+        image = text.render(text.sysFont("Arial", 13), self.text, (200,200,200))
+        return screen.blit(image, [self.position[0]+4, self.position[1]+8])
 
     def destroy(self):
         self.active = False
@@ -326,8 +456,8 @@ class Label(object):
 
 class Explosion(object):
     """ 爆炸效果 """
-    def __init__(self, position, interval = None, images = None):
-        global sprites
+    def __init__(self, world, position, interval = None, images = None):
+        self.world = world
 
         self.position = [position[0]-16, position[1]-16]
 
@@ -338,23 +468,19 @@ class Explosion(object):
             interval = 100
 
         if images == None:
-            images = [
-                # 三種爆炸效果
-                sprites.subsurface(0, 80*2, 32*2, 32*2),
-                sprites.subsurface(32*2, 80*2, 32*2, 32*2),
-                sprites.subsurface(64*2, 80*2, 32*2, 32*2),
-            ]
-
-        images.reverse()
-        self.images = [] + images
+            # 三種爆炸效果
+            images = atlas.frames(atlas.EXPLOSION)
+
+        # 圖像是共用的，倒序複製一份再逐個取出
+        self.images = images[::-1]
         self.image = self.images.pop()
 
-        gtimer.add(interval, lambda :self.update(), len(self.images) + 1)
+        world.timer.add(interval, self.update, len(self.images) + 1)
 
     def draw(self):
-        """ 畫爆炸效果 """
+        """ 畫爆炸效果，返回畫過的區域 """
         global screen
-        screen.blit(self.image, self.position)
+        return screen.blit(self.image, self.position)
 
     def update(self):
         if len(self.images) > 0:
@@ -371,21 +497,31 @@ class Level(object):
     # 地形像素尺寸
     TILE_SIZE = 16
 
-    def __init__(self, level_nr = None):
-        global sprites
+    # 原版地形圖每行、每列的格子數
+    GRID_SIZE = 26
+
+    # 所有地形圖共用的格子坐標和尺寸，key為每行的格子數
+    shared_tile_rects = {}
+
+    def __init__(self, world, level_nr = None):
+        self.world = world
+
+        # 地圖每行、每列的格子數和像素尺寸，由World設定
+        self.grid_size = world.grid_size
+        self.pixel_size = self.grid_size * self.TILE_SIZE
 
-        # 限定地形圖上同时最多出現四個敵人
-        self.max_active_enemies = 4
+        # 限定地形圖上同时最多出現的敵人數，原版為四個
+        self.max_active_enemies = world.max_active_enemies
 
         tile_images = [
             pygame.Surface((8*2, 8*2)),
-            sprites.subsurface(48*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(48*2, 72*2, 8*2, 8*2),
-            sprites.subsurface(56*2, 72*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(72*2, 64*2, 8*2, 8*2),
-            sprites.subsurface(64*2, 72*2, 8*2, 8*2),
+            atlas.image((48*2, 64*2, 8*2, 8*2)),
+            atlas.image((48*2, 72*2, 8*2, 8*2)),
+            atlas.image((56*2, 72*2, 8*2, 8*2)),
+            atlas.image((64*2, 64*2, 8*2, 8*2)),
+            atlas.image((64*2, 64*2, 8*2, 8*2)),
+            atlas.image((72*2, 64*2, 8*2, 8*2)),
+            atlas.image((64*2, 72*2, 8*2, 8*2)),
         ]
         self.tile_empty = tile_images[0]
         # 磚牆
@@ -410,37 +546,101 @@ class Level(object):
         if level_nr == 0:
             level_nr = 35
 
-        # 加载對應等级的地形圖
+        # 每個格子的坐標和尺寸，下標為y*grid_size+x，同樣大小的地形圖共用，不能修改
+        size = self.grid_size
+        self.tile_rects = Level.shared_tile_rects.get(size)
+        if self.tile_rects == None:
+            self.tile_rects = []
+            for y in range(size):
+                for x in range(size):
+                    self.tile_rects.append(pygame.Rect(x*self.TILE_SIZE, y*self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE))
+            Level.shared_tile_rects[size] = self.tile_rects
+
+        # 加载對應等级的地形圖，按格子保存每個格子的地形
+        self.tiles = [self.TILE_EMPTY] * (size * size)
         self.loadLevel(level_nr)
-        # 包含所有可以被子弹消滅的地形的坐標和尺寸
-        self.obstacle_rects = []
+        # 按格子保存所有可以被子弹消滅的地形的坐標和尺寸
+        # 沒有障礙物的格子為None
+        self.obstacle_grid = []
+        # 每個格子是否有障礙物，1為有，供BulletManager批量查詢
+        self.obstacle_mask = bytearray()
+        # 敵方坦克用的距離場，第一次查詢時才計算
+        self.distance_fields = {}
         self.updateObstacleRects()
 
-        gtimer.add(400, lambda :self.toggleWaves())
+        # 預先畫好的地形圖層，第一次畫地形時才創建
+        # background為草地以外的地形，grass_layer為蓋在坦克上面的草地
+        self.background = None
+        self.grass_layer = None
+        # 圖層畫好以後地形有變化的格子
+        self.changed_tiles = set()
+
+        world.timer.add(400, self.toggleWaves)
+
+    def __getstate__(self):
+        """ 複製地形圖時不複製預先畫好的圖層，需要時重新畫 """
+        state = self.__dict__.copy()
+        state["background"] = None
+        state["grass_layer"] = None
+        state["changed_tiles"] = set()
+        return state
+
+    def adoptLayers(self, level):
+        """
+        接手同一關另一份地形圖已經畫好的圖層，只重畫兩份地形圖不同的格子
+        連線遊戲回滾後的地形圖是複製的，不用重畫整個圖層
+        """
+        if level.background == None or self.background != None:
+            return
+        self.background = level.background
+        self.grass_layer = level.grass_layer
+        self.changed_tiles = set(level.changed_tiles)
+        for index, tile in enumerate(self.tiles):
+            if tile != level.tiles[index]:
+                self.changed_tiles.add(index)
+        if self.tile_water is not level.tile_water:
+            for index, tile in enumerate(self.tiles):
+                if tile == self.TILE_WATER:
+                    self.changed_tiles.add(index)
 
     def hitTile(self, pos, power = 1, sound = False):
         """ 砲彈擊中地形的聲音及地形生命 """
-        global play_sounds, sounds
+        x = pos[0] // self.TILE_SIZE
+        y = pos[1] // self.TILE_SIZE
+        tile = self.tiles[y * self.grid_size + x]
+        # 砲彈擊中磚牆
+        if tile == self.TILE_BRICK:
+            if sound:
+                self.world.playSound("brick")
+            self.setTile(x, y, self.TILE_EMPTY)
+            return True
+        # 擊中鋼板
+        elif tile == self.TILE_STEEL:
+            if sound:
+                self.world.playSound("steel")
+            if power == 2:
+                self.setTile(x, y, self.TILE_EMPTY)
+            return True
+        else:
+            return False
 
-        for tile in self.mapr:
-            if tile[1].topleft == pos:
-                # 砲彈擊中磚牆
-                if tile[0] == self.TILE_BRICK:
-                    if play_sounds and sound:
-                        sounds["brick"].play()
-                    self.mapr.remove(tile)
-                    self.updateObstacleRects()
-                    return True
-                # 擊中鋼板
-                elif tile[0] == self.TILE_STEEL:
-                    if play_sounds and sound:
-                        sounds["steel"].play()
-                    if power == 2:
-                        self.mapr.remove(tile)
-                        self.updateObstacleRects()
-                    return True
-                else:
-                    return False
+    def setTile(self, x, y, tile):
+        """ 修改一個格子的地形，同時更新該格子的障礙物 """
+        index = y * self.grid_size + x
+        self.tiles[index] = tile
+        if self.background != None:
+            self.changed_tiles.add(index)
+        # 玩家基地佔用的格子一直是障礙物
+        if self.obstacle_grid[index] is self.world.castle.rect:
+            return
+        if tile in (self.TILE_BRICK, self.TILE_STEEL, self.TILE_WATER):
+            self.obstacle_grid[index] = self.tile_rects[index]
+            self.obstacle_mask[index] = 1
+        else:
+            self.obstacle_grid[index] = None
+            self.obstacle_mask[index] = 0
+        for field in self.distance_fields.values():
+            field.tileChanged(x, y)
 
     def toggleWaves(self):
         """ 切換海水圖片 """
@@ -449,87 +649,366 @@ class Level(object):
         else:
             self.tile_water = self.tile_water1
 
+        # 圖層中的海水需要重畫
+        if self.background != None:
+            for index, tile in enumerate(self.tiles):
+                if tile == self.TILE_WATER:
+                    self.changed_tiles.add(index)
+
     def loadLevel(self, level_nr = 1):
-        """ 加载地形圖文件 """
-        filename = "levels/"+str(level_nr)
-        if (not os.path.isfile(filename)):
+        """ 加载地形圖，地形圖由levelpack從編譯好的levels.pack中讀取 """
+        tiles = levelpack.grid(level_nr)
+        if tiles == None:
             return False
-        level = []
-        f = open(filename, "r")
-        data = f.read().split("\n")
-        self.mapr = []
-        x, y = 0, 0
-        for row in data:
-            for ch in row:
-                if ch == "#":
-                    self.mapr.append((self.TILE_BRICK, pygame.Rect(x, y, self.TILE_SIZE, self.TILE_SIZE)))
-                elif ch == "@":
-                    self.mapr.append((self.TILE_STEEL, pygame.Rect(x, y, self.TILE_SIZE, self.TILE_SIZE)))
-                elif ch == "~":
-                    self.mapr.append((self.TILE_WATER, pygame.Rect(x, y, self.TILE_SIZE, self.TILE_SIZE)))
-                elif ch == "%":
-                    self.mapr.append((self.TILE_GRASS, pygame.Rect(x, y, self.TILE_SIZE, self.TILE_SIZE)))
-                elif ch == "-":
-                    self.mapr.append((self.TILE_FROZE, pygame.Rect(x, y, self.TILE_SIZE, self.TILE_SIZE)))
-                x += self.TILE_SIZE
-            x = 0
-            y += self.TILE_SIZE
+        if self.grid_size == self.GRID_SIZE:
+            self.tiles = list(tiles)
+        else:
+            self.tiles = self.tileLevel(tiles)
         return True
 
-    def draw(self, tiles = None):
-        """ 畫指定關卡的地形圖到遊戲窗口上 """
-        global screen
-
-        if tiles == None:
-            tiles = [TILE_BRICK, TILE_STEEL, TILE_WATER, TILE_GRASS, TILE_FROZE]
-
-        for tile in self.mapr:
-            if tile[0] in tiles:
-                if tile[0] == self.TILE_BRICK:
-                    screen.blit(self.tile_brick, tile[1].topleft)
-                elif tile[0] == self.TILE_STEEL:
-                    screen.blit(self.tile_steel, tile[1].topleft)
-                elif tile[0] == self.TILE_WATER:
-                    screen.blit(self.tile_water, tile[1].topleft)
-                elif tile[0] == self.TILE_FROZE:
-                    screen.blit(self.tile_froze, tile[1].topleft)
-                elif tile[0] == self.TILE_GRASS:
-                    screen.blit(self.tile_grass, tile[1].topleft)
+    def tileLevel(self, tiles):
+        """
+        大小不同的地圖用原版地形圖平鋪填滿，
+        再清空玩家基地和所有坦克出現的位置，圍繞玩家基地重建磚牆
+        """
+        size = self.grid_size
+        grid = self.GRID_SIZE
+        result = [tiles[(y % grid) * grid + x % grid] for y in range(size) for x in range(size)]
+
+        world = self.world
+        points = list(world.spawn_points) + [world.castlePosition()]
+        points += [world.playerPosition(i) for i in range(2)]
+        for x, y in points:
+            for dy in range(2):
+                for dx in range(2):
+                    if 0 <= x + dx < size and 0 <= y + dy < size:
+                        result[(y + dy) * size + x + dx] = self.TILE_EMPTY
+        for x, y in self.fortressPositions():
+            result[y * size + x] = self.TILE_BRICK
+        return result
+
+    def updateLayers(self):
+        """
+        更新預先畫好的地形圖層
+        第一次調用時畫出所有格子，之後只重畫有變化的格子
+        返回重畫過的格子的坐標和尺寸
+        """
+        if self.background == None:
+            size = self.pixel_size
+            self.background = pygame.Surface((size, size))
+            self.grass_layer = pygame.Surface((size, size), pygame.SRCALPHA)
+            self.changed_tiles = set(range(len(self.tiles)))
+
+        rects = []
+        for index in self.changed_tiles:
+            rect = self.tile_rects[index]
+            tile = self.tiles[index]
+            self.background.fill([0, 0, 0], rect)
+            self.grass_layer.fill([0, 0, 0, 0], rect)
+            if tile == self.TILE_BRICK:
+                self.background.blit(self.tile_brick, rect.topleft)
+            elif tile == self.TILE_STEEL:
+                self.background.blit(self.tile_steel, rect.topleft)
+            elif tile == self.TILE_WATER:
+                self.background.blit(self.tile_water, rect.topleft)
+            elif tile == self.TILE_FROZE:
+                self.background.blit(self.tile_froze, rect.topleft)
+            elif tile == self.TILE_GRASS:
+                self.grass_layer.blit(self.tile_grass, rect.topleft)
+            rects.append(rect)
+        self.changed_tiles.clear()
+        return rects
 
     def updateObstacleRects(self):
         """ 所有可以被子彈消滅的地形的座標和尺寸 """
-        global castle
-        self.obstacle_rects = [castle.rect]     # 玩家基地是可以被子弹消灭的
+        castle_rect = self.world.castle.rect     # 玩家基地是可以被子弹消灭的
+        self.obstacle_grid = [None] * (self.grid_size * self.grid_size)
+
+        # 玩家基地佔用2x2個格子
+        for y in range(castle_rect.top // self.TILE_SIZE, castle_rect.bottom // self.TILE_SIZE):
+            for x in range(castle_rect.left // self.TILE_SIZE, castle_rect.right // self.TILE_SIZE):
+                self.obstacle_grid[y * self.grid_size + x] = castle_rect
+
+        for index, tile in enumerate(self.tiles):
+            if tile in (self.TILE_BRICK, self.TILE_STEEL, self.TILE_WATER) and self.obstacle_grid[index] is None:
+                self.obstacle_grid[index] = self.tile_rects[index]
+
+        self.obstacle_mask = bytearray([obstacle is not None for obstacle in self.obstacle_grid])
+
+    def gridRange(self, rect):
+        """ rect覆蓋的格子範圍，返回(x1, y1, x2, y2)，包含x2和y2 """
+        last = self.grid_size - 1
+        x1 = max(rect.left // self.TILE_SIZE, 0)
+        y1 = max(rect.top // self.TILE_SIZE, 0)
+        x2 = min((rect.right - 1) // self.TILE_SIZE, last)
+        y2 = min((rect.bottom - 1) // self.TILE_SIZE, last)
+        return x1, y1, x2, y2
+
+    def obstaclesAt(self, rect):
+        """
+        與rect碰撞的所有障礙物
+        障礙物正好填滿它佔用的格子，所以只需要檢查rect覆蓋的格子
+        """
+        grid = self.obstacle_grid
+        size = self.grid_size
+        x1, y1, x2, y2 = self.gridRange(rect)
+        found = []
+        for y in range(y1, y2 + 1):
+            row = y * size
+            for x in range(x1, x2 + 1):
+                obstacle = grid[row + x]
+                if obstacle is not None and obstacle not in found:
+                    found.append(obstacle)
+        return found
+
+    def collideObstacle(self, rect):
+        """ rect是否撞上障礙物 """
+        grid = self.obstacle_grid
+        size = self.grid_size
+        x1, y1, x2, y2 = self.gridRange(rect)
+        for y in range(y1, y2 + 1):
+            row = y * size
+            for x in range(x1, x2 + 1):
+                if grid[row + x] is not None:
+                    return True
+        return False
 
-        for tile in self.mapr:
-            if tile[0] in (self.TILE_BRICK, self.TILE_STEEL, self.TILE_WATER):
-                self.obstacle_rects.append(tile[1])
+    def fortressPositions(self):
+        """ 圍繞玩家基地的磚牆的格子坐標 """
+        x, y = self.world.castlePosition()
+        return [
+            (x-1, y-1), (x-1, y), (x-1, y+1),
+            (x+2, y-1), (x+2, y), (x+2, y+1),
+            (x, y-1), (x+1, y-1),
+        ]
 
     def buildFortress(self, tile):
         """ 圍繞玩家基地的磚牆 """
-        positions = [
-            (11*self.TILE_SIZE, 23*self.TILE_SIZE),
-            (11*self.TILE_SIZE, 24*self.TILE_SIZE),
-            (11*self.TILE_SIZE, 25*self.TILE_SIZE),
-            (14*self.TILE_SIZE, 23*self.TILE_SIZE),
-            (14*self.TILE_SIZE, 24*self.TILE_SIZE),
-            (14*self.TILE_SIZE, 25*self.TILE_SIZE),
-            (12*self.TILE_SIZE, 23*self.TILE_SIZE),
-            (13*self.TILE_SIZE, 23*self.TILE_SIZE),
-        ]
+        for x, y in self.fortressPositions():
+            self.setTile(x, y, tile)
+
+    def distanceField(self, name, targets):
+        """
+        到targets的距離場，name相同的距離場只保留一個
+        targets改變時重新計算，地形變化時由setTile()更新
+        """
+        field = self.distance_fields.get(name)
+        if field == None:
+            field = DistanceField(self, targets)
+            self.distance_fields[name] = field
+        else:
+            field.setTargets(targets)
+        return field
 
-        obsolete = []
 
-        for i, rect in enumerate(self.mapr):
-            if rect[1].topleft in positions:
-                obsolete.append(rect)
-        for rect in obsolete:
-            self.mapr.remove(rect)
+class DistanceField(object):
+    """
+    地形圖上每個位置到目標位置的最短距離，敵方坦克按距離選擇前進方向
+    坦克佔用2x2個格子，位置為坦克左上角的格子
+    磚牆可以打穿，但代價更高；鋼板、海水和玩家基地不能通過
+    地形被打穿時只更新受影響的距離，地形增加時下次查詢前重新計算
+    """
 
-        for pos in positions:
-            self.mapr.append((tile, pygame.Rect(pos, [self.TILE_SIZE, self.TILE_SIZE])))
+    # 無法到達
+    INFINITY = 1 << 30
+    # 穿過一個磚牆格子的額外代價
+    BRICK_COST = 4
 
-        self.updateObstacleRects()
+    # 四個方向的位置偏移，與Tank.DIR_*一致
+    OFFSETS = ((0, -1), (1, 0), (0, 1), (-1, 0))
+
+    # 每個位置的上、右、下、左相鄰位置，超出地圖為None，key為每行的位置數
+    # 所有距離場共用，複製遊戲世界時不複製
+    neighbour_tables = {}
+
+    def __init__(self, level, targets):
+        self.level = level
+        # 每行、每列的位置數
+        self.size = level.grid_size - 1
+        self.targets = list(targets)
+
+        # 進入每個位置的代價，None為不能通過
+        self.costs = [self.cost(index) for index in range(self.size * self.size)]
+        self.distances = []
+        self.dirty = True
+
+    def neighbourTable(self):
+        """ 每個位置的相鄰位置 """
+        size = self.size
+        table = DistanceField.neighbour_tables.get(size)
+        if table == None:
+            table = []
+            for y in range(size):
+                for x in range(size):
+                    neighbours = []
+                    for dx, dy in self.OFFSETS:
+                        if 0 <= x + dx < size and 0 <= y + dy < size:
+                            neighbours.append((y + dy) * size + x + dx)
+                        else:
+                            neighbours.append(None)
+                    table.append(tuple(neighbours))
+            DistanceField.neighbour_tables[size] = table
+        return table
+
+    def cost(self, index):
+        """ 坦克進入一個位置的代價 """
+        level = self.level
+        grid_size = level.grid_size
+        x = index % self.size
+        y = index // self.size
+        castle_rect = level.world.castle.rect
+        cost = 1
+        for cell in (y*grid_size + x, y*grid_size + x + 1, (y+1)*grid_size + x, (y+1)*grid_size + x + 1):
+            tile = level.tiles[cell]
+            if tile in (level.TILE_STEEL, level.TILE_WATER) or level.obstacle_grid[cell] is castle_rect:
+                return None
+            if tile == level.TILE_BRICK:
+                cost += self.BRICK_COST
+        return cost
+
+    def setTargets(self, targets):
+        """ 修改目標位置 """
+        targets = list(targets)
+        if targets != self.targets:
+            self.targets = targets
+            self.dirty = True
+
+    def rebuild(self):
+        """ 從目標位置開始重新計算所有位置的距離 """
+        self.distances = [self.INFINITY] * len(self.costs)
+        queue = []
+        for target in self.targets:
+            if self.costs[target] != None:
+                self.distances[target] = 0
+                queue.append((0, target))
+        heapq.heapify(queue)
+        self.propagate(queue)
+        self.dirty = False
+
+    def propagate(self, queue):
+        """ Dijkstra：從queue中的位置向外更新距離 """
+        distances = self.distances
+        costs = self.costs
+        neighbours = self.neighbourTable()
+        while len(queue) > 0:
+            distance, index = heapq.heappop(queue)
+            if distance > distances[index]:
+                continue
+            # 從相鄰位置進入這個位置
+            distance += costs[index]
+            for neighbour in neighbours[index]:
+                if neighbour != None and costs[neighbour] != None and distance < distances[neighbour]:
+                    distances[neighbour] = distance
+                    heapq.heappush(queue, (distance, neighbour))
+
+    def tileChanged(self, x, y):
+        """ 格子(x, y)的地形改變了，更新包含這個格子的位置 """
+        size = self.size
+        queue = []
+        for py in range(max(y - 1, 0), min(y, size - 1) + 1):
+            for px in range(max(x - 1, 0), min(x, size - 1) + 1):
+                index = py * size + px
+                old = self.costs[index]
+                new = self.cost(index)
+                if old == new:
+                    continue
+                self.costs[index] = new
+                if self.dirty:
+                    continue
+                # 代價增加或者原來不能通過的位置，需要重新計算
+                if new == None or old == None or new > old:
+                    self.dirty = True
+                    continue
+                # 代價減少，相鄰位置經過這個位置可能更近
+                if self.distances[index] < self.INFINITY:
+                    queue.append((self.distances[index], index))
+        if len(queue) > 0 and not self.dirty:
+            heapq.heapify(queue)
+            self.propagate(queue)
+
+    def distance(self, index):
+        """ 位置到目標的距離 """
+        if self.dirty:
+            self.rebuild()
+        return self.distances[index]
+
+    def nextDirection(self, index):
+        """ 從位置出發，距離目標最近的方向，已經到達或無法到達返回None """
+        if self.dirty:
+            self.rebuild()
+        if self.distances[index] == 0:
+            return None
+        best = None
+        best_distance = self.INFINITY
+        for direction, neighbour in enumerate(self.neighbourTable()[index]):
+            if neighbour == None or self.costs[neighbour] == None:
+                continue
+            distance = self.distances[neighbour] + self.costs[neighbour]
+            if distance < best_distance:
+                best = direction
+                best_distance = distance
+        return best
+
+
+class SpatialHash(object):
+    """
+    按固定大小的區塊索引物體，查詢可能和一個區域碰撞的物體時只檢查附近區塊中的物體
+    大地圖上有幾百輛坦克和砲彈時，碰撞檢查不用逐個比較所有物體
+    物體按左上角所在的區塊加入索引，查詢時向左上擴大物體的最大尺寸
+    建立索引後物體還會移動，margin為物體最多還能移動的距離，查詢時再向四周擴大margin
+    查詢結果按物體加入的順序排列，和逐個檢查列表的順序一樣，是否碰撞仍要用物體當前的rect判斷
+    """
+
+    # 區塊像素尺寸
+    CELL_SIZE = 64
+    # 物體數量超過這個數才建立索引，否則直接檢查整個列表更快
+    MIN_OBJECTS = 32
+
+    def __init__(self, objects, size, margin = 0):
+        self.objects = list(objects)
+        # 物體的最大寬度和高度
+        self.size = size
+        self.margin = margin
+        # key為區塊坐標，值為左上角在這個區塊中的物體的編號
+        self.cells = {}
+        # 已經從列表中移除的物體的id
+        self.removed = set()
+        cell_size = self.CELL_SIZE
+        cells = self.cells
+        for order, obj in enumerate(self.objects):
+            rect = obj.rect
+            key = (rect.left // cell_size, rect.top // cell_size)
+            orders = cells.get(key)
+            if orders == None:
+                cells[key] = [order]
+            else:
+                orders.append(order)
+
+    def remove(self, obj):
+        """ 物體從列表中移除時也要從索引中移除 """
+        self.removed.add(id(obj))
+
+    def query(self, rect):
+        """ 可能和rect碰撞的物體，按加入的順序排列 """
+        cell_size = self.CELL_SIZE
+        low = self.size + self.margin
+        x1 = (rect.left - low) // cell_size
+        y1 = (rect.top - low) // cell_size
+        x2 = (rect.right - 1 + self.margin) // cell_size
+        y2 = (rect.bottom - 1 + self.margin) // cell_size
+        cells = self.cells
+        found = []
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                orders = cells.get((x, y))
+                if orders != None:
+                    found += orders
+        found.sort()
+        objects = self.objects
+        if len(self.removed) == 0:
+            return [objects[order] for order in found]
+        removed = self.removed
+        return [objects[order] for order in found if id(objects[order]) not in removed]
 
 
 class Tank(object):
@@ -542,8 +1021,6 @@ class Tank(object):
     (SIDE_PLAYER, SIDE_ENEMY) = range(2)
 
     def __init__(self, level, side, position = None, direction = None, filename = None):
-        global sprites
-
         # 坦克生命值，生命值小於1表示被消滅
         self.health = 100
 
@@ -581,22 +1058,17 @@ class Tank(object):
         self.pressed = [False] * 4
 
         # 坦克無敵時的狀態效果
-        self.shield_images = [
-            sprites.subsurface(0, 48*2, 16*2, 16*2),
-            sprites.subsurface(16*2, 48*2, 16*2, 16*2),
-        ]
+        self.shield_images = atlas.frames(atlas.SHIELD)
         self.shield_image = self.shield_images[0]
         self.shield_index = 0
 
         # 出現新坦克時的顯示效果
-        self.spawn_images = [
-            sprites.subsurface(32*2, 48*2, 16*2, 16*2),
-            sprites.subsurface(48*2, 48*2, 16*2, 16*2),
-        ]
+        self.spawn_images = atlas.frames(atlas.SPAWN)
         self.spawn_image = self.spawn_images[0]
         self.spawn_index = 0
 
         self.level = level
+        self.world = level.world
 
         # 坦克出現的位置
         if position != None:
@@ -606,27 +1078,27 @@ class Tank(object):
 
         # 坦克出現時的方向
         if direction == None:
-            self.direction = random.choice([self.DIR_RIGHT, self.DIR_DOWN, self.DIR_LEFT])
+            self.direction = self.world.random.choice([self.DIR_RIGHT, self.DIR_DOWN, self.DIR_LEFT])
         else:
             self.direction = direction
 
         self.state = self.STATE_SPAWNING
 
         # 播放新坦克出現時的效果
-        self.timer_uuid_spawn = gtimer.add(100, lambda :self.toggleSpawnImage())
+        self.timer_uuid_spawn = self.world.timer.add(100, self.toggleSpawnImage)
         # 產生新坦克的效果出現1秒後终止，並出現坦克
-        self.timer_uuid_spawn_end = gtimer.add(1000, lambda :self.endSpawning())
+        self.timer_uuid_spawn_end = self.world.timer.add(1000, self.endSpawning)
 
     def endSpawning(self):
         """ 停止播放新坦克出現效果，坦克出現，可以操作 """
         self.state = self.STATE_ALIVE
-        gtimer.destroy(self.timer_uuid_spawn_end)
+        self.world.timer.destroy(self.timer_uuid_spawn_end)
 
 
     def toggleSpawnImage(self):
         """ 產生新坦克時的效果 """
         if self.state != self.STATE_SPAWNING:
-            gtimer.destroy(self.timer_uuid_spawn)
+            self.world.timer.destroy(self.timer_uuid_spawn)
             return
         self.spawn_index += 1
         if self.spawn_index >= len(self.spawn_images):
@@ -637,7 +1109,7 @@ class Tank(object):
     def toggleShieldImage(self):
         """ 用於坦克的無敵狀態顯示 """
         if self.state != self.STATE_ALIVE:
-            gtimer.destroy(self.timer_uuid_shield)
+            self.world.timer.destroy(self.timer_uuid_shield)
             return
         if self.shielded:
             self.shield_index += 1
@@ -647,25 +1119,26 @@ class Tank(object):
             self.shield_image = self.shield_images[self.shield_index]
 
     def draw(self):
-        """ 畫坦克 """
+        """ 畫坦克，返回畫過的區域 """
         global screen
         if self.state == self.STATE_ALIVE:
-            screen.blit(self.image, self.rect.topleft)
+            rect = screen.blit(self.image, self.rect.topleft)
             #pygame.image.load('assets/sprites/tankpic.jpeg').convert_alpha()
             if self.shielded:
-                screen.blit(self.shield_image, [self.rect.left-3, self.rect.top-3])
+                rect = rect.union(screen.blit(self.shield_image, [self.rect.left-3, self.rect.top-3]))
+            return rect
         # 坦克爆炸
         elif self.state == self.STATE_EXPLODING:
-            self.explosion.draw()
+            return self.explosion.draw()
         # 產生新坦克
         elif self.state == self.STATE_SPAWNING:
-            screen.blit(self.spawn_image, self.rect.topleft)
+            return screen.blit(self.spawn_image, self.rect.topleft)
 
     def explode(self):
         """ 坦克爆炸 """
         if self.state != self.STATE_DEAD:
             self.state = self.STATE_EXPLODING
-            self.explosion = Explosion(self.rect.topleft)
+            self.explosion = Explosion(self.world, self.rect.topleft)
 
             if self.bonus:
                 self.spawnBonus()   #坦克爆炸後出現爆炸
@@ -675,11 +1148,9 @@ class Tank(object):
         發射子彈
         返回True表示已發射子彈，False為其他
         """
-        global bullets, labels
-
         # 坦克被消滅，不再發射砲彈
         if self.state != self.STATE_ALIVE:
-            gtimer.destroy(self.timer_uuid_fire)
+            self.world.timer.destroy(self.timer_uuid_fire)
             return False
 
         if self.paused:
@@ -689,7 +1160,7 @@ class Tank(object):
             # 同一輛坦克只能保持一定的active砲彈數
             # 遊戲窗口內最多屬於同一輛坦克的砲彈數
             active_bullets = 0
-            for bullet in bullets:
+            for bullet in self.world.bullets:
                 if bullet.owner_class == self and bullet.state == bullet.STATE_ACTIVE:
                     active_bullets += 1
             if active_bullets >= self.max_active_bullets:
@@ -710,7 +1181,7 @@ class Tank(object):
             self.bullet_queued = False
 
         bullet.owner_class = self
-        bullets.append(bullet)
+        self.world.bullets.append(bullet)
         return True
 
     def rotate(self, direction, fix_position = True):
@@ -756,8 +1227,6 @@ class Tank(object):
 
     def bulletImpact(self, friendly_fire = False, damage = 100, tank = None):
         """ 子彈碰撞規則，敵方坦克被敵方砲彈擊中不會爆炸 """
-        global play_sounds, sounds
-
         # 坦克處於無敵狀態中
         if self.shielded:
             return True
@@ -771,10 +1240,9 @@ class Tank(object):
                     tank.trophies["enemy"+str(self.type)] += 1
                     points = (self.type+1) * 100
                     tank.score += points
-                    if play_sounds:
-                        sounds["explosion"].play()
+                    self.world.playSound("explosion")
 
-                    labels.append(Label(self.rect.topleft, str(points), 500))
+                    self.world.labels.append(Label(self.world, self.rect.topleft, str(points), 500))
 
                 # 坦克爆炸
                 self.explode()
@@ -788,17 +1256,47 @@ class Tank(object):
         elif self.side == self.SIDE_PLAYER:
             if not self.paralised:
                 self.setParalised(True)
-                self.timer_uuid_paralise = gtimer.add(10000, lambda :self.setParalised(False), 1)
+                self.timer_uuid_paralise = self.world.timer.add(10000, functools.partial(self.setParalised, False), 1)
             return True
 
     def setParalised(self, paralised = True):
         """ 坦克癱瘓狀態 """
         if self.state != self.STATE_ALIVE:
-            gtimer.destroy(self.timer_uuid_paralise)
+            self.world.timer.destroy(self.timer_uuid_paralise)
             return
         self.paralised = paralised
 
 
+class TankPath(object):
+    """
+    敵方坦克的直線移動路徑
+    每一步的坐標在取出時才計算，不預先生成坐標列表
+    """
+    def __init__(self, x, y, direction, pixels, speed, exact = False):
+        self.x = x
+        self.y = y
+        self.dx, self.dy = DistanceField.OFFSETS[direction]
+        self.pixels = pixels
+        self.speed = speed
+        # 一共多少步，和range(0, pixels, speed)一樣
+        self.length = max(0, (pixels + speed - 1) // speed)
+        # 已經取出多少步
+        self.index = 0
+        # exact為True時不包含當前坐標，最後一步正好走完pixels像素
+        if exact:
+            self.index = 1
+            self.length += 1
+
+    def __len__(self):
+        return self.length - self.index
+
+    def pop(self):
+        """ 取出下一步的坐標 """
+        px = min(self.index * self.speed, self.pixels)
+        self.index += 1
+        return [self.x + self.dx * px, self.y + self.dy * px]
+
+
 class Enemy(Tank):
     """ 敵方坦克 """
     # 四種類似的坦克
@@ -807,8 +1305,6 @@ class Enemy(Tank):
     def __init__(self, level, type, position = None, direction = None, filename = None):
         Tank.__init__(self, level, type, position = None, direction = None, filename = None)
 
-        global enemies, sprites
-
         # 為True則不開火
         self.bullet_queued = False
 
@@ -830,30 +1326,21 @@ class Enemy(Tank):
 
         # 敵方坦克爆炸後有五分之一機會留下一個寶物
         # 且場上同時只能有一個寶物
-        if random.randint(1, 5) == 1:
+        if self.world.random.randint(1, 5) == 1:
             self.bonus = True
-            for enemy in enemies:
+            for enemy in self.world.enemies:
                 if enemy.bonus:
                     self.bonus = False
                     break
 
-        images = [
-            sprites.subsurface(32*2, 0, 13*2, 15*2),
-            sprites.subsurface(48*2, 0, 13*2, 15*2),
-            sprites.subsurface(64*2, 0, 13*2, 15*2),
-            sprites.subsurface(80*2, 0, 13*2, 15*2),
-            sprites.subsurface(32*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(48*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(64*2, 16*2, 13*2, 15*2),
-            sprites.subsurface(80*2, 16*2, 13*2, 15*2)
-        ]
+        images = atlas.directions(atlas.ENEMY_TANKS[self.type])
 
-        self.image = images[self.type+0]
+        self.image = images[self.DIR_UP]
 
-        self.image_up = self.image;
-        self.image_left = pygame.transform.rotate(self.image, 90)
-        self.image_down = pygame.transform.rotate(self.image, 180)
-        self.image_right = pygame.transform.rotate(self.image, 270)
+        self.image_up = images[self.DIR_UP]
+        self.image_left = images[self.DIR_LEFT]
+        self.image_down = images[self.DIR_DOWN]
+        self.image_right = images[self.DIR_RIGHT]
 
         if self.bonus:
             self.image1_up = self.image_up;
@@ -861,35 +1348,40 @@ class Enemy(Tank):
             self.image1_down = self.image_down
             self.image1_right = self.image_right
 
-            self.image2 = images[self.type+4]
-            self.image2_up = self.image2;
-            self.image2_left = pygame.transform.rotate(self.image2, 90)
-            self.image2_down = pygame.transform.rotate(self.image2, 180)
-            self.image2_right = pygame.transform.rotate(self.image2, 270)
+            images = atlas.directions(atlas.ENEMY_TANKS_FLASH[self.type])
+            self.image2 = images[self.DIR_UP]
+            self.image2_up = images[self.DIR_UP]
+            self.image2_left = images[self.DIR_LEFT]
+            self.image2_down = images[self.DIR_DOWN]
+            self.image2_right = images[self.DIR_RIGHT]
 
         self.rotate(self.direction, False)
 
-        # 敵方坦克出現位置
+        # 敵方坦克出現位置，所有位置都被佔用時這輛坦克放回去，下次再出現
         if position == None:
-            self.rect.topleft = self.getFreeSpawningPosition()
-            if not self.rect.topleft:
+            position = self.getFreeSpawningPosition()
+            if not position:
+                level.enemies_left.append(self.type)
+                self.world.timer.destroy(self.timer_uuid_spawn)
+                self.world.timer.destroy(self.timer_uuid_spawn_end)
                 self.state = self.STATE_DEAD
                 return
+            self.rect.topleft = position
 
         # 計算坦克自動移動路徑
         self.path = self.generatePath(self.direction)
 
         # 每秒發射一顆子彈
-        self.timer_uuid_fire = gtimer.add(1000, lambda :self.fire())
+        self.timer_uuid_fire = self.world.timer.add(1000, self.fire)
 
         # 寶物閃爍
         if self.bonus:
-            self.timer_uuid_flash = gtimer.add(200, lambda :self.toggleFlash())
+            self.timer_uuid_flash = self.world.timer.add(200, self.toggleFlash)
 
     def toggleFlash(self):
         """ 切換閃爍狀態 """
         if self.state not in (self.STATE_ALIVE, self.STATE_SPAWNING):
-            gtimer.destroy(self.timer_uuid_flash)
+            self.world.timer.destroy(self.timer_uuid_flash)
             return
         self.flash = not self.flash
         if self.flash:
@@ -906,34 +1398,33 @@ class Enemy(Tank):
 
     def spawnBonus(self):
         """ 產生新的寶物 """
-
-        global bonuses
+        bonuses = self.world.bonuses
 
         if len(bonuses) > 0:
             return
         bonus = Bonus(self.level)
         bonuses.append(bonus)
-        gtimer.add(500, lambda :bonus.toggleVisibility())
-        gtimer.add(10000, lambda :bonuses.remove(bonus), 1)
+        self.world.timer.add(500, bonus.toggleVisibility)
+        self.world.timer.add(10000, bonus.destroy, 1)
 
 
     def getFreeSpawningPosition(self):
-        global players, enemies
 
+        # 敵方坦克出現位置，World.spawn_points中的格子坐標
+        tile_size = self.level.TILE_SIZE
         available_positions = [
-            [(self.level.TILE_SIZE * 2 - self.rect.width) / 2, (self.level.TILE_SIZE * 2 - self.rect.height) / 2],
-            [12 * self.level.TILE_SIZE + (self.level.TILE_SIZE * 2 - self.rect.width) / 2, (self.level.TILE_SIZE * 2 - self.rect.height) / 2],
-            [24 * self.level.TILE_SIZE + (self.level.TILE_SIZE * 2 - self.rect.width) / 2,  (self.level.TILE_SIZE * 2 - self.rect.height) / 2]
+            [x * tile_size + (tile_size * 2 - self.rect.width) / 2, y * tile_size + (tile_size * 2 - self.rect.height) / 2]
+            for x, y in self.world.spawn_points
         ]
 
-        random.shuffle(available_positions)
+        self.world.random.shuffle(available_positions)
 
         # 隨機挑選一個沒被其他物體佔用的坐標出現新坦克
         for pos in available_positions:
             enemy_rect = pygame.Rect(pos, [26, 26])
 
             collision = False
-            for enemy in enemies:
+            for enemy in self.world.nearbyEnemies(enemy_rect):
                 if enemy_rect.colliderect(enemy.rect):
                     collision = True
                     continue
@@ -942,7 +1433,7 @@ class Enemy(Tank):
                 continue
 
             collision = False
-            for player in players:
+            for player in self.world.players:
                 if enemy_rect.colliderect(player.rect):
                     collision = True
                     continue
@@ -955,16 +1446,16 @@ class Enemy(Tank):
 
     def move(self):
         """ 敵方坦克移動 """
-        global players, enemies, bonuses
+        world = self.world
 
         if self.state != self.STATE_ALIVE or self.paused or self.paralised:
             return
 
         # 生成自動移動路徑
-        if self.path == []:
+        if len(self.path) == 0:
             self.path = self.generatePath(None, True)
 
-        new_position = self.path.pop(0)
+        new_position = self.path.pop()
 
         # 坦克下一個出現位置超出遊戲界面，則重新計算自動移動路徑
         if self.direction == self.DIR_UP:
@@ -972,11 +1463,11 @@ class Enemy(Tank):
                 self.path = self.generatePath(self.direction, True)
                 return
         elif self.direction == self.DIR_RIGHT:
-            if new_position[0] > (416 - 26):
+            if new_position[0] > (self.level.pixel_size - 26):
                 self.path = self.generatePath(self.direction, True)
                 return
         elif self.direction == self.DIR_DOWN:
-            if new_position[1] > (416 - 26):
+            if new_position[1] > (self.level.pixel_size - 26):
                 self.path = self.generatePath(self.direction, True)
                 return
         elif self.direction == self.DIR_LEFT:
@@ -987,28 +1478,28 @@ class Enemy(Tank):
         new_rect = pygame.Rect(new_position, [26, 26])
 
         # 撞上地形，重新計算坦克自動移動路徑
-        if new_rect.collidelist(self.level.obstacle_rects) != -1:
+        if self.level.collideObstacle(new_rect):
             self.path = self.generatePath(self.direction, True)
             return
 
         # 撞上其他敵方坦克，坦克轉向反方向，並重新計算坦克自動移動路徑
-        for enemy in enemies:
+        for enemy in world.nearbyEnemies(new_rect):
             if enemy != self and new_rect.colliderect(enemy.rect):
                 self.turnAround()
                 self.path = self.generatePath(self.direction)
                 return
 
         # 撞上玩家坦克，坦克轉向反方向，並重新計算坦克自動移動路徑
-        for player in players:
+        for player in world.players:
             if new_rect.colliderect(player.rect):
                 self.turnAround()
                 self.path = self.generatePath(self.direction)
                 return
 
         # 撞上寶物，寶物消失，敵人坦克不會獲得任何增益效果
-        for bonus in bonuses:
+        for bonus in world.bonuses:
             if new_rect.colliderect(bonus.rect):
-                bonuses.remove(bonus)
+                world.bonuses.remove(bonus)
 
         # 沒撞上任何東西，則將坐標設置為坦克移動的下一個坐標
         self.rect.topleft = new_rect.topleft
@@ -1023,7 +1514,14 @@ class Enemy(Tank):
         """
         敵方坦克自動移動規則：
         先沿著坦克指向方向走，不通則隨機選擇一個方向
+        World.aggression為按距離場追擊玩家基地或玩家坦克的機率，撞到其他坦克後不追擊，以免互相堵住
         """
+        world = self.world
+        if fix_direction and world.aggression > 0 and world.random.random() < world.aggression:
+            path = self.chasePath()
+            if path != None:
+                return path
+
         all_directions = [self.DIR_UP, self.DIR_RIGHT, self.DIR_DOWN, self.DIR_LEFT]
 
         if direction == None:
@@ -1033,7 +1531,7 @@ class Enemy(Tank):
                 opposite_direction = self.direction - 2
             directions = all_directions
             # 打亂方向順序
-            random.shuffle(directions)
+            self.world.random.shuffle(directions)
             # 將坦克方向的相反方向放到最後，最後才選擇反方向移動
             directions.remove(opposite_direction)
             directions.append(opposite_direction)
@@ -1043,7 +1541,7 @@ class Enemy(Tank):
             else:
                 opposite_direction = direction - 2
             directions = all_directions
-            random.shuffle(directions)
+            self.world.random.shuffle(directions)
             directions.remove(opposite_direction)
             directions.remove(direction)
             # 優先選擇坦克方向移動
@@ -1053,6 +1551,8 @@ class Enemy(Tank):
 
         x = int(round(self.rect.left / 16))
         y = int(round(self.rect.top / 16))
+        # 最右邊、最下面能出現坦克的格子
+        last = self.level.grid_size - 2
 
         new_direction = None
 
@@ -1061,22 +1561,22 @@ class Enemy(Tank):
         for direction in directions:
             if direction == self.DIR_UP and y > 1:
                 new_pos_rect = self.rect.move(0, -8)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collideObstacle(new_pos_rect):
                     new_direction = direction
                     break
-            elif direction == self.DIR_RIGHT and x < 24:
+            elif direction == self.DIR_RIGHT and x < last:
                 new_pos_rect = self.rect.move(8, 0)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collideObstacle(new_pos_rect):
                     new_direction = direction
                     break
-            elif direction == self.DIR_DOWN and y < 24:
+            elif direction == self.DIR_DOWN and y < last:
                 new_pos_rect = self.rect.move(0, 8)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collideObstacle(new_pos_rect):
                     new_direction = direction
                     break
             elif direction == self.DIR_LEFT and x > 1:
                 new_pos_rect = self.rect.move(-8, 0)
-                if new_pos_rect.collidelist(self.level.obstacle_rects) == -1:
+                if not self.level.collideObstacle(new_pos_rect):
                     new_direction = direction
                     break
 
@@ -1091,8 +1591,6 @@ class Enemy(Tank):
         # 坦克轉向並修正轉向後的坐標
         self.rotate(new_direction, fix_direction)
 
-        positions = []
-
         x = self.rect.left
         y = self.rect.top
 
@@ -1102,30 +1600,86 @@ class Enemy(Tank):
             axis_fix = self.nearest(x, 16) - x
         axis_fix = 0
 
-        pixels = self.nearest(random.randint(1, 12) * 32, 32) + axis_fix + 3
-
-        # 計算自動移動路徑
-        if new_direction == self.DIR_UP:
-            for px in range(0, pixels, self.speed):
-                positions.append([x, y-px])
-        elif new_direction == self.DIR_RIGHT:
-            for px in range(0, pixels, self.speed):
-                positions.append([x+px, y])
-        elif new_direction == self.DIR_DOWN:
-            for px in range(0, pixels, self.speed):
-                positions.append([x, y+px])
-        elif new_direction == self.DIR_LEFT:
-            for px in range(0, pixels, self.speed):
-                positions.append([x-px, y])
+        pixels = self.nearest(self.world.random.randint(1, 12) * 32, 32) + axis_fix + 3
+
+        # 自動移動路徑
+        return TankPath(x, y, new_direction, pixels, self.speed)
+
+    def gridPosition(self, rect):
+        """ 坦克所在的距離場位置 """
+        last = self.level.grid_size - 2
+        x = min(max(int(round((rect.left - 3) / 16.0)), 0), last)
+        y = min(max(int(round((rect.top - 3) / 16.0)), 0), last)
+        return y * (last + 1) + x
+
+    def chasePath(self):
+        """ 按距離場朝玩家基地或最近的玩家坦克前進一格，無法前進返回None """
+        level = self.level
+        size = level.grid_size - 1
+        index = self.gridPosition(self.rect)
+
+        # 在玩家基地上方、左邊、右邊可以直接打到基地
+        castle_x = self.world.castle.rect.left // 16
+        castle_y = self.world.castle.rect.top // 16
+        targets = []
+        for x, y in ((castle_x, castle_y - 2), (castle_x - 2, castle_y), (castle_x + 2, castle_y)):
+            if 0 <= x < size and 0 <= y < size:
+                targets.append(y * size + x)
+        fields = [level.distanceField("castle", targets)]
+
+        # 玩家坦克每移動一格都要重新計算整個距離場，大地圖上目標位置按比例取整，減少重新計算的次數
+        step = max(1, level.grid_size // Level.GRID_SIZE)
+        for i, player in enumerate(self.world.players):
+            if player.state == player.STATE_ALIVE:
+                target = self.gridPosition(player.rect)
+                if step > 1:
+                    target = target // size // step * step * size + target % size // step * step
+                fields.append(level.distanceField("player" + str(i), [target]))
+
+        # 追擊最近的目標
+        field = fields[0]
+        for other in fields[1:]:
+            if other.distance(index) < field.distance(index):
+                field = other
+
+        direction = field.nextDirection(index)
+        if direction == None:
+            return None
+
+        # 坦克要先對齊所在位置的格子，否則會擦到旁邊格子的障礙物
+        left = index % size * 16 + 3
+        top = index // size * 16 + 3
+        if direction in (self.DIR_UP, self.DIR_DOWN) and self.rect.left != left:
+            if left > self.rect.left:
+                direction = self.DIR_RIGHT
+            else:
+                direction = self.DIR_LEFT
+        elif direction in (self.DIR_RIGHT, self.DIR_LEFT) and self.rect.top != top:
+            if top > self.rect.top:
+                direction = self.DIR_DOWN
+            else:
+                direction = self.DIR_UP
+        else:
+            # 前進到下一個位置
+            dx, dy = DistanceField.OFFSETS[direction]
+            left += dx * 16
+            top += dy * 16
 
-        return positions
+        pixels = abs(left - self.rect.left) + abs(top - self.rect.top)
+        self.rotate(direction, False)
+        return TankPath(self.rect.left, self.rect.top, direction, pixels, self.speed, True)
 
 
 class Player(Tank):
     """ 玩家坦克 """
+    # 玩家一、玩家二控制開火和向上、向右、向下、向左移動的按鍵
+    CONTROLS = (
+        [pygame.K_SPACE, pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT],
+        [102, 119, 100, 115, 97],
+    )
+
     def __init__(self, level, type, position = None, direction = None, filename = None):
         Tank.__init__(self, level, type, position = None, direction = None, filename = None)
-        global sprites
 
         if filename == None:
             filename = (0, 0, 16*2, 16*2)
@@ -1148,11 +1702,12 @@ class Player(Tank):
         }
 
         # 玩家坦克圖像
-        self.image = sprites.subsurface(filename)
-        self.image_up = self.image
-        self.image_left = pygame.transform.rotate(self.image, 90)
-        self.image_down = pygame.transform.rotate(self.image, 180)
-        self.image_right = pygame.transform.rotate(self.image, 270)
+        images = atlas.directions(filename)
+        self.image = images[self.DIR_UP]
+        self.image_up = images[self.DIR_UP]
+        self.image_left = images[self.DIR_LEFT]
+        self.image_down = images[self.DIR_DOWN]
+        self.image_right = images[self.DIR_RIGHT]
 
         # 玩家坦克方向默認向上
         if direction == None:
@@ -1162,7 +1717,7 @@ class Player(Tank):
 
     def move(self, direction):
         """ 玩家坦克移動 """
-        global players, enemies, bonuses
+        world = self.world
 
         if self.state == self.STATE_EXPLODING:
             if not self.explosion.active:
@@ -1186,11 +1741,11 @@ class Player(Tank):
                 return
         elif direction == self.DIR_RIGHT:
             new_position = [self.rect.left + self.speed, self.rect.top]
-            if new_position[0] > (416 - 26):
+            if new_position[0] > (self.level.pixel_size - 26):
                 return
         elif direction == self.DIR_DOWN:
             new_position = [self.rect.left, self.rect.top + self.speed]
-            if new_position[1] > (416 - 26):
+            if new_position[1] > (self.level.pixel_size - 26):
                 return
         elif direction == self.DIR_LEFT:
             new_position = [self.rect.left - self.speed, self.rect.top]
@@ -1200,21 +1755,21 @@ class Player(Tank):
         player_rect = pygame.Rect(new_position, [26, 26])
 
         # 撞上地形
-        if player_rect.collidelist(self.level.obstacle_rects) != -1:
+        if self.level.collideObstacle(player_rect):
             return
 
         # 撞上其它玩家坦克
-        for player in players:
+        for player in world.players:
             if player != self and player.state == player.STATE_ALIVE and player_rect.colliderect(player.rect) == True:
                 return
 
         # 撞上敵方坦克
-        for enemy in enemies:
+        for enemy in world.nearbyEnemies(player_rect):
             if player_rect.colliderect(enemy.rect) == True:
                 return
 
         # 撞上寶物
-        for bonus in bonuses:
+        for bonus in world.bonuses:
             if player_rect.colliderect(bonus.rect) == True:
                 self.bonus = bonus
 
@@ -1234,89 +1789,259 @@ class Player(Tank):
         self.state = self.STATE_ALIVE
 
 
-class Game(object):
+class World(object):
+    """
+    遊戲世界，保存一局遊戲的全部狀態並推進遊戲邏輯
+    不依賴遊戲窗口、聲音和幀率，可以在沒有窗口的環境下運行
+    """
     # 方向
     (DIR_UP, DIR_RIGHT, DIR_DOWN, DIR_LEFT) = range(4)
     TILE_SIZE = 16
 
-    def __init__(self):
-        global screen, sprites, play_sounds, sounds
-        # 遊戲窗口位於屏幕中央
-        os.environ['SDL_VIDEO_WINDOW_POS'] = 'center'
+    # 玩家輸入位掩碼：向上、向右、向下、向左移動和開火
+    (INPUT_UP, INPUT_RIGHT, INPUT_DOWN, INPUT_LEFT, INPUT_FIRE) = (1, 2, 4, 8, 16)
+
+    # 固定步長模式下每一步的時間，單位ms，即每秒50步
+    TICK = 20
+
+    # 每一關四種不同類型的坦克的數量
+    levels_enemies = (
+        (18,2,0,0), (14,4,0,2), (14,4,0,2), (2,5,10,3), (8,5,5,2),
+        (9,2,7,2), (7,4,6,3), (7,4,7,2), (6,4,7,3), (12,2,4,2),
+        (5,5,4,6), (0,6,8,6), (0,8,8,4), (0,4,10,6), (0,2,10,8),
+        (16,2,0,2), (8,2,8,2), (2,8,6,4), (4,4,4,8), (2,8,2,8),
+        (6,2,8,4), (6,8,2,4), (0,10,4,6), (10,4,4,2), (0,8,2,10),
+        (4,6,4,6), (2,8,2,8), (15,2,2,1), (0,4,10,6), (4,8,4,4),
+        (3,8,3,6), (6,4,2,8), (4,4,4,8), (0,10,4,6), (0,6,4,10),
+    )
+
+    def __init__(self, nr_of_players = 1, seed = None, vector_bullets = False, grid_size = None,
+                 spawn_points = None, max_active_enemies = 4):
+        # 圖像資源不需要遊戲窗口也能加載
+        atlas.load()
+
+        # 地圖每行、每列的格子數，比原版大的地圖用原版地形圖平鋪填滿
+        if grid_size == None:
+            grid_size = Level.GRID_SIZE
+        self.grid_size = grid_size
+        # 敵方坦克出現位置的格子坐標，默認為原版最上面一行的左、中、右三個位置
+        if spawn_points == None:
+            spawn_points = self.spreadSpawnPoints(grid_size, 3)
+        self.spawn_points = [tuple(point) for point in spawn_points]
+        # 同時最多出現的敵人數
+        self.max_active_enemies = max_active_enemies
+
+        # 玩家數量
+        self.nr_of_players = nr_of_players
+
+        # 遊戲中所有隨機數都來自這個隨機數生成器
+        # 相同的種子和相同的輸入會得到完全相同的遊戲過程
+        if seed == None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        # 計時器
+        self.timer = Timer()
+        # 玩家坦克
+        self.players = []
+        # 敵方坦克
+        self.enemies = []
+        # 砲彈
+        self.bullets = []
+        # vector_bullets為True並且安裝了numpy時批量推進砲彈
+        self.bullet_manager = None
+        if vector_bullets and numpy != None:
+            self.bullet_manager = BulletManager(self)
+        # 寶物
+        self.bonuses = []
+        # 得分標籤
+        self.labels = []
+        # 本次step中產生的聲音，由Game負責播放
+        self.sound_events = []
+
+        # 玩家基地
+        self.castle = Castle(self)
+
+        self.level = None
+        # 0關表示還沒開始遊戲
+        self.stage = 0
+        self.timefreeze = False
+        # 敵方坦克追擊玩家基地或玩家坦克的機率，0為原版的隨機移動，1為一直追擊
+        self.aggression = 0.0
 
-        if play_sounds:
-            # 預設mixer初始化參數，必須位於pygame.init()之前
-            pygame.mixer.pre_init(44100, -16, 1, 512)
+        # 遊戲結束開關
+        self.game_over = False
+        # 關卡主循環開關，關卡结束3秒後才關閉
+        self.running = False
+        # 為False則不再接收玩家輸入，等待關卡结束
+        self.active = False
 
-        pygame.init()
-        size = width, height = 480, 416
-        # 創建遊戲窗口
-        screen = pygame.display.set_mode(size)
-        # 遊戲窗口的文字標題
-        pygame.display.set_caption("坦克大战")
-        # 用於設置幀數
-        self.clock = pygame.time.Clock()
+        # 已經推進的step數
+        self.ticks = 0
+        # 記錄每一步玩家輸入的回放，None表示不記錄
+        self.recorder = None
+        # 固定步長模式下還沒推進的時間，單位ms
+        self.accumulator = 0
+
+        # 敵方坦克和砲彈的碰撞索引，只在step()中坦克和砲彈很多時建立，其餘時間為None
+        self.enemy_index = None
+        self.bullet_index = None
+
+    @staticmethod
+    def spreadSpawnPoints(grid_size, count):
+        """ 在最上面一行平均分布count個敵方坦克出現位置 """
+        last = grid_size - 2
+        if count == 1:
+            return [(last // 2, 0)]
+        return [(int(round(i * last / float(count - 1))), 0) for i in range(count)]
+
+    def castlePosition(self):
+        """ 玩家基地左上角的格子坐標 """
+        return (self.grid_size // 2 - 1, self.grid_size - 2)
+
+    def playerPosition(self, index):
+        """ 玩家坦克出現位置的格子坐標，在玩家基地左右兩邊 """
+        x, y = self.castlePosition()
+        if index == 0:
+            return (x - 4, y)
+        return (x + 4, y)
+
+    def nearbyEnemies(self, rect):
+        """ 可能和rect碰撞的敵方坦克，按列表中的順序 """
+        if self.enemy_index == None:
+            return self.enemies
+        return self.enemy_index.query(rect)
+
+    def nearbyBullets(self, rect):
+        """ 可能和rect碰撞的砲彈，按列表中的順序 """
+        if self.bullet_index == None:
+            return self.bullets
+        return self.bullet_index.query(rect)
+
+    def indexObjects(self, objects, size, margin):
+        """ 物體很多時建立碰撞索引，否則返回None """
+        if len(objects) <= SpatialHash.MIN_OBJECTS:
+            return None
+        return SpatialHash(objects, size, margin)
+
+    def playSound(self, name):
+        """ 記錄要播放的聲音，世界本身不播放聲音 """
+        self.sound_events.append(name)
 
-        # 遊戲中所有圖片資源都在這裡了
-        sprites = pygame.transform.scale(pygame.image.load("images/sprites.gif"), [192, 224])
+    def nextLevel(self):
+        """ 進入下一關 """
+        del self.bullets[:]
+        del self.enemies[:]
+        del self.bonuses[:]
+        del self.labels[:]
+        # 畫玩家基地
+        self.castle.rebuild()
+        self.timer.clear()
 
-        # 設置遊戲窗口的圖形標題，默認為pygame官方圖標
-        pygame.display.set_icon(sprites.subsurface(0, 0, 13*2, 13*2))
+        # 加載地形圖和標識可以被子彈消滅的障礙物
+        self.stage += 1
+        self.level = Level(self, self.stage)
+        self.timefreeze = False
 
-        if play_sounds:
-            pygame.mixer.init(44100, -16, 1, 514)
-            # 加載聲音文件
-            sounds["start"] = pygame.mixer.Sound("sounds/gamestart.ogg")
-            sounds["endnew"] = pygame.mixer.Sound("sounds/gameovernew.ogg")
-            sounds["score"] = pygame.mixer.Sound("sounds/score.ogg")
-            sounds["bg"] = pygame.mixer.Sound("sounds/background.ogg")
-            sounds["fire"] = pygame.mixer.Sound("sounds/fire.ogg")
-            sounds["bonus"] = pygame.mixer.Sound("sounds/bonus.ogg")
-            sounds["explosion"] = pygame.mixer.Sound("sounds/explosion.ogg")
-            sounds["brick"] = pygame.mixer.Sound("sounds/brick.ogg")
-            sounds["steel"] = pygame.mixer.Sound("sounds/steel.ogg")
-            sounds["back"] = pygame.mixer.Sound("sounds/back.ogg")
-            sounds["diemuc"] = pygame.mixer.Sound("sounds/diemuc.ogg")
-            
-        # 表示還有多少個敵人
-        self.enemy_life_image = sprites.subsurface(81*2, 57*2, 7*2, 7*2)
-        # 表示自己還有多少條生命
-        self.player_life_image = sprites.subsurface(89*2, 56*2, 7*2, 8*2)
-        # 表示第幾關
-        self.flag_image = sprites.subsurface(64*2, 49*2, 16*2, 15*2)
+        # 大於35關的關卡，一律使用第35關的敵方坦克類型
+        if self.stage <= 35:
+            enemies_l = self.levels_enemies[self.stage - 1]
+        else:
+            enemies_l = self.levels_enemies[34]
 
-        # 用在選擇界面，選擇單人模式還是雙人模式
-        self.player_image = pygame.transform.rotate(sprites.subsurface(0, 0, 13*2, 13*2), 270)
+        # 比原版大的地圖，敵方坦克數量按面積等比例增加
+        if self.grid_size != Level.GRID_SIZE:
+            area = self.grid_size * self.grid_size
+            enemies_l = [count * area // (Level.GRID_SIZE * Level.GRID_SIZE) for count in enemies_l]
 
-        self.timefreeze = False
+        # 打亂四種類型的敵方坦克出戰順序
+        self.level.enemies_left = [0]*enemies_l[0] + [1]*enemies_l[1] + [2]*enemies_l[2] + [3]*enemies_l[3]
+        self.random.shuffle(self.level.enemies_left)
 
-        # 加載自定義字體，字體大小為16
-        #self.font = pygame.font.Font("fonts/prstart.ttf", 16)
-        self.font = pygame.font.Font("fonts/heiti.ttf", 16)
+        # 初始化玩家坦克
+        self.reloadPlayers()
 
-        # 遊戲結束畫面
-        self.im_game_over = pygame.Surface((64, 40))
-        self.im_game_over.set_colorkey((0,0,0))
-        self.im_game_over.blit(self.font.render("Game", False, (127, 64, 64)), [0, 0])
-        self.im_game_over.blit(self.font.render("OVER", False, (127, 64, 64)), [0, 20])
-        self.game_over_y = 416+40
+        # 玩家坦克出現3秒後，出現敵方坦克
+        self.timer.add(3000, self.spawnEnemy)
 
-        # 默認為單人遊戲
-        self.nr_of_players = 1
+        self.game_over = False
+        self.running = True
+        self.active = True
 
-        # 初始化遊戲環境
-        del players[:]
-        del bullets[:]
-        del enemies[:]
-        del bonuses[:]
+    def reloadPlayers(self):
+        """ 初始化玩家坦克 """
+        players = self.players
 
-    def triggerBonus(self, bonus, player):
-        """ 觸發寶物效果 """
+        if len(players) == 0:
+            # 玩家一
+            x, y = self.playerPosition(0)
+            x = x * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
+            y = y * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
 
-        global enemies, labels, play_sounds, sounds
+            player = Player(
+                self.level, 0, [x, y], self.DIR_UP, atlas.PLAYER_TANKS[0]
+            )
+            players.append(player)
 
-        if play_sounds:
-            sounds["bonus"].play()
+            # 玩家二
+            if self.nr_of_players == 2:
+                x, y = self.playerPosition(1)
+                x = x * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
+                y = y * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
+                player = Player(
+                    self.level, 0, [x, y], self.DIR_UP, atlas.PLAYER_TANKS[1]
+                )
+                player.controls = Player.CONTROLS[1][:]
+                players.append(player)
+
+        for player in players:
+            player.level = self.level
+            self.respawnPlayer(player, True)
+
+    def respawnPlayer(self, player, clear_scores = False):
+        # 初始化玩家坦克属性
+        player.reset()
+
+        # 清除玩家所有得分
+        if clear_scores:
+            player.trophies = {
+                "bonus" : 0, "enemy0" : 0, "enemy1" : 0, "enemy2" : 0, "enemy3" : 0
+            }
+
+        # 玩家坦克出現時的無敵效果顯示，默認4秒無敵
+        self.shieldPlayer(player, True, 4000)
+
+    def spawnEnemy(self):
+        """ 產生敵方坦克，每三個出現位置每次產生一輛，原版每次一輛 """
+        for i in range(max(1, len(self.spawn_points) // 3)):
+            if len(self.enemies) >= self.level.max_active_enemies:
+                return
+            if len(self.level.enemies_left) < 1 or self.timefreeze:
+                return
+            enemy = Enemy(self.level, 1)
+            if enemy.state == enemy.STATE_DEAD:
+                return
+
+            self.enemies.append(enemy)
+
+    def shieldPlayer(self, player, shield = True, duration = None):
+        """
+        玩家坦克剛出現時有短暂的無敵狀態
+        該方法用於添加/移除玩家的無敵狀態
+        """
+        player.shielded = shield
+        if shield:
+            player.timer_uuid_shield = self.timer.add(100, player.toggleShieldImage)
+        else:
+            self.timer.destroy(player.timer_uuid_shield)
+
+        if shield and duration != None:
+            self.timer.add(duration, functools.partial(self.shieldPlayer, player, False), 1)
+
+    def triggerBonus(self, bonus, player):
+        """ 觸發寶物效果 """
+        self.playSound("bonus")
 
         # 玩家坦克吃寶物數量
         player.trophies["bonus"] += 1
@@ -1324,7 +2049,7 @@ class Game(object):
 
         # 手雷寶物效果
         if bonus.bonus == bonus.BONUS_GRENADE:
-            for enemy in enemies:
+            for enemy in self.enemies:
                 enemy.explode()
         # 頭盔寶物效果
         elif bonus.bonus == bonus.BONUS_HELMET:
@@ -1332,7 +2057,7 @@ class Game(object):
         # 鐵寶物效果
         elif bonus.bonus == bonus.BONUS_SHOVEL:
             self.level.buildFortress(self.level.TILE_STEEL)
-            gtimer.add(10000, lambda :self.level.buildFortress(self.level.TILE_BRICK), 1)
+            self.timer.add(10000, functools.partial(self.level.buildFortress, self.level.TILE_BRICK), 1)
         # 星星寶物效果
         elif bonus.bonus == bonus.BONUS_STAR:
             player.speed = player.speed + 1
@@ -1345,52 +2070,299 @@ class Game(object):
         # 時鐘寶物效果
         elif bonus.bonus == bonus.BONUS_TIMER:
             self.toggleEnemyFreeze(True)
-            gtimer.add(10000, lambda :self.toggleEnemyFreeze(False), 1)
-        bonuses.remove(bonus)
-        
+            self.timer.add(10000, functools.partial(self.toggleEnemyFreeze, False), 1)
+        # 同一幀內寶物可能已被敵方坦克撞掉
+        if bonus in self.bonuses:
+            self.bonuses.remove(bonus)
 
-        labels.append(Label(bonus.rect.topleft, "500", 500))
+        self.labels.append(Label(self, bonus.rect.topleft, "500", 500))
 
-    def shieldPlayer(self, player, shield = True, duration = None):
+    def toggleEnemyFreeze(self, freeze = True):
+        """ 寶物效果，暫停所有敵人 """
+        for enemy in self.enemies:
+            enemy.paused = freeze
+        self.timefreeze = freeze
+
+    def gameOver(self):
+        """ 遊戲结束，3秒後停止關卡 """
+        self.game_over = True
+        self.timer.add(3000, self.stop, 1)
+
+    def finishLevel(self):
+        """ 通過這一關，3秒後停止關卡 """
+        self.active = False
+        self.timer.add(3000, self.stop, 1)
+
+    def stop(self):
+        """ 停止關卡主循環，由Game顯示計分頁面 """
+        self.running = False
+
+    def applyInput(self, player, mask):
+        """ 把輸入位掩碼應用到玩家坦克上 """
+        player.pressed = [
+            bool(mask & self.INPUT_UP),
+            bool(mask & self.INPUT_RIGHT),
+            bool(mask & self.INPUT_DOWN),
+            bool(mask & self.INPUT_LEFT),
+        ]
+        if mask & self.INPUT_FIRE and player.state == player.STATE_ALIVE:
+            if player.fire():
+                self.playSound("fire")
+
+    def advance(self, time_passed, inputs = None):
         """
-        玩家坦克剛出現時有短暂的無敵狀態
-        該方法用於添加/移除玩家的無敵狀態
+        固定步長模式：累計經過的時間，每夠TICK毫秒推進一步
+        開火只在第一步有效，返回推進的步數
         """
-        player.shielded = shield
-        if shield:
-            player.timer_uuid_shield = gtimer.add(100, lambda :player.toggleShieldImage())
+        self.accumulator += time_passed
+        steps = 0
+        # 保留每一步產生的聲音
+        sound_events = []
+        while self.accumulator >= self.TICK:
+            self.accumulator -= self.TICK
+            self.step(self.TICK, inputs)
+            sound_events += self.sound_events
+            if steps == 0 and inputs != None:
+                inputs = [mask & ~self.INPUT_FIRE for mask in inputs]
+            steps += 1
+        self.sound_events = sound_events
+        return steps
+
+    def copy(self):
+        """
+        複製整個遊戲世界，用作回放的狀態快照
+        圖像、格子坐標等不會改變的資源兩個世界共用，回放記錄不複製
+        """
+        memo = {id(self.recorder) : None}
+        for shared in atlas.shared():
+            memo[id(shared)] = shared
+        level = self.level
+        if level != None:
+            memo[id(level.tile_rects)] = level.tile_rects
+            for rect in level.tile_rects:
+                memo[id(rect)] = rect
+            memo[id(level.tile_empty)] = level.tile_empty
+        return copy.deepcopy(self, memo)
+
+    def inputMask(self, player):
+        """ 玩家坦克當前按下的方向鍵，World.INPUT_*位掩碼 """
+        mask = 0
+        for i in range(4):
+            if player.pressed[i]:
+                mask |= 1 << i
+        return mask
+
+    def checksum(self):
+        """ 遊戲狀態的校驗和，用於檢查兩個世界的狀態是否完全一致 """
+        state = (
+            self.stage, self.ticks, self.timer.time, self.game_over, self.active,
+            self.castle.state, self.level.tiles, self.level.enemies_left,
+            [(tuple(p.rect), p.direction, p.state, p.health, p.lives, p.score, p.superpowers, p.shielded, p.paralised) for p in self.players],
+            [(tuple(e.rect), e.direction, e.state, e.health, e.type, e.paused) for e in self.enemies],
+            [(tuple(b.rect), b.direction, b.state, b.power, b.owner) for b in self.bullets],
+            [(tuple(b.rect), b.bonus) for b in self.bonuses],
+            sorted((t["due"], t["id"]) for t in self.timer.timers.values()),
+            self.random.getstate(),
+        )
+        return zlib.crc32(repr(state).encode("utf-8"))
+
+    def updatePlayers(self, time_passed, inputs = None):
+        """ 按玩家的輸入開火、移動玩家坦克，inputs為None表示保持上一步的按鍵狀態 """
+        players = self.players
+
+        if inputs != None and not self.game_over and self.active:
+            for player, mask in zip(players, inputs):
+                self.applyInput(player, mask)
+
+        # 更新玩家坦克下次出现坐標
+        for player in players:
+            if player.state == player.STATE_ALIVE and not self.game_over and self.active:
+                if player.pressed[0] == True:
+                    player.move(self.DIR_UP)
+                elif player.pressed[1] == True:
+                    player.move(self.DIR_RIGHT)
+                elif player.pressed[2] == True:
+                    player.move(self.DIR_DOWN)
+                elif player.pressed[3] == True:
+                    player.move(self.DIR_LEFT)
+            player.update(time_passed)
+
+    def step(self, time_passed, inputs = None):
+        """
+        推進遊戲世界一步
+        time_passed是經過的時間，單位ms
+        inputs是每個玩家的輸入位掩碼，None表示保持上一步的按鍵狀態
+        """
+        del self.sound_events[:]
+
+        players = self.players
+
+        if self.recorder != None:
+            if inputs == None:
+                self.recorder.record([self.inputMask(player) for player in players], self)
+            else:
+                self.recorder.record(inputs, self)
+
+        self.updatePlayers(time_passed, inputs)
+
+        # 敵方坦克逐個移動，每輛每步最多移動3像素，轉向時修正坐標最多4像素
+        # 之後更新砲彈時坦克不會移動，繼續用這個索引
+        self.enemy_index = self.indexObjects(self.enemies, 26, 8)
+        for enemy in self.enemies[:]:
+            if enemy.state == enemy.STATE_DEAD and not self.game_over and self.active:
+                self.enemies.remove(enemy)
+                if self.enemy_index != None:
+                    self.enemy_index.remove(enemy)
+                if len(self.level.enemies_left) == 0 and len(self.enemies) == 0:
+                    self.finishLevel()
+            else:
+                enemy.update(time_passed)
+
+        if not self.game_over and self.active:
+            for player in players:
+                if player.state == player.STATE_ALIVE:
+                    if player.bonus != None and player.side == player.SIDE_PLAYER:
+                        # 觸發寶物效果
+                        self.triggerBonus(player.bonus, player)
+                        player.bonus = None
+                # 命用完就結束，否則產生新的玩家坦克
+                elif player.state == player.STATE_DEAD:
+                    player.superpowers = 0
+                    player.lives -= 1
+                    if player.lives > 0:
+                        self.respawnPlayer(player)
+                        self.playSound("diemuc")      #坦克死亡音效
+                    else:
+                        self.gameOver()
+
+        # 砲彈每步最多移動8像素
+        if self.bullet_manager != None:
+            self.bullet_manager.update()
         else:
-            gtimer.destroy(player.timer_uuid_shield)
+            self.bullet_index = self.indexObjects(self.bullets, 8, 8)
+            for bullet in self.bullets[:]:
+                if bullet.state == bullet.STATE_REMOVED:
+                    self.bullets.remove(bullet)
+                    if self.bullet_index != None:
+                        self.bullet_index.remove(bullet)
+                else:
+                    bullet.update()
+        self.enemy_index = None
+        self.bullet_index = None
 
-        if shield and duration != None:
-            gtimer.add(duration, lambda :self.shieldPlayer(player, False), 1)
+        for bonus in self.bonuses[:]:
+            if bonus.active == False:
+                self.bonuses.remove(bonus)
 
+        for label in self.labels[:]:
+            if not label.active:
+                self.labels.remove(label)
 
-    def spawnEnemy(self):
-        """ 產生敵方坦克 """
-        global enemies
+        # 玩家基地被擊中，遊戲結束
+        if not self.game_over:
+            if not self.castle.active:
+                self.gameOver()
 
-        if len(enemies) >= self.level.max_active_enemies:
-            return
-        if len(self.level.enemies_left) < 1 or self.timefreeze:
-            return
-        enemy = Enemy(self.level, 1)
+        self.timer.update(time_passed)
 
-        enemies.append(enemy)
+        self.ticks += 1
 
 
-    def respawnPlayer(self, player, clear_scores = False):
-        # 初始化玩家坦克属性
-        player.reset()
+class Game(object):
+    """ 遊戲窗口，負責畫面、聲音和鍵盤輸入，遊戲邏輯由World負責 """
 
-        # 清除玩家所有得分
-        if clear_scores:
-            player.trophies = {
-                "bonus" : 0, "enemy0" : 0, "enemy1" : 0, "enemy2" : 0, "enemy3" : 0
-            }
+    # 遊戲窗口中畫地圖的範圍，地圖比它大時只畫鏡頭範圍內的部分
+    VIEW_SIZE = 416
 
-        # 玩家坦克出現時的無敵效果顯示，默認4秒無敵
-        self.shieldPlayer(player, True, 4000)
+    def __init__(self, map_options = None):
+        global screen, play_sounds, sounds
+        # 啟動過程中每一步完成的時間，從創建Game開始計算，用於啟動時間報告
+        self.started = time.perf_counter()
+        self.startup = []
+        # 是否在選擇界面顯示後打印啟動時間報告
+        self.report_startup = False
+
+        # 遊戲窗口位於屏幕中央
+        os.environ['SDL_VIDEO_WINDOW_POS'] = 'center'
+
+        # 只初始化用到的pygame模塊，字體在第一次加載字體時初始化，不用的手柄等模塊不初始化
+        pygame.display.init()
+        size = width, height = 480, 416
+        # 創建遊戲窗口
+        screen = pygame.display.set_mode(size)
+        # 遊戲窗口的文字標題
+        pygame.display.set_caption("坦克大战")
+        # 用於設置幀數
+        self.clock = pygame.time.Clock()
+
+        self.startupMark("display")
+
+        if play_sounds:
+            pygame.mixer.init(44100, -16, 1, 512)
+            # 聲音文件在後台解碼，和畫選擇界面同時進行
+            sounds = audio.Sounds()
+            self.startupMark("mixer")
+
+        # 遊戲中所有圖片資源都在這裡了
+        atlas.load(True)
+        self.startupMark("sprites")
+
+        # 設置遊戲窗口的圖形標題，默認為pygame官方圖標
+        pygame.display.set_icon(atlas.image(atlas.PLAYER_TANKS[0]))
+
+        # 表示還有多少個敵人
+        self.enemy_life_image = atlas.image((81*2, 57*2, 7*2, 7*2))
+        # 表示自己還有多少條生命
+        self.player_life_image = atlas.image((89*2, 56*2, 7*2, 8*2))
+        # 表示第幾關
+        self.flag_image = atlas.image((64*2, 49*2, 16*2, 15*2))
+
+        # 用在選擇界面，選擇單人模式還是雙人模式
+        self.player_image = atlas.directions(atlas.PLAYER_TANKS[0])[atlas.DIR_RIGHT]
+
+        # 加載自定義字體，字體大小為16，沒有字體文件時使用pygame默認字體
+        #self.font = text.font("fonts/prstart.ttf", 16)
+        self.font = text.font("fonts/heiti.ttf", 16)
+
+        # 選擇界面中不會變的部分，第一次顯示時才畫
+        self.menu_image = None
+        # 最高得分，第一次用到時才從文件讀取，保存時更新
+        self.hiscore = None
+
+        # 遊戲結束畫面
+        self.im_game_over = pygame.Surface((64, 40))
+        self.im_game_over.set_colorkey((0,0,0))
+        self.im_game_over.blit(text.render(self.font, "Game", (127, 64, 64)), [0, 0])
+        self.im_game_over.blit(text.render(self.font, "OVER", (127, 64, 64)), [0, 20])
+        self.startupMark("font")
+        self.game_over_y = 416+40
+
+        # 默認為單人遊戲
+        self.nr_of_players = 1
+
+        # 創建World的地圖參數(grid_size、spawn_points、max_active_enemies)，空的為原版地圖
+        self.map_options = map_options or {}
+
+        # 當前這局遊戲的世界，在選擇界面中為None
+        self.world = None
+        # 當前這局遊戲的回放記錄
+        self.replay = None
+
+        # 每個玩家當前按下的按鍵，World.INPUT_*位掩碼
+        self.inputs = []
+
+        # 上一幀畫過的地形圖，換了地形圖就要重畫整個窗口
+        self.drawn_level = None
+        # 上一幀畫過精靈的區域，下一幀要先恢復成地形
+        self.dirty_rects = []
+        # 地圖比窗口大時先畫到和地圖一樣大的畫布上，再把鏡頭範圍複製到窗口
+        self.canvas = None
+        # 畫好的側邊欄，和畫它時的敵人數、玩家生命、關卡，這些變了才重畫
+        self.sidebar = None
+        self.sidebar_state = None
+
+        # 性能分析，按F3開始，None表示沒有開始
+        self.profiler = None
 
     def gameOver(self):
         """ 遊戲结束 """
@@ -1404,16 +2376,10 @@ class Game(object):
 
         self.game_over_y = 416+40
 
-        self.game_over = True
-        gtimer.add(3000, lambda :self.showScores(), 1)
-
     def gameOverScreen(self):
         """ 顯示遊戲结束界面 """
         global screen
 
-        # 结束遊戲主循環
-        self.running = False
-
         screen.fill([0, 0, 0])
 
         self.writeInBricks("game", [125, 140])
@@ -1434,15 +2400,16 @@ class Game(object):
 
     def showMenu(self):
         """ 選擇界面，接收用戶的選擇並進入下一關 """
-        global players, screen
+        global screen
 
-        self.running = False
-        del gtimer.timers[:]
-        # 0關就是選擇界面
-        self.stage = 0
+        # 選擇界面沒有遊戲世界
+        self.world = None
 
         # 把選擇界面畫到遊戲窗口中
         self.animateIntroScreen()
+        if self.report_startup:
+            self.report_startup = False
+            print (self.startupReport())
 
         main_loop = True
         while main_loop:
@@ -1466,47 +2433,26 @@ class Game(object):
                             self.drawIntroScreen()
                     elif event.key == pygame.K_RETURN:      # 按回車鍵，結束選擇
                         main_loop = False
-
-        del players[:]
+                    elif event.key == pygame.K_F9:          # 按F9鍵，從快速存檔繼續
+                        if self.quickLoad():
+                            self.playLevel()
+                            return
+
+        # 記錄這局遊戲的回放，隨機數種子也要記下來
+        # 回放文件不保存地圖參數，自定義地圖不記錄回放
+        seed = random.randrange(1 << 32)
+        self.world = World(self.nr_of_players, seed, **self.map_options)
+        self.replay = None
+        if len(self.map_options) == 0:
+            self.replay = Replay(seed, self.nr_of_players, 1)
+            self.world.recorder = self.replay
         self.nextLevel()
 
-    def reloadPlayers(self):
-        """ 初始化玩家坦克 """
-        global players
-
-        if len(players) == 0:
-            # 玩家一
-            x = 8 * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
-            y = 24 * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
-
-            player = Player(
-                self.level, 0, [x, y], self.DIR_UP, (0, 0, 13*2, 13*2)
-            )
-            players.append(player)
-
-            # 玩家二
-            if self.nr_of_players == 2:
-                x = 16 * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
-                y = 24 * self.TILE_SIZE + (self.TILE_SIZE * 2 - 26) / 2
-                player = Player(
-                    self.level, 0, [x, y], self.DIR_UP, (16*2, 0, 13*2, 13*2)
-                )
-                player.controls = [102, 119, 100, 115, 97]
-                players.append(player)
-
-        for player in players:
-            player.level = self.level
-            self.respawnPlayer(player, True)
-
     def showScores(self):
         """ 計分頁面 """
-        global screen, sprites, players, play_sounds, sounds
+        global screen, play_sounds, sounds
 
-        # 終止遊戲主循環
-        self.running = False
-
-        # 清除所有計時器
-        del gtimer.timers[:]
+        players = self.world.players
 
         # 停止播放所有的遊戲聲音
         if play_sounds:
@@ -1523,42 +2469,33 @@ class Game(object):
             hiscore = players[1].score
             self.saveHiscore(hiscore)
 
-        img_tanks = [
-            sprites.subsurface(32*2, 0, 13*2, 15*2),
-            sprites.subsurface(48*2, 0, 13*2, 15*2),
-            sprites.subsurface(64*2, 0, 13*2, 15*2),
-            sprites.subsurface(80*2, 0, 13*2, 15*2)
-        ]
+        img_tanks = atlas.frames(atlas.ENEMY_TANKS)
 
-        img_arrows = [
-            sprites.subsurface(81*2, 48*2, 7*2, 7*2),
-            sprites.subsurface(88*2, 48*2, 7*2, 7*2)
-        ]
+        img_arrows = atlas.frames([(81*2, 48*2, 7*2, 7*2), (88*2, 48*2, 7*2, 7*2)])
 
         # 把遊戲窗口填充為黑色，方便後面顯示
         screen.fill([0, 0, 0])
 
         # 颜色
-        black = pygame.Color("black")
         white = pygame.Color("white")
         purple = pygame.Color(127, 64, 64)
         pink = pygame.Color(191, 160, 128)
 
-        screen.blit(self.font.render(u"最高得分", False, purple), [105, 35])
-        screen.blit(self.font.render(str(hiscore), False, pink), [295, 35])
+        screen.blit(text.render(self.font, u"最高得分", purple), [105, 35])
+        screen.blit(text.render(self.font, str(hiscore), pink), [295, 35])
 
-        screen.blit(self.font.render(u"關卡"+str(self.stage).rjust(3), False, white), [170, 65])
+        screen.blit(text.render(self.font, u"關卡"+str(self.world.stage).rjust(3), white), [170, 65])
 
-        screen.blit(self.font.render(u"玩家一", False, purple), [25, 95])
+        screen.blit(text.render(self.font, u"玩家一", purple), [25, 95])
 
         #玩家1得分
-        screen.blit(self.font.render(str(players[0].score).rjust(8), False, pink), [25, 125])
+        screen.blit(text.render(self.font, str(players[0].score).rjust(8), pink), [25, 125])
 
         if self.nr_of_players == 2:
-            screen.blit(self.font.render(u"玩家二", False, purple), [320, 95])
+            screen.blit(text.render(self.font, u"玩家二", purple), [320, 95])
 
             #玩家2得分
-            screen.blit(self.font.render(str(players[1].score).rjust(8), False, pink), [325, 125])
+            screen.blit(text.render(self.font, str(players[1].score).rjust(8), pink), [325, 125])
 
         # 畫坦克圖像
         for i in range(4):
@@ -1568,7 +2505,7 @@ class Game(object):
                 screen.blit(img_arrows[1], [258, 168+(i*45)])
         
 
-        screen.blit(self.font.render("TOTAL", False, white), [70, 335])
+        screen.blit(text.render(self.font, "TOTAL", white), [70, 335])
 
         pygame.draw.line(screen, white, [170, 330], [307, 330], 4)
 
@@ -1583,30 +2520,27 @@ class Game(object):
 
             tanks = players[0].trophies["enemy"+str(i)]
 
+            count_rect = points_rect = None
             for n in range(tanks+1):
                 if n > 0 and play_sounds:
                     sounds["score"].play()
 
-                screen.blit(self.font.render(str(n-1).rjust(2), False, black), [170, 168+(i*45)])
-                screen.blit(self.font.render(str(n).rjust(2), False, white), [170, 168+(i*45)])
-                screen.blit(self.font.render(str((n-1) * (i+1) * 100).rjust(4)+" PTS", False, black), [25, 168+(i*45)])
-                screen.blit(self.font.render(str(n * (i+1) * 100).rjust(4)+" PTS", False, white), [25, 168+(i*45)])
+                count_rect = self.drawCounter(str(n).rjust(2), [170, 168+(i*45)], count_rect)
+                points_rect = self.drawCounter(str(n * (i+1) * 100).rjust(4)+" PTS", [25, 168+(i*45)], points_rect)
                 pygame.display.flip()
                 self.clock.tick(interval)
 
             if self.nr_of_players == 2:
                 tanks = players[1].trophies["enemy"+str(i)]
 
+                count_rect = points_rect = None
                 for n in range(tanks+1):
 
                     if n > 0 and play_sounds:
                         sounds["score"].play()
 
-                    screen.blit(self.font.render(str(n-1).rjust(2), False, black), [277, 168+(i*45)])
-                    screen.blit(self.font.render(str(n).rjust(2), False, white), [277, 168+(i*45)])
-
-                    screen.blit(self.font.render(str((n-1) * (i+1) * 100).rjust(4)+" PTS", False, black), [325, 168+(i*45)])
-                    screen.blit(self.font.render(str(n * (i+1) * 100).rjust(4)+" PTS", False, white), [325, 168+(i*45)])
+                    count_rect = self.drawCounter(str(n).rjust(2), [277, 168+(i*45)], count_rect)
+                    points_rect = self.drawCounter(str(n * (i+1) * 100).rjust(4)+" PTS", [325, 168+(i*45)], points_rect)
 
                     pygame.display.flip()
                     self.clock.tick(interval)
@@ -1614,10 +2548,10 @@ class Game(object):
             self.clock.tick(interval)
 
         tanks = sum([i for i in players[0].trophies.values()]) - players[0].trophies["bonus"]
-        screen.blit(self.font.render(str(tanks).rjust(2), False, white), [170, 335])
+        screen.blit(text.render(self.font, str(tanks).rjust(2), white), [170, 335])
         if self.nr_of_players == 2:
             tanks = sum([i for i in players[1].trophies.values()]) - players[1].trophies["bonus"]
-            screen.blit(self.font.render(str(tanks).rjust(2), False, white), [277, 335])
+            screen.blit(text.render(self.font, str(tanks).rjust(2), white), [277, 335])
 
         pygame.display.flip()
 
@@ -1625,67 +2559,163 @@ class Game(object):
         self.clock.tick(1)
         self.clock.tick(1)
 
-        if self.game_over:
+        if self.world.game_over:
             self.gameOverScreen()       #结束界面
         else:
             self.nextLevel()
 
 
     def draw(self):
-        global screen, castle, players, enemies, bullets, bonuses
-        # 先填充為黑色
-        screen.fill([0, 0, 0])
-        # 畫地形圖
-        self.level.draw([self.level.TILE_EMPTY, self.level.TILE_BRICK, \
-                        self.level.TILE_STEEL, self.level.TILE_FROZE, \
-                        self.level.TILE_WATER])
-        # 畫玩家基地
-        castle.draw()
-
-        for enemy in enemies:
-            enemy.draw()
-
-        for label in labels:
-            label.draw()
-
-        for player in players:
-            player.draw()
+        """
+        畫遊戲畫面
+        地形來自預先畫好的圖層，只恢復和更新上一幀和這一幀畫過的區域
+        地圖比窗口大時畫到畫布上，只畫鏡頭附近的坦克和砲彈，再把鏡頭範圍複製到窗口
+        """
+        global screen
+        world = self.world
+        level = world.level
+
+        changed = level.updateLayers()
+
+        display = screen
+        view = self.camera()
+        if view != None:
+            if self.canvas == None or self.canvas.get_size() != level.background.get_size():
+                self.canvas = pygame.Surface(level.background.get_size())
+                self.drawn_level = None
+            # 精靈都畫在全局screen上，畫精靈時換成畫布
+            screen = self.canvas
+
+        # 地圖邊上的精靈不能畫到側邊欄上，側邊欄不是每幀都重畫
+        screen.set_clip(pygame.Rect(0, 0, level.pixel_size, level.pixel_size))
+        try:
+            # 換了地形圖，重畫整個窗口
+            redraw_all = level is not self.drawn_level
+            if redraw_all:
+                self.drawn_level = level
+                self.dirty_rects = []
+                screen.blit(level.background, [0, 0])
+            else:
+                # 把上一幀畫過精靈的區域和有變化的格子恢復為地形
+                for rect in self.dirty_rects + changed:
+                    screen.blit(level.background, rect, rect)
+
+            rects = []
+            sprites_to_draw = [world.castle] + world.enemies + world.labels + \
+                              world.players + world.bullets + world.bonuses
+            # 鏡頭外的坦克和砲彈不畫，砲彈的爆炸效果比砲彈大
+            visible = None if view == None else view.inflate(64, 64)
+            for sprite in sprites_to_draw:
+                if visible != None and hasattr(sprite, "rect") and not visible.colliderect(sprite.rect):
+                    continue
+                rect = sprite.draw()
+                if rect != None:
+                    rects.append(rect)
 
-        for bullet in bullets:
-            bullet.draw()
+            dirty = self.dirty_rects + changed + rects
 
-        for bonus in bonuses:
-            bonus.draw()
+            # 草地蓋在坦克上面
+            if redraw_all:
+                screen.blit(level.grass_layer, [0, 0])
+            else:
+                for rect in dirty:
+                    screen.blit(level.grass_layer, rect, rect)
+        finally:
+            screen.set_clip(None)
+            screen = display
 
-        self.level.draw([self.level.TILE_GRASS])
+        # 鏡頭範圍整個複製到窗口，浮層直接畫在窗口上，不用恢復
+        overlays = rects
+        if view != None:
+            screen.blit(self.canvas, [0, 0], view)
+            overlays = []
+            dirty = [pygame.Rect(0, 0, self.VIEW_SIZE, self.VIEW_SIZE)]
 
         # 遊戲結束了的話，顯示"game over"，從基地位置移到屏幕中間，每幀移動4像素
-        if self.game_over:
+        if world.game_over:
             if self.game_over_y > 188:
                 self.game_over_y -= 4
-            screen.blit(self.im_game_over, [176, self.game_over_y]) # 176=(416-64)/2
-
-        # 畫側邊欄，顯示敵人生命，玩家生命
-        self.drawSidebar()
-
-        pygame.display.flip()
-
-    def drawSidebar(self):
-        """ 畫側邊欄 """
-        global screen, players, enemies
-
-        x = 416
-        y = 0
-        screen.fill([100, 100, 100], pygame.Rect([416, 0], [64, 416]))
+            rect = screen.blit(self.im_game_over, [176, self.game_over_y]) # 176=(416-64)/2
+            overlays.append(rect)
+            dirty.append(rect)
+
+        # 性能分析浮層，下一幀和精靈一樣先恢復成地形
+        if self.profiler != None:
+            rect = self.profiler.drawOverlay(screen)
+            overlays.append(rect)
+            dirty.append(rect)
+
+        # 畫側邊欄，顯示敵人生命，玩家生命，沒有變化時不用更新
+        rect = self.drawSidebar(redraw_all)
+        if rect != None:
+            dirty.append(rect)
+
+        if redraw_all:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty)
+
+        self.dirty_rects = rects
+
+    def camera(self):
+        """ 地圖比窗口大時，鏡頭在地圖上的範圍，跟著玩家一，放得下整個地圖返回None """
+        world = self.world
+        size = world.level.pixel_size
+        if size <= self.VIEW_SIZE:
+            return None
+        target = world.castle.rect
+        for player in world.players:
+            if player.state == player.STATE_ALIVE:
+                target = player.rect
+                break
+        half = self.VIEW_SIZE // 2
+        x = min(max(target.centerx - half, 0), size - self.VIEW_SIZE)
+        y = min(max(target.centery - half, 0), size - self.VIEW_SIZE)
+        return pygame.Rect(x, y, self.VIEW_SIZE, self.VIEW_SIZE)
+
+    def drawCounter(self, value, position, rect = None):
+        """ 計分頁面上遞增的數字，先把上一次畫的數字塗黑，返回畫過的區域 """
+        global screen
+        if rect != None:
+            screen.fill([0, 0, 0], rect)
+        return screen.blit(text.render(self.font, value, pygame.Color("white")), position)
 
-        xpos = x + 16
-        ypos = y + 16
+    def drawSidebar(self, force = False):
+        """
+        畫側邊欄
+        側邊欄先畫到單獨的圖像上，只有敵人數、玩家生命或關卡變了才重畫，
+        返回畫到窗口上的區域，沒有變化並且不要求重畫時返回None
+        """
+        global screen
+        world = self.world
+        players = world.players
+
+        # 側邊欄最多放得下原版一關的20個敵人
+        enemies = min(len(world.level.enemies_left) + len(world.enemies), 20)
+        state = (enemies, tuple(player.lives for player in players), world.stage, pygame.font.get_init())
+        if state != self.sidebar_state:
+            self.sidebar_state = state
+            self.sidebar = self.renderSidebar(enemies, players, world.stage)
+        elif not force:
+            return None
+
+        return screen.blit(self.sidebar, [416, 0])
+
+    def renderSidebar(self, enemies, players, stage):
+        """ 畫側邊欄圖像，顯示敵人生命，玩家生命和關卡 """
+        if self.sidebar == None:
+            self.sidebar = pygame.Surface([64, 416]).convert()
+        sidebar = self.sidebar
+        sidebar.fill([100, 100, 100])
+
+        xpos = 16
+        ypos = 16
 
         # 畫敵人生命
-        for n in range(len(self.level.enemies_left) + len(enemies)):
-            screen.blit(self.enemy_life_image, [xpos, ypos])
+        for n in range(enemies):
+            sidebar.blit(self.enemy_life_image, [xpos, ypos])
             if n % 2 == 1:
-                xpos = x + 16
+                xpos = 16
                 ypos+= 17
             else:
                 xpos += 17
@@ -1695,37 +2725,28 @@ class Game(object):
             text_color = pygame.Color('black')
             for n in range(len(players)):
                 if n == 0:
-                    screen.blit(self.font.render(str(n+1)+"P", False, text_color), [x+16, y+200])
-                    screen.blit(self.font.render(str(players[n].lives), False, text_color), [x+31, y+215])
-                    screen.blit(self.player_life_image, [x+17, y+215])
+                    sidebar.blit(text.render(self.font, str(n+1)+"P", text_color), [16, 200])
+                    sidebar.blit(text.render(self.font, str(players[n].lives), text_color), [31, 215])
+                    sidebar.blit(self.player_life_image, [17, 215])
                 else:
-                    screen.blit(self.font.render(str(n+1)+"P", False, text_color), [x+16, y+240])
-                    screen.blit(self.font.render(str(players[n].lives), False, text_color), [x+31, y+255])
-                    screen.blit(self.player_life_image, [x+17, y+255])
+                    sidebar.blit(text.render(self.font, str(n+1)+"P", text_color), [16, 240])
+                    sidebar.blit(text.render(self.font, str(players[n].lives), text_color), [31, 255])
+                    sidebar.blit(self.player_life_image, [17, 255])
 
-            screen.blit(self.flag_image, [x+17, y+280])
-            screen.blit(self.font.render(str(self.stage), False, text_color), [x+17, y+312])
+            sidebar.blit(self.flag_image, [17, 280])
+            sidebar.blit(text.render(self.font, str(stage), text_color), [17, 312])
+
+        return sidebar
 
     def drawIntroScreen(self, put_on_surface = True):
         """ 畫選擇界面 """
         global screen
-        # 遊戲窗口背景圖片
-        BACK_IMAGE = "./picture/back.jpeg"
-        back_image = pygame.image.load(BACK_IMAGE)
-        screen.blit(back_image, (0,0))
-        
-        self.writeInBricks("battle", [65, 80])
-        self.writeInBricks("city", [129, 160])
+        screen.blit(self.menuImage(), (0,0))
 
         if pygame.font.get_init():
             # 之前獲得的最高得分
             hiscore = self.loadHiscore()
-            # 選擇界面的内容
-            screen.blit(self.font.render(u"最高得分-"+str(hiscore), True, pygame.Color('white')), [170, 35])
-            screen.blit(self.font.render("1 PLAYER", True, pygame.Color('white')), [165, 250])
-            screen.blit(self.font.render("2 PLAYERS", True, pygame.Color('white')), [165, 275])
-            screen.blit(self.font.render("(c) 1980 1985 NAMCO LTD.", True, pygame.Color('white')), [140, 350])
-            screen.blit(self.font.render("ALL RIGHTS RESERVED", True, pygame.Color('white')), [140, 380])
+            screen.blit(text.render(self.font, u"最高得分-"+str(hiscore), pygame.Color('white'), True), [170, 35])
 
         # 畫self.player image圖像到選擇界面,接收按鍵事件來選擇單人或多人模式
         if self.nr_of_players == 1:
@@ -1737,6 +2758,44 @@ class Game(object):
         if put_on_surface:
             pygame.display.flip()
 
+    def menuImage(self):
+        """ 選擇界面的背景圖片、標題和文字，只在第一次顯示時加載和畫一次 """
+        if self.menu_image != None:
+            return self.menu_image
+
+        # 遊戲窗口背景圖片，轉換為遊戲窗口的像素格式，畫起來更快
+        BACK_IMAGE = "./picture/back.jpeg"
+        image = pygame.image.load(BACK_IMAGE).convert()
+
+        image.blit(atlas.brickWord("battle"), [65, 80])
+        image.blit(atlas.brickWord("city"), [129, 160])
+
+        if pygame.font.get_init():
+            # 選擇界面的内容
+            image.blit(text.render(self.font, "1 PLAYER", pygame.Color('white'), True), [165, 250])
+            image.blit(text.render(self.font, "2 PLAYERS", pygame.Color('white'), True), [165, 275])
+            image.blit(text.render(self.font, "(c) 1980 1985 NAMCO LTD.", pygame.Color('white'), True), [140, 350])
+            image.blit(text.render(self.font, "ALL RIGHTS RESERVED", pygame.Color('white'), True), [140, 380])
+
+        self.menu_image = image
+        return image
+
+    def startupMark(self, name):
+        """ 記錄啟動過程中一步完成的時間，每一步只記錄第一次 """
+        if name not in dict(self.startup):
+            self.startup.append((name, time.perf_counter() - self.started))
+
+    def startupReport(self):
+        """ 啟動時間報告，每一步完成時距離創建Game的毫秒數，以及後台解碼聲音用的時間 """
+        lines = []
+        for name, seconds in self.startup:
+            lines.append("%-12s %8.1f ms" % (name, seconds * 1000))
+        if isinstance(sounds, audio.Sounds):
+            elapsed = sounds.wait()
+            lines.append("%-12s %8.1f ms  (%d files, %d from cache, in background)" % ("sounds",
+                elapsed * 1000, len(sounds), sounds.cached))
+        return "\n".join(lines)
+
     def animateIntroScreen(self):
         """ 選擇菜單從下往上滑動效果 """
         global screen
@@ -1759,6 +2818,7 @@ class Game(object):
             # 畫選擇界面到遊戲窗口中
             screen.blit(screen_cp, [0, y])
             pygame.display.flip()
+            self.startupMark("first frame")
             # 選擇界面每次上移5像素
             y -= 5
 
@@ -1767,84 +2827,33 @@ class Game(object):
         pygame.display.flip()
 
 
-    def chunks(self, l, n):
-        """ 將字符串分割成塊，n是每塊大小 """
-        return [l[i:i+n] for i in range(0, len(l), n)]
-
     def writeInBricks(self, text, pos):
-        global screen, sprites
-
-        bricks = sprites.subsurface(56*2, 64*2, 8*2, 8*2)
-        brick1 = bricks.subsurface((0, 0, 8, 8))
-        brick2 = bricks.subsurface((8, 0, 8, 8))
-        brick3 = bricks.subsurface((8, 8, 8, 8))
-        brick4 = bricks.subsurface((0, 8, 8, 8))
-
-        alphabet = {
-            "a" : "0071b63c7ff1e3",
-            "b" : "01fb1e3fd8f1fe",
-            "c" : "00799e0c18199e",
-            "e" : "01fb060f98307e",
-            "g" : "007d860cf8d99f",
-            "i" : "01f8c183060c7e",
-            "l" : "0183060c18307e",
-            "m" : "018fbffffaf1e3",
-            "o" : "00fb1e3c78f1be",
-            "r" : "01fb1e3cff3767",
-            "t" : "01f8c183060c18",
-            "v" : "018f1e3eef8e08",
-            "y" : "019b3667860c18"
-        }
-
-        abs_x, abs_y = pos
-
-        for letter in text.lower():
-
-            binstr = ""
-            for h in self.chunks(alphabet[letter], 2):
-                binstr += str(bin(int(h, 16)))[2:].rjust(8, "0")
-            binstr = binstr[7:]
-
-            x, y = 0, 0
-            letter_w = 0
-            surf_letter = pygame.Surface((56, 56))
-            for j, row in enumerate(self.chunks(binstr, 7)):
-                for i, bit in enumerate(row):
-                    if bit == "1":
-                        if i%2 == 0 and j%2 == 0:
-                            surf_letter.blit(brick1, [x, y])
-                        elif i%2 == 1 and j%2 == 0:
-                            surf_letter.blit(brick2, [x, y])
-                        elif i%2 == 1 and j%2 == 1:
-                            surf_letter.blit(brick3, [x, y])
-                        elif i%2 == 0 and j%2 == 1:
-                            surf_letter.blit(brick4, [x, y])
-                        if x > letter_w:
-                            letter_w = x
-                    x += 8
-                x = 0
-                y += 8
-            screen.blit(surf_letter, [abs_x, abs_y])
-            abs_x += letter_w + 16
-
-    def toggleEnemyFreeze(self, freeze = True):
-        """ 寶物效果，暫停所有敵人 """
-        global enemies
-
-        for enemy in enemies:
-            enemy.paused = freeze
-        self.timefreeze = freeze
-
+        """ 用磚塊拼出的字，字母和單詞的圖像都只拼一次 """
+        global screen
+        screen.blit(atlas.brickWord(text), pos)
 
     def loadHiscore(self):
-        """ 加載遊戲得分 """
+        """ 加載遊戲得分，只在第一次調用時讀取文件 """
+        if self.hiscore == None:
+            self.hiscore = self.readHiscore()
+        return self.hiscore
+
+    def readHiscore(self):
+        """ 從文件中讀取遊戲得分 """
         filename = ".hiscore"
         # 從文件中加載最高分數，沒有則直接返回20000
         if (not os.path.isfile(filename)):
             return 20000
 
-        f = open(filename, "r")
-        hiscore = int(f.read().strip())
+        try:
+            f = open(filename, "r")
+            try:
+                hiscore = int(f.read().strip())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            print ("Can't load hiscore")
+            return 20000
 
         if hiscore > 19999 and hiscore < 1000000:
             return hiscore
@@ -1853,17 +2862,186 @@ class Game(object):
             return 20000
 
     def saveHiscore(self, hiscore):
-        """ 保存遊戲得分 """
+        """ 保存遊戲得分，同時更新內存中的得分，保存失敗則下次重新讀取文件 """
+        self.hiscore = None
         try:
             f = open(".hiscore", "w")
-            f.write(str(hiscore))
-        except:
+            try:
+                f.write(str(hiscore))
+            finally:
+                f.close()
+        except (IOError, OSError):
             print ("Can't save hiscore")
             return False
-        finally:
-            f.close()
+        self.hiscore = hiscore
+        return True
+
+    def quickSave(self):
+        """ 把當前這一關的全部狀態保存到存檔文件，先寫臨時文件再替換，不會留下寫了一半的存檔 """
+        import snapshot
+
+        if self.world == None or self.world.level == None:
+            return False
+        try:
+            data = snapshot.dumps(self.world)
+        except ValueError as e:
+            print ("Can't save game: %s" % e)
+            return False
+        temp = QUICK_SAVE + ".tmp"
+        try:
+            if not os.path.isdir(os.path.dirname(QUICK_SAVE)):
+                os.makedirs(os.path.dirname(QUICK_SAVE))
+            f = open(temp, "wb")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.replace(temp, QUICK_SAVE)
+        except (IOError, OSError):
+            print ("Can't save game")
+            return False
+        print ("Game saved to %s (%d bytes)" % (QUICK_SAVE, len(data)))
         return True
 
+    def quickLoad(self):
+        """ 讀取存檔，替換當前的遊戲世界，返回是否成功 """
+        import snapshot
+
+        try:
+            f = open(QUICK_SAVE, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            world = snapshot.loads(data)
+        except (IOError, OSError, ValueError, zlib.error, struct.error):
+            print ("Can't load saved game")
+            return False
+
+        # 存檔中沒有回放記錄，讀檔後的遊戲不能回放
+        self.replay = None
+        self.world = world
+        # 存檔可能和當前這局的玩家數不同，計分頁面按玩家數顯示
+        self.nr_of_players = world.nr_of_players
+        self.drawn_level = None
+        self.game_over_y = 416+40
+        print ("Game loaded from " + QUICK_SAVE)
+        return True
+
+    def saveReplay(self):
+        """ 把這局遊戲的回放保存到replays目錄 """
+        if self.replay == None:
+            return
+        self.replay.finish(self.world)
+        filename = os.path.join("replays", time.strftime("%Y%m%d-%H%M%S") + ".replay")
+        try:
+            if not os.path.isdir("replays"):
+                os.makedirs("replays")
+            self.replay.save(filename)
+        except (IOError, OSError):
+            print ("Can't save replay")
+        else:
+            print ("Replay saved to " + filename)
+        self.replay = None
+
+    def playReplay(self, player, seek = 0):
+        """
+        以正常速度播放回放
+        按向左、向右鍵後退、前進10秒，按ESC鍵退出
+        """
+        global play_sounds, sounds
+
+        player.seek(seek)
+        self.world = player.world
+        self.replay = None
+        self.drawn_level = None
+        self.game_over_y = 416+40
+        accumulator = 0
+
+        self.draw()
+
+        while True:
+            time_passed = self.clock.tick(50)
+
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    quit()
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        return
+                    elif event.key == pygame.K_LEFT:
+                        player.seek(player.position - 500)
+                    elif event.key == pygame.K_RIGHT:
+                        player.seek(player.position + 500)
+
+            accumulator += time_passed
+            while accumulator >= World.TICK and not player.finished():
+                accumulator -= World.TICK
+                player.step()
+                if play_sounds:
+                    for name in player.world.sound_events:
+                        sounds[name].play()
+
+            self.world = player.world
+            self.draw()
+
+    def playNetwork(self, session):
+        """
+        連線遊戲，session為netplay.Session
+        兩個鍵盤布局都控制本地玩家，過關後直接進入下一關，按ESC鍵退出
+        """
+        global play_sounds, sounds
+
+        self.replay = None
+        self.inputs = [0, 0]
+
+        # 等待對方連上
+        while not session.handshake():
+            self.clock.tick(50)
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    quit()
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    return
+
+        self.world = session.world
+        self.drawn_level = None
+        self.game_over_y = 416+40
+        if play_sounds:
+            sounds["back"].play()
+
+        while not session.finished():
+            self.clock.tick(50)
+            previous = self.world
+            self.handleEvents(previous)
+            if pygame.key.get_pressed()[pygame.K_ESCAPE]:
+                return
+
+            mask = 0
+            for m in self.inputs:
+                mask |= m
+            if session.update(mask) > 0:
+                for i in range(len(self.inputs)):
+                    self.inputs[i] &= ~World.INPUT_FIRE
+
+            world = session.world
+            # 回滾後地形圖是複製的，接手已經畫好的圖層
+            if world.level is not previous.level and world.stage == previous.stage:
+                world.level.adoptLayers(previous.level)
+                if self.drawn_level is previous.level:
+                    self.drawn_level = world.level
+
+            if play_sounds:
+                for name in world.sound_events:
+                    sounds[name].play()
+            if world.game_over and not previous.game_over:
+                self.gameOver()
+
+            self.world = world
+            self.draw()
+
+        if session.disconnected:
+            print ("Disconnected")
 
     def finishLevel(self):
         """ 通過這一關，進入下一關 """
@@ -1873,217 +3051,171 @@ class Game(object):
         if play_sounds:
             sounds["bg"].stop()
 
-        self.active = False
-        gtimer.add(3000, lambda :self.showScores(), 1)
+        print ("Stage "+str(self.world.stage)+" completed")
+
+    def handleEvents(self, world):
+        """ 處理窗口事件，按鍵轉換為每個玩家的輸入位掩碼 """
+        global play_sounds, sounds
 
-        print ("Stage "+str(self.stage)+" completed")
+        for event in pygame.event.get():
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                pass
+            elif event.type == pygame.QUIT:
+                self.saveReplay()
+                quit()
+            # F3顯示或隱藏性能分析浮層，F4保存性能分析記錄
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                self.toggleProfiler()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                if self.profiler != None:
+                    print ("Profile saved to " + self.profiler.dump())
+            # F5快速存檔，F9快速讀檔
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+                self.quickSave()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
+                self.quickLoad()
+            # 按下鍵盤的一個鍵觸發
+            elif event.type == pygame.KEYDOWN and not world.game_over and world.active:
+                # 切換播放聲音
+                if event.key == pygame.K_m:
+                    play_sounds = not play_sounds
+                    if not play_sounds:
+                        pygame.mixer.stop()
+                    else:
+                        sounds["bg"].play(-1)
+
+                for i, player in enumerate(world.players):
+                    if player.state == player.STATE_ALIVE:
+                        try:
+                            index = player.controls.index(event.key)
+                        except:
+                            pass
+                        else:
+                            # 按下空格鍵，表示開火
+                            if index == 0:
+                                self.inputs[i] |= World.INPUT_FIRE
+                            # 按下向上、向右、向下、向左鍵，向對應方向移動
+                            else:
+                                self.inputs[i] |= 1 << (index - 1)
+            # 鬆開按下的鍵盤鍵觸發
+            elif event.type == pygame.KEYUP:
+                for i, player in enumerate(world.players):
+                    try:
+                        index = player.controls.index(event.key)
+                    except:
+                        pass
+                    else:
+                        # 鬆開方向鍵，停止向該方向移動
+                        if index > 0:
+                            self.inputs[i] &= ~(1 << (index - 1))
+
+    def toggleProfiler(self):
+        """ 開始或停止性能分析，開始時顯示浮層 """
+        if self.profiler == None:
+            self.profiler = Profiler(PROFILE_SPANS)
+        if self.profiler.enabled():
+            self.profiler.disable()
+            self.profiler = None
+        else:
+            self.profiler.enable()
 
     def nextLevel(self):
         """ 進入下一關 """
-        global castle, players, bullets, bonuses, play_sounds, sounds
-
-        del bullets[:]
-        del enemies[:]
-        del bonuses[:]
-        # 畫玩家基地
-        castle.rebuild()
-        del gtimer.timers[:]
+        self.world.nextLevel()
+        self.playLevel()
 
-        # 加載地形圖和標識可以被子彈消滅的障礙物
-        self.stage += 1
-        self.level = Level(self.stage)
-        self.timefreeze = False
-
-        # 每一關四種不同類型的坦克的數量
-        levels_enemies = (
-            (18,2,0,0), (14,4,0,2), (14,4,0,2), (2,5,10,3), (8,5,5,2),
-            (9,2,7,2), (7,4,6,3), (7,4,7,2), (6,4,7,3), (12,2,4,2),
-            (5,5,4,6), (0,6,8,6), (0,8,8,4), (0,4,10,6), (0,2,10,8),
-            (16,2,0,2), (8,2,8,2), (2,8,6,4), (4,4,4,8), (2,8,2,8),
-            (6,2,8,4), (6,8,2,4), (0,10,4,6), (10,4,4,2), (0,8,2,10),
-            (4,6,4,6), (2,8,2,8), (15,2,2,1), (0,4,10,6), (4,8,4,4),
-            (3,8,3,6), (6,4,2,8), (4,4,4,8), (0,10,4,6), (0,6,4,10),
-        )
-        # 大於35關的關卡，一律使用第35關的敵方坦克類型
-        if self.stage <= 35:
-            enemies_l = levels_enemies[self.stage - 1]
-        else:
-            enemies_l = levels_enemies[34]
+    def playLevel(self):
+        """ 玩當前這一關，把鍵盤輸入交給World並畫出遊戲畫面，快速讀檔後從讀出的狀態繼續 """
+        global play_sounds, sounds
 
-        # 打亂四種類型的敵方坦克出戰順序
-        self.level.enemies_left = [0]*enemies_l[0] + [1]*enemies_l[1] + [2]*enemies_l[2] + [3]*enemies_l[3]
-        random.shuffle(self.level.enemies_left)
+        world = self.world
+        self.inputs = [0] * len(world.players)
 
         # 開始放遊戲聲音
         if play_sounds:
             # sounds["start"].play()
-            # gtimer.add(4330, lambda :sounds["bg"].play(-1), 2)
+            # world.timer.add(4330, lambda :sounds["bg"].play(-1), 2)
             sounds["back"].play()
 
-        # 初始化玩家坦克
-        self.reloadPlayers()
+        self.draw()
 
-        # 玩家坦克出現3秒後，出現敵方坦克
-        gtimer.add(3000, lambda :self.spawnEnemy())
+        while world.running:
+            time_passed = self.clock.tick(50)
 
-        # 遊戲結束開關
-        self.game_over = False
+            profiler = self.profiler
+            if profiler != None:
+                profiler.beginFrame()
 
-        # 遊戲主循環開關
-        self.running = True
+            self.handleEvents(world)
 
-        self.active = True
+            # 快速讀檔換了遊戲世界
+            if self.world is not world:
+                world = self.world
+                self.inputs = [0] * len(world.players)
 
-        self.draw()
+            game_over = world.game_over
+            active = world.active
 
-        while self.running:
-            time_passed = self.clock.tick(50)
+            # 以固定步長推進遊戲世界，遊戲速度不受幀率影響
+            steps = world.advance(time_passed, self.inputs)
 
-            for event in pygame.event.get():
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    pass
-                elif event.type == pygame.QUIT:
-                    quit()
-                # 按下鍵盤的一個鍵觸發
-                elif event.type == pygame.KEYDOWN and not self.game_over and self.active:
-                    # 切換播放聲音
-                    if event.key == pygame.K_m:
-                        play_sounds = not play_sounds
-                        if not play_sounds:
-                            pygame.mixer.stop()
-                        else:
-                            sounds["bg"].play(-1)
-
-                    for player in players:
-                        if player.state == player.STATE_ALIVE:
-                            try:
-                                index = player.controls.index(event.key)
-                            except:
-                                pass
-                            else:
-                                # 按下空格鍵，表示開火
-                                if index == 0:
-                                    if player.fire() and play_sounds:
-                                        sounds["fire"].play()
-                                # 按下向上鍵，向上移動
-                                elif index == 1:
-                                    player.pressed[0] = True
-                                # 按下向右鍵，向右移動
-                                elif index == 2:
-                                    player.pressed[1] = True
-                                # 按下向下鍵，向下移動
-                                elif index == 3:
-                                    player.pressed[2] = True
-                                # 按下向左鍵，向左移動
-                                elif index == 4:
-                                    player.pressed[3] = True
-                # 鬆開按下的鍵盤鍵觸發
-                elif event.type == pygame.KEYUP and not self.game_over and self.active:
-                    for player in players:
-                        if player.state == player.STATE_ALIVE:
-                            try:
-                                index = player.controls.index(event.key)
-                            except:
-                                pass
-                            else:
-                                # 鬆開向上鍵，停止向上移动
-                                if index == 1:
-                                    player.pressed[0] = False
-                                # 鬆開向右鍵，停止向右移动
-                                elif index == 2:
-                                    player.pressed[1] = False
-                                # 鬆開向下鍵，停止向下移动
-                                elif index == 3:
-                                    player.pressed[2] = False
-                                # 鬆開向左鍵，停止向左移动
-                                elif index == 4:
-                                    player.pressed[3] = False
-
-            # 更新玩家坦克下次出现坐標
-            for player in players:
-                if player.state == player.STATE_ALIVE and not self.game_over and self.active:
-                    if player.pressed[0] == True:
-                        player.move(self.DIR_UP);
-                    elif player.pressed[1] == True:
-                        player.move(self.DIR_RIGHT);
-                    elif player.pressed[2] == True:
-                        player.move(self.DIR_DOWN);
-                    elif player.pressed[3] == True:
-                        player.move(self.DIR_LEFT);
-                player.update(time_passed)
-
-            for enemy in enemies:
-                if enemy.state == enemy.STATE_DEAD and not self.game_over and self.active:
-                    enemies.remove(enemy)
-                    if len(self.level.enemies_left) == 0 and len(enemies) == 0:
-                        self.finishLevel()
-                else:
-                    enemy.update(time_passed)
+            # 開火只在按下後的第一步有效
+            if steps > 0:
+                for i in range(len(self.inputs)):
+                    self.inputs[i] &= ~World.INPUT_FIRE
 
-            if not self.game_over and self.active:
-                for player in players:
-                    if player.state == player.STATE_ALIVE:
-                        if player.bonus != None and player.side == player.SIDE_PLAYER:
-                            # 觸發寶物效果
-                            self.triggerBonus(bonus, player)
-                            player.bonus = None
-                    # 命用完就結束，否則產生新的玩家坦克
-                    elif player.state == player.STATE_DEAD:
-                        self.superpowers = 0
-                        player.lives -= 1
-                        if player.lives > 0:
-                            self.respawnPlayer(player)
-                            sounds["diemuc"].play()      #坦克死亡音效
-                        else:
-                            self.gameOver()
+            if play_sounds:
+                for name in world.sound_events:
+                    sounds[name].play()
 
-            for bullet in bullets:
-                if bullet.state == bullet.STATE_REMOVED:
-                    bullets.remove(bullet)
-                else:
-                    bullet.update()
+            if world.game_over and not game_over:
+                self.gameOver()
+            elif active and not world.active and not world.game_over:
+                self.finishLevel()
 
-            for bonus in bonuses:
-                if bonus.active == False:
-                    bonuses.remove(bonus)
+            self.draw()
 
-            for label in labels:
-                if not label.active:
-                    labels.remove(label)
+            if profiler != None:
+                profiler.endFrame(world)
 
-            # 玩家基地被擊中，遊戲結束
-            if not self.game_over:
-                if not castle.active:
-                    self.gameOver()
+        if world.game_over:
+            self.saveReplay()
 
-            gtimer.update(time_passed)
+        self.showScores()
 
-            self.draw()
+
+# 性能分析的計時範圍：(名稱, 類, 方法名)
+PROFILE_SPANS = (
+    ("events", Game, "handleEvents"),
+    ("players", World, "updatePlayers"),
+    ("enemies", Enemy, "update"),
+    ("bullets", BulletManager, "update"),
+    ("bullets", Bullet, "update"),
+    ("timers", Timer, "update"),
+    ("draw", Game, "draw"),
+)
 
 
 if __name__ == "__main__":
-    # 計時器
-    gtimer = Timer()
-    # 圖像資源
-    sprites = None
-    # 遊戲窗口
-    screen = None
-    # 玩家坦克
-    players = []
-    # 敵方坦克
-    enemies = []
-    # 砲彈
-    bullets = []
-    # 寶物
-    bonuses = []
-
-    labels = []
-    # 是否播放聲音
-    play_sounds = True
-    # 所有聲音
-    sounds = {}
-
-    game = Game()
-    castle = Castle()
+    # 直接運行時本模塊是__main__，其他模塊import BattleCity時要用同一個模塊，否則會有兩套類
+    sys.modules["BattleCity"] = sys.modules["__main__"]
+
+    # 默認為原版地圖，可以指定更大的地圖、更多的敵方坦克出現位置和同時出現的敵人數
+    parser = argparse.ArgumentParser(description = "Battle City")
+    parser.add_argument("--grid-size", type = int, default = Level.GRID_SIZE, help = "map size in tiles")
+    parser.add_argument("--spawn-points", type = int, default = 3, help = "enemy spawn points along the top row")
+    parser.add_argument("--max-enemies", type = int, default = 4, help = "enemies on the map at the same time")
+    parser.add_argument("--startup-report", action = "store_true", help = "print how long startup took")
+    options = parser.parse_args()
+    map_options = {}
+    if (options.grid_size, options.spawn_points, options.max_enemies) != (Level.GRID_SIZE, 3, 4):
+        map_options = {
+            "grid_size" : options.grid_size,
+            "spawn_points" : World.spreadSpawnPoints(options.grid_size, options.spawn_points),
+            "max_active_enemies" : options.max_enemies,
+        }
+
+    game = Game(map_options)
+    game.report_startup = options.startup_report
     # 開始遊戲，畫選擇界面
     game.showMenu()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+解碼後資源的磁盤緩存
+聲音文件解碼後的PCM數據和放大後的sprites.gif保存在cache目錄，下次啟動直接讀取，不用重新解碼
+緩存文件名由資源類型、源文件內容的SHA-1和解碼參數決定，源文件或參數變了自動使用新的緩存文件，
+緩存文件的格式變了就增加VERSION
+"""
+import hashlib
+import os
+import struct
+
+
+# 緩存目錄，不受當前目錄影響
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# 文件頭：標識"TWAC"、版本、數據長度
+MAGIC = b"TWAC"
+VERSION = 1
+HEADER = struct.Struct("<4sB3xI")
+
+
+def fileHash(filename):
+    """ 源文件內容的SHA-1 """
+    f = open(filename, "rb")
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+
+def cachePath(kind, source, params = ()):
+    """ 緩存文件路徑，源文件內容或解碼參數不同則路徑不同，源文件讀不了返回None """
+    try:
+        digest = fileHash(source)
+    except (IOError, OSError):
+        return None
+    key = hashlib.sha1(repr((VERSION, digest, tuple(params))).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, "%s-%s.bin" % (kind, key[:24]))
+
+
+def load(path):
+    """ 讀取緩存的數據，沒有緩存或緩存損壞返回None """
+    if path == None:
+        return None
+    try:
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+    magic, version, length = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or length != len(data) - HEADER.size:
+        return None
+    return data[HEADER.size:]
+
+
+def store(path, data):
+    """ 保存數據到緩存，先寫臨時文件再替換，保存失敗返回False，下次重新解碼 """
+    if path == None:
+        return False
+    # 多個線程、多個進程可能同時寫同一個緩存文件，臨時文件不能相同
+    temp = "%s.%d.%d.tmp" % (path, os.getpid(), id(data))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok = True)
+        f = open(temp, "wb")
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, len(data)))
+            f.write(data)
+        finally:
+            f.close()
+        os.replace(temp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        return False
+    return True
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲圖片資源
+sprites.gif只加載一次，切割出來的圖像和四個方向的旋轉圖像都只創建一次，
+所有坦克、砲彈、爆炸等物體共用同一份圖像
+"""
+import pygame
+
+import assetcache
+
+
+# 方向，與Tank.DIR_*、Bullet.DIR_*一致
+(DIR_UP, DIR_RIGHT, DIR_DOWN, DIR_LEFT) = range(4)
+
+# 圖片原本朝上，轉到各個方向需要旋轉的角度
+ROTATIONS = (0, 270, 180, 90)
+
+# sprites.gif和放大兩倍後的尺寸
+SHEET_FILE = "images/sprites.gif"
+SHEET_SIZE = (192, 224)
+
+# 以下是各種圖像在放大兩倍後的sprites.gif中的位置和尺寸
+# 玩家一、玩家二坦克
+PLAYER_TANKS = ((0, 0, 13*2, 13*2), (16*2, 0, 13*2, 13*2))
+# 四種敵方坦克
+ENEMY_TANKS = (
+    (32*2, 0, 13*2, 15*2),
+    (48*2, 0, 13*2, 15*2),
+    (64*2, 0, 13*2, 15*2),
+    (80*2, 0, 13*2, 15*2),
+)
+# 攜帶寶物的敵方坦克閃爍時的圖像
+ENEMY_TANKS_FLASH = (
+    (32*2, 16*2, 13*2, 15*2),
+    (48*2, 16*2, 13*2, 15*2),
+    (64*2, 16*2, 13*2, 15*2),
+    (80*2, 16*2, 13*2, 15*2),
+)
+# 砲彈
+BULLET = (75*2, 74*2, 3*2, 4*2)
+# 坦克無敵時的效果
+SHIELD = ((0, 48*2, 16*2, 16*2), (16*2, 48*2, 16*2, 16*2))
+# 出現新坦克時的效果
+SPAWN = ((32*2, 48*2, 16*2, 16*2), (48*2, 48*2, 16*2, 16*2))
+# 三種爆炸效果，砲彈爆炸只用前兩種
+EXPLOSION = ((0, 80*2, 32*2, 32*2), (32*2, 80*2, 32*2, 32*2), (64*2, 80*2, 32*2, 32*2))
+# 玩家基地，未被消滅和被消滅後
+CASTLE = ((0, 15*2, 16*2, 16*2), (16*2, 15*2, 16*2, 16*2))
+# 拼字用的四分之一磚塊，key為格子在2x2磚塊中的位置(列, 行)
+BRICK_QUARTERS = {
+    (0, 0) : (56*2, 64*2, 8, 8),
+    (1, 0) : (56*2+8, 64*2, 8, 8),
+    (1, 1) : (56*2+8, 64*2+8, 8, 8),
+    (0, 1) : (56*2, 64*2+8, 8, 8),
+}
+
+# 磚塊字母，每個字母7x7格，十六進制數的低49位從左上角開始每7位一行
+BRICK_LETTERS = {
+    "a" : "0071b63c7ff1e3",
+    "b" : "01fb1e3fd8f1fe",
+    "c" : "00799e0c18199e",
+    "e" : "01fb060f98307e",
+    "g" : "007d860cf8d99f",
+    "i" : "01f8c183060c7e",
+    "l" : "0183060c18307e",
+    "m" : "018fbffffaf1e3",
+    "o" : "00fb1e3c78f1be",
+    "r" : "01fb1e3cff3767",
+    "t" : "01f8c183060c18",
+    "v" : "018f1e3eef8e08",
+    "y" : "019b3667860c18"
+}
+
+# 放大兩倍後的sprites.gif
+sheet = None
+# 是否已轉換為遊戲窗口的像素格式
+converted = False
+
+# 切割出來的圖像，key為位置和尺寸
+images = {}
+# 四個方向的圖像，key為向上時的位置和尺寸
+rotations = {}
+# 拼好的磚塊字母(圖像, 寬度)和單詞圖像
+letters = {}
+words = {}
+
+
+def load(convert = False):
+    """
+    加載sprites.gif並預先創建所有坦克、砲彈、無敵效果、出現效果和爆炸效果的圖像
+    convert為True時轉換為遊戲窗口的像素格式，必須在創建遊戲窗口之後調用
+    """
+    global sheet, converted
+
+    if sheet != None and (converted or not convert):
+        return sheet
+
+    sheet = loadSheet()
+    if convert:
+        sheet = sheet.convert_alpha()
+    converted = convert
+
+    # 重新切割，舊的圖像屬於沒有轉換的sprites.gif
+    images.clear()
+    rotations.clear()
+    letters.clear()
+    words.clear()
+
+    for rect in PLAYER_TANKS + ENEMY_TANKS + ENEMY_TANKS_FLASH + (BULLET, ):
+        directions(rect)
+    for rect in SHIELD + SPAWN + EXPLOSION + CASTLE:
+        image(rect)
+
+    return sheet
+
+
+def loadSheet():
+    """ 放大兩倍後的sprites.gif，放大後的像素保存在磁盤緩存中，下次直接讀取 """
+    path = assetcache.cachePath("sheet", SHEET_FILE, SHEET_SIZE)
+    data = assetcache.load(path)
+    if data == None or len(data) != SHEET_SIZE[0] * SHEET_SIZE[1] * 4:
+        scaled = pygame.transform.scale(pygame.image.load(SHEET_FILE), SHEET_SIZE)
+        data = pygame.image.tostring(scaled, "RGBA")
+        assetcache.store(path, data)
+    # 有沒有緩存都從RGBA像素創建，每次啟動的像素格式都一樣
+    return pygame.image.fromstring(data, SHEET_SIZE, "RGBA")
+
+
+def image(rect):
+    """ 切割sprites.gif中的一塊圖像，同一塊只切割一次 """
+    rect = tuple(rect)
+    surface = images.get(rect)
+    if surface == None:
+        surface = sheet.subsurface(rect)
+        images[rect] = surface
+    return surface
+
+
+def directions(rect):
+    """ 返回圖像向上、向右、向下、向左四個方向的圖像，每個圖像只旋轉一次 """
+    rect = tuple(rect)
+    result = rotations.get(rect)
+    if result == None:
+        up = image(rect)
+        result = tuple([pygame.transform.rotate(up, angle) if angle else up for angle in ROTATIONS])
+        rotations[rect] = result
+    return result
+
+
+def frames(rects):
+    """ 返回一組動畫圖像 """
+    return [image(rect) for rect in rects]
+
+
+def brickLetter(letter):
+    """ 用磚塊拼出的字母圖像和字母寬度，每個字母只拼一次 """
+    result = letters.get(letter)
+    if result == None:
+        bits = int(BRICK_LETTERS[letter], 16)
+        surface = pygame.Surface((56, 56))
+        width = 0
+        for y in range(7):
+            for x in range(7):
+                if bits >> (48 - y*7 - x) & 1:
+                    surface.blit(image(BRICK_QUARTERS[x % 2, y % 2]), [x*8, y*8])
+                    width = max(width, x*8)
+        result = (surface, width)
+        letters[letter] = result
+    return result
+
+
+def brickWord(word):
+    """ 用磚塊拼出的單詞圖像，字母之間空16像素，每個單詞只拼一次 """
+    word = word.lower()
+    surface = words.get(word)
+    if surface == None:
+        glyphs = [brickLetter(letter) for letter in word]
+        positions = []
+        x = 0
+        for glyph, width in glyphs:
+            positions.append(x)
+            x += width + 16
+        surface = pygame.Surface((positions[-1] + 56 if glyphs else 0, 56))
+        for (glyph, width), x in zip(glyphs, positions):
+            surface.blit(glyph, [x, 0])
+        words[word] = surface
+    return surface
+
+
+def shared():
+    """ 所有已創建的圖像，這些圖像不會被修改，可以在多個遊戲世界之間共用 """
+    result = list(images.values())
+    for surfaces in rotations.values():
+        result.extend(surfaces)
+    if sheet != None:
+        result.append(sheet)
+    return result
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲聲音
+聲音文件在後台線程池中解碼，不用等聲音解碼完就能顯示選擇界面，
+解碼後的PCM數據保存在磁盤緩存中，下次啟動直接讀取，缺少或損壞的聲音文件用無聲的聲音代替
+"""
+import concurrent.futures
+import threading
+import time
+
+import pygame
+
+import assetcache
+
+
+# 聲音名稱和聲音文件
+FILES = {
+    "start" : "sounds/gamestart.ogg",
+    "endnew" : "sounds/gameovernew.ogg",
+    "score" : "sounds/score.ogg",
+    "bg" : "sounds/background.ogg",
+    "fire" : "sounds/fire.ogg",
+    "bonus" : "sounds/bonus.ogg",
+    "explosion" : "sounds/explosion.ogg",
+    "brick" : "sounds/brick.ogg",
+    "steel" : "sounds/steel.ogg",
+    "back" : "sounds/back.ogg",
+    "diemuc" : "sounds/diemuc.ogg",
+}
+
+# 解碼聲音的後台線程數，聲音文件只有十來個，幾個線程就能在選擇界面滑入期間全部加載完
+WORKERS = 4
+
+
+class Sounds(object):
+    """
+    後台加載的全部聲音，用法和dict一樣：sounds["fire"].play()
+    取的聲音還沒有解碼完時等它解碼完，必須在pygame.mixer.init()之後創建
+    """
+
+    def __init__(self, files = FILES, workers = WORKERS):
+        self.started = time.perf_counter()
+        # 全部聲音解碼完用了多少秒，還沒有解碼完為None
+        self.elapsed = None
+        # 已經加載的聲音數和其中從磁盤緩存讀取的聲音數
+        self.total = len(files)
+        self.loaded = 0
+        self.cached = 0
+        self.lock = threading.Lock()
+
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.futures = {}
+        for name in files:
+            self.futures[name] = executor.submit(self.load, files[name])
+        # 線程在全部聲音解碼完後自動退出
+        executor.shutdown(wait = False)
+
+    def load(self, filename):
+        """ 在後台線程中加載一個聲音 """
+        path = assetcache.cachePath("sound", filename, pygame.mixer.get_init())
+        data = assetcache.load(path)
+        if data != None:
+            sound = pygame.mixer.Sound(buffer = data)
+            cached = 1
+        else:
+            try:
+                sound = pygame.mixer.Sound(filename)
+            except (pygame.error, IOError, OSError):
+                print ("Can't load sound " + filename)
+                sound = pygame.mixer.Sound(buffer = bytes(4))
+            else:
+                assetcache.store(path, sound.get_raw())
+            cached = 0
+
+        with self.lock:
+            self.loaded += 1
+            self.cached += cached
+            if self.loaded == self.total:
+                self.elapsed = time.perf_counter() - self.started
+        return sound
+
+    def __getitem__(self, name):
+        return self.futures[name].result()
+
+    def __iter__(self):
+        return iter(self.futures)
+
+    def __len__(self):
+        return len(self.futures)
+
+    def wait(self):
+        """ 等全部聲音解碼完，返回用了多少秒 """
+        for future in self.futures.values():
+            future.result()
+        return self.elapsed
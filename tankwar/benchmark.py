@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲邏輯和畫面的性能測試，不需要顯示器
+每個場景用固定的隨機數種子和固定的玩家輸入推進固定的步數，
+記錄每秒步數、每步耗時的p50/p99、玩家/敵人/砲彈/計時器/畫面各部分的耗時和內存分配，結果寫成JSON方便比較不同版本
+
+用法：
+    python benchmark.py [--ticks 3000] [--seed 1] [--scenario 場景 ...] [--no-draw] [--vector-bullets]
+                        [--tracemalloc] [--output benchmark.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# 沒有顯示器也能創建遊戲窗口
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import BattleCity
+import text
+from BattleCity import World, Game, Bonus, PROFILE_SPANS
+from profiler import Profiler
+
+
+def playerInputs(tick, fire_every = 15):
+    """ 玩家輸入：每40步換一個方向，每fire_every步開火一次，兩個玩家方向錯開 """
+    directions = (World.INPUT_UP, World.INPUT_LEFT, World.INPUT_DOWN, World.INPUT_RIGHT)
+    inputs = []
+    for i in range(2):
+        mask = directions[(tick // 40 + i) % 4]
+        if tick % fire_every == 0:
+            mask |= World.INPUT_FIRE
+        inputs.append(mask)
+    return inputs
+
+
+def newWorld(options, stage):
+    world = World(2, options.seed, options.vector_bullets)
+    world.stage = stage - 1
+    world.nextLevel()
+    return world
+
+
+def setupLevels(options, segment):
+    """ 35關輪流玩，開始時就出現一輛敵方坦克，不用等3秒 """
+    world = newWorld(options, segment % 35 + 1)
+    world.spawnEnemy()
+    return world
+
+
+def setupMaxEnemies(options, segment):
+    """ 敵方坦克數量不設上限，每0.3秒出現一輛 """
+    world = newWorld(options, 1)
+    world.level.max_active_enemies = 100
+    world.level.enemies_left = [i % 4 for i in range(1000)]
+    world.timer.add(300, world.spawnEnemy)
+    return world
+
+
+def setupLargeMap(options, segment):
+    """ 128x128格的大地圖，上半部分48個出現位置，最多300輛敵方坦克，每0.3秒出現一批 """
+    points = [(x, y) for y in range(0, 96, 16) for x in range(0, 126, 16)]
+    world = World(2, options.seed, options.vector_bullets, 128, points, 300)
+    world.nextLevel()
+    world.timer.add(300, world.spawnEnemy)
+    return world
+
+
+def setupSustainedFire(options, segment):
+    """ 玩家每一步都開火，每輛坦克最多30顆砲彈 """
+    world = newWorld(options, 4)
+    for player in world.players:
+        player.max_active_bullets = 30
+    return world
+
+
+def setupBrickHeavy(options, segment):
+    """ 除了坦克出現的地方，地圖填滿磚牆 """
+    world = newWorld(options, 1)
+    level = world.level
+    for y in range(2, 23):
+        for x in range(level.grid_size):
+            if level.tiles[y * level.grid_size + x] == level.TILE_EMPTY:
+                level.setTile(x, y, level.TILE_BRICK)
+    for player in world.players:
+        player.max_active_bullets = 30
+    return world
+
+
+def bonusStorm(world, tick):
+    """ 每20步玩家一吃到一個寶物 """
+    if tick % 20 == 0 and len(world.players) > 0:
+        player = world.players[0]
+        if player.state == player.STATE_ALIVE:
+            bonus = Bonus(world.level)
+            bonus.rect.topleft = player.rect.topleft
+            world.bonuses.append(bonus)
+            player.bonus = bonus
+
+
+# 場景名稱：(創建遊戲世界, 開火間隔, 每一步之前額外的操作, 幾個關卡平分步數, 每個關卡至少幾步)
+# 35關輪流玩時每關至少400步(8秒)，敵方坦克每3秒出現一輛，每關都有幾秒的敵人移動和碰撞
+SCENARIOS = {
+    "levels" : (setupLevels, 15, None, 35, 400),
+    "max_enemies" : (setupMaxEnemies, 15, None, 1, 0),
+    "large_map" : (setupLargeMap, 15, None, 1, 0),
+    "sustained_fire" : (setupSustainedFire, 1, None, 1, 0),
+    "brick_heavy" : (setupBrickHeavy, 1, None, 1, 0),
+    "bonus_storm" : (lambda options, segment: newWorld(options, 1), 15, bonusStorm, 1, 0),
+}
+
+
+def runScenario(name, options, game):
+    """ 推進一個場景，返回每一步的耗時 """
+    setup, fire_every, before_step, segments, min_ticks = SCENARIOS[name]
+    latencies = []
+
+    for segment in range(segments):
+        world = setup(options, segment)
+        ticks = options.ticks // segments + (1 if segment < options.ticks % segments else 0)
+        ticks = max(ticks, min_ticks)
+        for tick in range(ticks):
+            inputs = playerInputs(tick, fire_every)
+            start = time.perf_counter()
+            if before_step != None:
+                before_step(world, tick)
+            world.step(World.TICK, inputs)
+            if game != None:
+                game.world = world
+                game.draw()
+            latencies.append(time.perf_counter() - start)
+
+            # 關卡結束，遊戲結束則重新開始這一段
+            if not world.running:
+                if world.game_over:
+                    world = setup(options, segment)
+                else:
+                    world.nextLevel()
+
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def benchmark(name, options, game):
+    """ 測試一個場景，返回結果 """
+    # 第一次：只計時
+    text.clear()
+    gc.collect()
+    collections = sum(stat["collections"] for stat in gc.get_stats())
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    latencies = runScenario(name, options, game)
+    elapsed = time.perf_counter() - start
+    blocks = sys.getallocatedblocks() - blocks
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+
+    # 第二次：用遊戲中的性能分析記錄各部分耗時，計時本身有額外開銷，所以和第一次分開
+    profiler = Profiler(PROFILE_SPANS)
+    profiler.enable()
+    try:
+        profiled = sum(runScenario(name, options, game))
+    finally:
+        profiler.disable()
+    totals = profiler.totals
+
+    result = {
+        "ticks" : len(latencies),
+        "seconds" : round(elapsed, 4),
+        "ticks_per_second" : round(len(latencies) / elapsed, 1),
+        "p50_ms" : round(percentile(latencies, 50) * 1000, 4),
+        "p99_ms" : round(percentile(latencies, 99) * 1000, 4),
+        "max_ms" : round(max(latencies) * 1000, 4),
+        "subsystems_ms" : dict((key, round(value * 1000, 2)) for key, value in totals.items()),
+        "other_ms" : round((profiled - sum(totals.values())) * 1000, 2),
+        "allocated_blocks_delta" : blocks,
+        "gc_collections" : collections,
+    }
+    if game != None:
+        # 文字緩存的命中情況，包括後兩次運行，穩定後每幀都應該命中
+        result["text_cache"] = text.stats()
+
+    # 第三次：tracemalloc統計內存分配，很慢，需要時才做
+    if options.tracemalloc:
+        tracemalloc.start()
+        runScenario(name, options, game)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["tracemalloc_peak_kb"] = round(peak / 1024.0, 1)
+
+    return result
+
+
+def gitCommit():
+    """ 當前的git提交，不是git倉庫返回None """
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL,
+            cwd = os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("ascii").strip()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the game simulation and renderer headless.")
+    parser.add_argument("--ticks", type = int, default = 3000, help = "ticks per scenario, at least 400 per stage in levels")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--scenario", action = "append", choices = sorted(SCENARIOS),
+        help = "scenario to run, may be repeated (default: all)")
+    parser.add_argument("--no-draw", dest = "draw", action = "store_false", help = "skip Game.draw()")
+    parser.add_argument("--vector-bullets", action = "store_true", help = "use the NumPy bullet manager")
+    parser.add_argument("--tracemalloc", action = "store_true", help = "also measure peak traced memory")
+    parser.add_argument("--output", default = "benchmark.json", help = "JSON report, '-' for stdout")
+    options = parser.parse_args(argv)
+    if options.output != "-":
+        options.output = os.path.abspath(options.output)
+
+    # 資源文件用的是相對路徑
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    game = None
+    if options.draw:
+        BattleCity.play_sounds = False
+        game = Game()
+
+    report = {
+        "commit" : gitCommit(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "ticks" : options.ticks,
+        "seed" : options.seed,
+        "draw" : options.draw,
+        "vector_bullets" : options.vector_bullets,
+        "scenarios" : {},
+    }
+
+    for name in options.scenario or sorted(SCENARIOS):
+        result = benchmark(name, options, game)
+        report["scenarios"][name] = result
+        print ("%-16s %9.1f ticks/s  p50 %.3f ms  p99 %.3f ms" % (name, result["ticks_per_second"],
+            result["p50_ms"], result["p99_ms"]))
+
+    data = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output == "-":
+        print (data)
+    else:
+        f = open(options.output, "w")
+        try:
+            f.write(data + "\n")
+        finally:
+            f.close()
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+訓練AI用的遊戲環境
+TankWarEnv把一個不需要遊戲窗口的World包裝成reset()/step()接口，
+VectorEnv同時運行多個TankWarEnv，可以在一個進程中逐個推進，也可以分到多個進程中並行推進
+觀察值是numpy數組，需要安裝numpy
+"""
+import multiprocessing
+import random
+
+import numpy
+
+from BattleCity import World, Level
+
+
+class TankWarEnv(object):
+    """
+    一個遊戲環境
+    每次step()推進frame_skip步，觀察值為(OBS_CHANNELS, 26, 26)的uint8數組，每個格子一個值
+    """
+
+    # 觀察值的各個通道
+    (OBS_TILES, OBS_PLAYERS, OBS_ENEMIES, OBS_PLAYER_BULLETS, OBS_ENEMY_BULLETS, OBS_CASTLE, OBS_BONUSES) = range(7)
+    OBS_CHANNELS = 7
+
+    # 動作編號對應的輸入位掩碼
+    ACTIONS = (
+        0,
+        World.INPUT_UP,
+        World.INPUT_RIGHT,
+        World.INPUT_DOWN,
+        World.INPUT_LEFT,
+        World.INPUT_FIRE,
+        World.INPUT_UP | World.INPUT_FIRE,
+        World.INPUT_RIGHT | World.INPUT_FIRE,
+        World.INPUT_DOWN | World.INPUT_FIRE,
+        World.INPUT_LEFT | World.INPUT_FIRE,
+    )
+
+    # 獎勵：每得1分、通過一關、失去一條命、遊戲結束
+    REWARD_SCORE = 0.01
+    REWARD_FINISH = 10.0
+    REWARD_LIFE = -5.0
+    REWARD_GAME_OVER = -10.0
+
+    def __init__(self, nr_of_players = 1, stage = 1, seed = None, frame_skip = 4, max_steps = 10000,
+                 aggression = 0.0, vector_bullets = False):
+        self.nr_of_players = nr_of_players
+        self.stage = stage
+        # 每局的隨機數種子由seed產生，同一個seed得到同樣的一系列遊戲
+        self.seeds = random.Random(seed)
+        # 每個動作持續多少步
+        self.frame_skip = frame_skip
+        # 每局最多step()多少次
+        self.max_steps = max_steps
+        self.aggression = aggression
+        self.vector_bullets = vector_bullets
+
+        self.world = None
+        self.steps = 0
+        self.scores = []
+        self.lives = []
+
+    def reset(self, seed = None):
+        """ 開始新的一局，返回觀察值 """
+        if seed == None:
+            seed = self.seeds.randrange(1 << 32)
+        self.world = World(self.nr_of_players, seed, self.vector_bullets)
+        self.world.aggression = self.aggression
+        self.world.stage = self.stage - 1
+        self.world.nextLevel()
+        self.steps = 0
+        self.scores = [player.score for player in self.world.players]
+        self.lives = [player.lives for player in self.world.players]
+        return self.observe()
+
+    def step(self, action):
+        """
+        執行一個動作，返回(觀察值, 獎勵, 是否結束, 信息)
+        action為ACTIONS的編號，多個玩家時為每個玩家一個編號的列表
+        """
+        world = self.world
+        if self.nr_of_players == 1:
+            inputs = [self.ACTIONS[action]]
+        else:
+            inputs = [self.ACTIONS[a] for a in action]
+
+        for i in range(self.frame_skip):
+            world.step(World.TICK, inputs)
+            # 開火只在第一步有效
+            if i == 0:
+                inputs = [mask & ~World.INPUT_FIRE for mask in inputs]
+            if world.game_over or not world.active:
+                break
+        self.steps += 1
+
+        reward = 0.0
+        for i, player in enumerate(world.players):
+            reward += (player.score - self.scores[i]) * self.REWARD_SCORE
+            reward += (self.lives[i] - player.lives) * self.REWARD_LIFE
+            self.scores[i] = player.score
+            self.lives[i] = player.lives
+
+        done = False
+        if world.game_over:
+            reward += self.REWARD_GAME_OVER
+            done = True
+        elif not world.active:
+            reward += self.REWARD_FINISH
+            done = True
+        elif self.steps >= self.max_steps:
+            done = True
+
+        info = {"stage" : world.stage, "ticks" : world.ticks, "scores" : list(self.scores)}
+        return self.observe(), reward, done, info
+
+    def observe(self, out = None):
+        """ 觀察值，out為要寫入的數組 """
+        world = self.world
+        level = world.level
+        size = level.grid_size
+
+        if out is None:
+            out = numpy.zeros((self.OBS_CHANNELS, size, size), dtype = numpy.uint8)
+        else:
+            out[...] = 0
+
+        out[self.OBS_TILES] = numpy.frombuffer(bytes(level.tiles), dtype = numpy.uint8).reshape(size, size)
+
+        # 坦克按佔用的格子標記，玩家為玩家編號+1，敵方坦克為類型+1
+        for i, player in enumerate(world.players):
+            if player.state == player.STATE_ALIVE:
+                x1, y1, x2, y2 = level.gridRange(player.rect)
+                out[self.OBS_PLAYERS, y1:y2 + 1, x1:x2 + 1] = i + 1
+        for enemy in world.enemies:
+            if enemy.state == enemy.STATE_ALIVE:
+                x1, y1, x2, y2 = level.gridRange(enemy.rect)
+                out[self.OBS_ENEMIES, y1:y2 + 1, x1:x2 + 1] = enemy.type + 1
+
+        # 砲彈按中心所在的格子標記，值為方向+1
+        for bullet in world.bullets:
+            if bullet.state == bullet.STATE_ACTIVE:
+                x = min(max(bullet.rect.centerx // level.TILE_SIZE, 0), size - 1)
+                y = min(max(bullet.rect.centery // level.TILE_SIZE, 0), size - 1)
+                if bullet.owner == bullet.OWNER_PLAYER:
+                    out[self.OBS_PLAYER_BULLETS, y, x] = bullet.direction + 1
+                else:
+                    out[self.OBS_ENEMY_BULLETS, y, x] = bullet.direction + 1
+
+        if world.castle.active:
+            x1, y1, x2, y2 = level.gridRange(world.castle.rect)
+            out[self.OBS_CASTLE, y1:y2 + 1, x1:x2 + 1] = 1
+
+        for bonus in world.bonuses:
+            x1, y1, x2, y2 = level.gridRange(bonus.rect)
+            out[self.OBS_BONUSES, y1:y2 + 1, x1:x2 + 1] = bonus.bonus + 1
+
+        return out
+
+
+class VectorEnv(object):
+    """
+    同時運行n個遊戲環境，觀察值、獎勵、是否結束都按環境疊成numpy數組
+    processes為0時在當前進程中逐個推進，否則把環境平均分到processes個進程中並行推進
+    結束的環境自動開始新的一局，結束時的觀察值在信息的"final_observation"中
+    """
+
+    def __init__(self, n, processes = 0, seed = None, **kwargs):
+        self.n = n
+        self.processes = min(processes, n)
+        # 第i個環境的隨機數種子為seed+i
+        seeds = [None if seed == None else seed + i for i in range(n)]
+
+        if self.processes == 0:
+            self.workers = None
+            self.envs = [TankWarEnv(seed = seeds[i], **kwargs) for i in range(n)]
+        else:
+            self.envs = None
+            self.workers = []
+            # 每個進程負責的環境範圍
+            self.slices = []
+            start = 0
+            for p in range(self.processes):
+                count = n // self.processes + (1 if p < n % self.processes else 0)
+                parent, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(target = _worker, args = (child, seeds[start:start + count], kwargs))
+                process.daemon = True
+                process.start()
+                child.close()
+                self.workers.append((process, parent))
+                self.slices.append((start, start + count))
+                start += count
+
+    def reset(self):
+        """ 所有環境開始新的一局，返回(n, OBS_CHANNELS, 26, 26)的觀察值 """
+        if self.workers == None:
+            return numpy.stack([env.reset() for env in self.envs])
+
+        for process, pipe in self.workers:
+            pipe.send(("reset", None))
+        return numpy.concatenate([pipe.recv() for process, pipe in self.workers])
+
+    def step(self, actions):
+        """ 每個環境執行一個動作，返回(觀察值, 獎勵, 是否結束, 信息列表) """
+        if self.workers == None:
+            return _stepAll(self.envs, actions)
+
+        for (process, pipe), (start, end) in zip(self.workers, self.slices):
+            pipe.send(("step", actions[start:end]))
+        results = [pipe.recv() for process, pipe in self.workers]
+        observations = numpy.concatenate([result[0] for result in results])
+        rewards = numpy.concatenate([result[1] for result in results])
+        dones = numpy.concatenate([result[2] for result in results])
+        infos = []
+        for result in results:
+            infos.extend(result[3])
+        return observations, rewards, dones, infos
+
+    def close(self):
+        """ 結束所有進程 """
+        if self.workers == None:
+            return
+        for process, pipe in self.workers:
+            pipe.send(("close", None))
+            pipe.close()
+        for process, pipe in self.workers:
+            process.join()
+        self.workers = None
+
+
+def _stepAll(envs, actions):
+    """ 逐個推進環境，結束的環境重新開始 """
+    size = Level.GRID_SIZE
+    observations = numpy.zeros((len(envs), TankWarEnv.OBS_CHANNELS, size, size), dtype = numpy.uint8)
+    rewards = numpy.zeros(len(envs), dtype = numpy.float32)
+    dones = numpy.zeros(len(envs), dtype = bool)
+    infos = []
+    for i, env in enumerate(envs):
+        observation, rewards[i], dones[i], info = env.step(actions[i])
+        if dones[i]:
+            info["final_observation"] = observation
+            observation = env.reset()
+        observations[i] = observation
+        infos.append(info)
+    return observations, rewards, dones, infos
+
+
+def _worker(pipe, seeds, kwargs):
+    """ 子進程：運行一組環境，按父進程的命令推進 """
+    envs = [TankWarEnv(seed = seed, **kwargs) for seed in seeds]
+    while True:
+        command, data = pipe.recv()
+        if command == "reset":
+            pipe.send(numpy.stack([env.reset() for env in envs]))
+        elif command == "step":
+            pipe.send(_stepAll(envs, data))
+        elif command == "close":
+            pipe.close()
+            break
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+關卡地形圖
+levels目錄下的文字檔是可以編輯的原始地形圖，每行26個字符，一共26行：
+    . 空地  # 磚牆  @ 鋼板  ~ 海水  % 森林  - 地板  0 敵方坦克出現位置
+第一次使用時編譯成levels/levels.pack，每個格子一個字節，之後用mmap讀取
+文字檔比levels.pack新時自動重新編譯，讀取過的地形圖保存在LRU緩存中
+
+用法：
+    python levelpack.py          編譯並檢查所有地形圖
+    python levelpack.py --check  只檢查地形圖格式
+"""
+import functools
+import mmap
+import os
+import struct
+import sys
+
+
+# 地形，與Level.TILE_*一致
+(TILE_EMPTY, TILE_BRICK, TILE_STEEL, TILE_WATER, TILE_GRASS, TILE_FROZE) = range(6)
+
+# 地形圖文字檔中的字符
+TILE_CHARS = {
+    "." : TILE_EMPTY,
+    "#" : TILE_BRICK,
+    "@" : TILE_STEEL,
+    "~" : TILE_WATER,
+    "%" : TILE_GRASS,
+    "-" : TILE_FROZE,
+    # 敵方坦克出現的位置，當作空地
+    "0" : TILE_EMPTY,
+}
+
+# 每行、每列的格子數
+GRID_SIZE = 26
+
+# 地形圖目錄，不受當前目錄影響
+LEVEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "levels")
+PACK_FILE = os.path.join(LEVEL_DIR, "levels.pack")
+
+# 文件頭：標識"TWLV"、版本、地形圖數量、每行格子數
+MAGIC = b"TWLV"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBx")
+
+# 已打開的levels.pack
+pack = None
+
+
+def sourceFiles(directory = LEVEL_DIR):
+    """ 所有地形圖文字檔，key為關卡 """
+    files = {}
+    for name in os.listdir(directory):
+        if name.isdigit():
+            files[int(name)] = os.path.join(directory, name)
+    return files
+
+
+def readText(filename):
+    """ 讀取地形圖文字檔 """
+    f = open(filename, "r")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def parse(text):
+    """ 把地形圖文字轉換為每個格子一個字節，不認識的字符當作空地 """
+    tiles = bytearray(GRID_SIZE * GRID_SIZE)
+    for y, row in enumerate(text.split("\n")[:GRID_SIZE]):
+        for x, ch in enumerate(row[:GRID_SIZE]):
+            tiles[y * GRID_SIZE + x] = TILE_CHARS.get(ch, TILE_EMPTY)
+    return bytes(tiles)
+
+
+def validate(text):
+    """ 檢查地形圖格式，返回錯誤信息列表 """
+    errors = []
+    rows = text.split("\n")
+    # 允許文件最後有一個換行
+    if len(rows) > 1 and rows[-1] == "":
+        rows = rows[:-1]
+    if len(rows) != GRID_SIZE:
+        errors.append("expected %d rows, found %d" % (GRID_SIZE, len(rows)))
+    for y, row in enumerate(rows):
+        if len(row) != GRID_SIZE:
+            errors.append("row %d: expected %d cells, found %d" % (y + 1, GRID_SIZE, len(row)))
+        for x, ch in enumerate(row):
+            if ch not in TILE_CHARS:
+                errors.append("row %d, column %d: unknown tile %r" % (y + 1, x + 1, ch))
+    return errors
+
+
+def compileLevels(directory = LEVEL_DIR, filename = PACK_FILE):
+    """ 把所有地形圖文字檔編譯為一個文件，缺少的關卡為空地 """
+    files = sourceFiles(directory)
+    count = max(files) if len(files) > 0 else 0
+    data = [HEADER.pack(MAGIC, VERSION, count, GRID_SIZE)]
+    for level_nr in range(1, count + 1):
+        if level_nr in files:
+            data.append(parse(readText(files[level_nr])))
+        else:
+            data.append(bytes(GRID_SIZE * GRID_SIZE))
+
+    # 先寫到臨時文件再替換，其他進程不會讀到寫了一半的文件
+    # 多個進程可能同時編譯，每個進程用自己的臨時文件
+    temp = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        f = open(temp, "wb")
+        try:
+            f.write(b"".join(data))
+        finally:
+            f.close()
+        os.replace(temp, filename)
+    except (IOError, OSError):
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+def isStale(directory = LEVEL_DIR, filename = PACK_FILE):
+    """ levels.pack不存在或者比文字檔舊 """
+    if not os.path.isfile(filename):
+        return True
+    mtime = os.path.getmtime(filename)
+    for source in sourceFiles(directory).values():
+        if os.path.getmtime(source) > mtime:
+            return True
+    return False
+
+
+def openPack():
+    """ 打開levels.pack，需要時先重新編譯，無法編譯返回None """
+    global pack
+
+    if pack != None:
+        return pack
+
+    try:
+        if isStale():
+            compileLevels()
+        f = open(PACK_FILE, "rb")
+        try:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+    if len(data) < HEADER.size:
+        data.close()
+        return None
+    magic, version, count, size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or size != GRID_SIZE:
+        data.close()
+        return None
+    pack = data
+    return pack
+
+
+@functools.lru_cache(maxsize = 8)
+def grid(level_nr):
+    """ 第level_nr關的地形圖，每個格子一個字節，沒有這一關返回None """
+    data = openPack()
+    if data != None:
+        count = HEADER.unpack_from(data)[2]
+        if not 1 <= level_nr <= count:
+            return None
+        start = HEADER.size + (level_nr - 1) * GRID_SIZE * GRID_SIZE
+        return data[start:start + GRID_SIZE * GRID_SIZE]
+
+    # 無法使用levels.pack時直接讀文字檔
+    filename = os.path.join(LEVEL_DIR, str(level_nr))
+    if not os.path.isfile(filename):
+        return None
+    return parse(readText(filename))
+
+
+if __name__ == "__main__":
+    files = sourceFiles()
+    failed = False
+    for level_nr in sorted(files):
+        for error in validate(readText(files[level_nr])):
+            print ("levels/%d: %s" % (level_nr, error))
+            failed = True
+
+    if "--check" not in sys.argv[1:]:
+        print ("%d levels compiled to %s" % (compileLevels(), PACK_FILE))
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+區域網雙人連線遊戲
+兩邊各自運行同樣的World，只通過UDP交換每一步的玩家輸入位掩碼(World.INPUT_*)
+本地輸入延遲INPUT_DELAY步生效，還沒收到的對方輸入先預測為對方上一次的輸入，
+收到後發現預測錯了就從確認過的世界重新推進到當前步，延遲100ms以內操作起來和本地一樣
+
+每個Session保存兩個World：
+    confirmed 雙方輸入都已收到的最後一步，只按確認的輸入推進
+    world     當前畫面上的世界，對方的輸入可能是預測的
+預測錯誤時world換成confirmed的複製，再按已知和預測的輸入推進到當前步
+
+數據包：
+    文件頭 <4sBBB> 標識"TWNP"、版本、類型、發送方玩家編號
+    HELLO  <HIB> 開始關卡、隨機數種子、是否已收到對方的HELLO，以玩家一的關卡和種子為準
+    INPUT  <IIIbIB> 已連續收到對方多少步輸入、校驗和對應的步數、校驗和、
+           發送方領先的步數、第一個輸入的步數、輸入個數，之後每步一個字節的位掩碼
+沒被對方確認收到的輸入每個包都重發，丟包不需要重傳
+
+用法：
+    python netplay.py --player 0 --port 7000 --peer 127.0.0.1:7001
+    python netplay.py --player 1 --port 7001 --peer 127.0.0.1:7000
+    [--delay 步數] [--latency ms] [--jitter ms] [--loss 機率] [--seed N] [--stage N]
+    [--headless --ticks N]  不開窗口，用隨機輸入推進N步後輸出確認的校驗和
+"""
+import argparse
+import heapq
+import random
+import socket
+import struct
+import sys
+import time
+
+from BattleCity import World
+
+
+class Link(object):
+    """
+    UDP連線，只和一個對方通信
+    latency、jitter為發送時額外的延遲，單位ms，loss為丟包機率，用來在同一台機器上模擬網絡狀況
+    """
+
+    # 一個數據包最大字節數
+    MAX_PACKET = 1024
+
+    def __init__(self, local_address, peer_address, latency = 0, jitter = 0, loss = 0.0, seed = None):
+        self.peer_address = peer_address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(local_address)
+        self.socket.setblocking(False)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        # 延遲發送的數據包，最小堆，元素為(發送時間, 序號, 數據)
+        self.outgoing = []
+        self.sequence = 0
+
+        # 統計
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+
+    def send(self, data):
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        if self.latency > 0 or self.jitter > 0:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            heapq.heappush(self.outgoing, (time.monotonic() + delay / 1000.0, self.sequence, data))
+            self.sequence += 1
+        else:
+            self.sendNow(data)
+
+    def sendNow(self, data):
+        try:
+            self.socket.sendto(data, self.peer_address)
+            self.sent += 1
+        except OSError:
+            # 對方還沒開始監聽等錯誤，當作丟包
+            self.dropped += 1
+
+    def receive(self):
+        """ 發送到期的延遲數據包，返回收到的所有數據包 """
+        now = time.monotonic()
+        while self.outgoing and self.outgoing[0][0] <= now:
+            self.sendNow(heapq.heappop(self.outgoing)[2])
+
+        packets = []
+        while True:
+            try:
+                data, address = self.socket.recvfrom(self.MAX_PACKET)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # 對方端口關閉時的ICMP錯誤
+                continue
+            if address == self.peer_address:
+                packets.append(data)
+                self.received += 1
+        return packets
+
+    def close(self):
+        self.socket.close()
+
+
+class Session(object):
+    """
+    一局連線遊戲，player為本地玩家的編號(0或1)
+    先反覆調用handshake()直到返回True，之後每一步調用一次update()
+    """
+
+    MAGIC = b"TWNP"
+    VERSION = 1
+    HEADER = struct.Struct("<4sBBB")
+    HELLO = struct.Struct("<HIB")
+    INPUT = struct.Struct("<IIIbIB")
+    (PACKET_HELLO, PACKET_INPUT) = range(2)
+
+    # 本地輸入延遲幾步生效
+    INPUT_DELAY = 3
+    # 最多領先確認的世界幾步，超過就等待對方
+    MAX_PREDICTION = 10
+    # 一個數據包最多帶多少步輸入
+    MAX_INPUTS = 64
+    # 每隔多少步比較一次雙方的校驗和
+    CHECK_INTERVAL = 100
+    # 多少秒沒收到對方的數據包就斷開
+    TIMEOUT = 5.0
+
+    def __init__(self, link, player, seed = None, stage = 1, delay = None):
+        self.link = link
+        self.player = player
+        self.remote_player = 1 - player
+        # 以玩家一的隨機數種子和開始關卡為準
+        if seed == None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.stage = stage
+        self.delay = self.INPUT_DELAY if delay == None else delay
+
+        self.confirmed = None
+        self.world = None
+        # 已經收到對方的HELLO
+        self.heard = False
+        self.connected = False
+        self.disconnected = False
+        self.last_received = time.monotonic()
+        self.last_hello = 0
+
+        # 每個玩家每一步的輸入，本地輸入延遲delay步，前delay步為0
+        self.inputs = [[0] * self.delay, [0] * self.delay]
+        # world推進每一步時用的對方輸入，預測錯誤時重新推進
+        self.guesses = []
+        # world的下一步
+        self.tick = 0
+        # confirmed的下一步
+        self.confirmed_tick = 0
+        # 對方已經連續收到多少步本地輸入
+        self.peer_ack = 0
+        # 對方領先的步數，用來調整雙方的速度
+        self.peer_advantage = 0
+
+        # confirmed的校驗和，key為步數，和對方比較檢查兩邊是否一致
+        self.checksums = {}
+        self.peer_check = (0, 0)
+        # 兩邊不一致的步數，None表示一致
+        self.desync_tick = None
+
+        # 統計
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.stalls = 0
+
+    def handshake(self):
+        """ 交換HELLO，雙方都收到對方的HELLO後創建World，返回是否已經連上 """
+        if self.connected:
+            return True
+        self.receive()
+        now = time.monotonic()
+        if not self.connected and now - self.last_hello >= 0.1:
+            self.last_hello = now
+            self.link.send(self.HEADER.pack(self.MAGIC, self.VERSION, self.PACKET_HELLO, self.player) +
+                self.HELLO.pack(self.stage, self.seed, self.heard))
+        return self.connected
+
+    def start(self):
+        """ 雙方已確認收到HELLO，用同樣的種子和關卡創建World """
+        self.connected = True
+        world = World(2, self.seed)
+        world.stage = self.stage - 1
+        world.nextLevel()
+        self.confirmed = world
+        self.world = world.copy()
+
+    def finished(self):
+        """ 遊戲結束或斷開連線 """
+        if self.disconnected:
+            return True
+        return self.world != None and self.world.game_over and not self.world.running
+
+    def receive(self):
+        """ 處理收到的數據包 """
+        for data in self.link.receive():
+            if len(data) < self.HEADER.size:
+                continue
+            magic, version, kind, player = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC or version != self.VERSION or player != self.remote_player:
+                continue
+            self.last_received = time.monotonic()
+
+            if kind == self.PACKET_HELLO and len(data) >= self.HEADER.size + self.HELLO.size:
+                stage, seed, heard = self.HELLO.unpack_from(data, self.HEADER.size)
+                if not self.heard and self.player == 1:
+                    self.stage = stage
+                    self.seed = seed
+                self.heard = True
+                if heard and not self.connected:
+                    self.start()
+            elif kind == self.PACKET_INPUT and len(data) >= self.HEADER.size + self.INPUT.size:
+                # 對方已經開始，說明已經收到本地的HELLO
+                if not self.connected:
+                    if not self.heard:
+                        continue
+                    self.start()
+                offset = self.HEADER.size
+                ack, check_tick, check_crc, advantage, start, count = self.INPUT.unpack_from(data, offset)
+                offset += self.INPUT.size
+                masks = data[offset:offset + count]
+                self.peer_ack = max(self.peer_ack, ack)
+                self.peer_advantage = advantage
+                self.peer_check = (check_tick, check_crc)
+                remote = self.inputs[self.remote_player]
+                for i in range(len(masks)):
+                    if start + i == len(remote):
+                        remote.append(masks[i])
+                self.compareChecksums()
+
+    def compareChecksums(self):
+        """ 比較雙方同一步的校驗和 """
+        tick, crc = self.peer_check
+        if tick in self.checksums and self.checksums[tick] != crc and self.desync_tick == None:
+            self.desync_tick = tick
+            print ("Desync at tick %d" % tick)
+
+    def send(self):
+        """ 發送對方還沒確認收到的本地輸入 """
+        local = self.inputs[self.player]
+        start = self.peer_ack
+        masks = bytes(local[start:start + self.MAX_INPUTS])
+        check_tick = 0
+        check_crc = 0
+        if len(self.checksums) > 0:
+            check_tick = max(self.checksums)
+            check_crc = self.checksums[check_tick]
+        self.link.send(self.HEADER.pack(self.MAGIC, self.VERSION, self.PACKET_INPUT, self.player) +
+            self.INPUT.pack(len(self.inputs[self.remote_player]), check_tick, check_crc,
+                max(-128, min(127, self.advantage())), start, len(masks)) + masks)
+
+    def advantage(self):
+        """ 本地領先對方的步數 """
+        return self.tick - (len(self.inputs[self.remote_player]) - self.delay)
+
+    def inputsAt(self, tick):
+        """ 第tick步雙方的輸入，對方的輸入還沒收到時預測為最後收到的輸入 """
+        remote = self.inputs[self.remote_player]
+        if tick < len(remote):
+            guess = remote[tick]
+        elif len(remote) > 0:
+            guess = remote[-1]
+        else:
+            guess = 0
+        inputs = [0, 0]
+        inputs[self.player] = self.inputs[self.player][tick]
+        inputs[self.remote_player] = guess
+        return inputs
+
+    def advanceWorld(self, world, inputs):
+        """ 推進一步，上一關已經結束則進入下一關，和ReplayPlayer一樣 """
+        if not world.running and not world.game_over:
+            world.nextLevel()
+        world.step(world.TICK, inputs)
+
+    def confirm(self):
+        """ 按收到的對方輸入推進confirmed，返回預測是否有錯 """
+        remote = self.inputs[self.remote_player]
+        mispredicted = False
+        while self.confirmed_tick < self.tick and self.confirmed_tick < len(remote):
+            tick = self.confirmed_tick
+            if self.guesses[tick] != remote[tick]:
+                mispredicted = True
+            inputs = [0, 0]
+            inputs[self.player] = self.inputs[self.player][tick]
+            inputs[self.remote_player] = remote[tick]
+            self.advanceWorld(self.confirmed, inputs)
+            self.confirmed_tick += 1
+            if self.confirmed_tick % self.CHECK_INTERVAL == 0:
+                self.checksums[self.confirmed_tick] = self.confirmed.checksum()
+                # 只保留最近的校驗和
+                self.checksums.pop(self.confirmed_tick - self.CHECK_INTERVAL * 10, None)
+                self.compareChecksums()
+        return mispredicted
+
+    def rollback(self):
+        """ 從confirmed重新推進到當前步，對方的輸入用最新的預測 """
+        self.rollbacks += 1
+        world = self.confirmed.copy()
+        for tick in range(self.confirmed_tick, self.tick):
+            inputs = self.inputsAt(tick)
+            self.guesses[tick] = inputs[self.remote_player]
+            self.advanceWorld(world, inputs)
+            self.resimulated += 1
+        # 重新推進時的聲音已經播放過
+        del world.sound_events[:]
+        self.world = world
+
+    def update(self, mask):
+        """
+        本地玩家這一步的輸入為mask，推進一步
+        返回推進的步數，等待對方時為0
+        """
+        self.receive()
+        if not self.connected:
+            return 0
+        if time.monotonic() - self.last_received > self.TIMEOUT:
+            self.disconnected = True
+            return 0
+
+        if self.confirm():
+            self.rollback()
+
+        steps = 0
+        del self.world.sound_events[:]
+        # 領先對方太多時等一步，讓對方追上
+        waiting = self.tick - self.confirmed_tick >= self.MAX_PREDICTION
+        if not waiting and self.tick % 10 == 0 and self.advantage() - self.peer_advantage >= 2:
+            waiting = True
+        if waiting:
+            self.stalls += 1
+        else:
+            self.inputs[self.player].append(mask)
+            inputs = self.inputsAt(self.tick)
+            self.guesses.append(inputs[self.remote_player])
+            self.advanceWorld(self.world, inputs)
+            self.tick += 1
+            steps = 1
+
+        self.send()
+        return steps
+
+    def close(self):
+        self.link.close()
+
+
+def parseAddress(text):
+    host, port = text.rsplit(":", 1)
+    return (host, int(port))
+
+
+def botInput(rng, tick, mask):
+    """ 不開窗口時的隨機輸入：每30步換一個方向，每20步開火 """
+    if tick % 30 == 0:
+        mask = rng.choice((World.INPUT_UP, World.INPUT_RIGHT, World.INPUT_DOWN, World.INPUT_LEFT, 0))
+    if tick % 20 == 0:
+        return mask | World.INPUT_FIRE
+    return mask & ~World.INPUT_FIRE
+
+
+def runHeadless(session, ticks):
+    """ 以每秒50步推進到確認了ticks步，返回確認的世界的校驗和 """
+    while not session.handshake():
+        if session.disconnected:
+            return None
+        time.sleep(0.005)
+
+    rng = random.Random(session.player)
+    mask = 0
+    next_tick = time.monotonic()
+    while session.confirmed_tick < ticks and not session.disconnected:
+        mask = botInput(rng, session.tick, mask)
+        session.update(mask)
+        next_tick += World.TICK / 1000.0
+        time.sleep(max(0, next_tick - time.monotonic()))
+
+    checksum = session.confirmed.checksum()
+    # 繼續發送一會兒，讓對方也能確認最後的輸入
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:
+        session.receive()
+        session.send()
+        time.sleep(World.TICK / 1000.0)
+    return checksum
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Two-player lockstep game over UDP with rollback.")
+    parser.add_argument("--player", type = int, choices = (0, 1), required = True)
+    parser.add_argument("--port", type = int, required = True, help = "local UDP port")
+    parser.add_argument("--bind", default = "0.0.0.0")
+    parser.add_argument("--peer", required = True, help = "HOST:PORT of the other player")
+    parser.add_argument("--seed", type = int, default = None, help = "used by player 0")
+    parser.add_argument("--stage", type = int, default = 1, help = "used by player 0")
+    parser.add_argument("--delay", type = int, default = Session.INPUT_DELAY, help = "input delay in ticks")
+    parser.add_argument("--latency", type = float, default = 0, help = "simulated one-way latency in ms")
+    parser.add_argument("--jitter", type = float, default = 0, help = "simulated extra random latency in ms")
+    parser.add_argument("--loss", type = float, default = 0.0, help = "simulated packet loss probability")
+    parser.add_argument("--headless", action = "store_true", help = "no window, random inputs")
+    parser.add_argument("--ticks", type = int, default = 3000, help = "ticks to play when headless")
+    options = parser.parse_args(argv)
+
+    link = Link((options.bind, options.port), parseAddress(options.peer),
+        options.latency, options.jitter, options.loss)
+    session = Session(link, options.player, options.seed, options.stage, options.delay)
+
+    try:
+        if options.headless:
+            checksum = runHeadless(session, options.ticks)
+            if checksum == None:
+                print ("Disconnected")
+                sys.exit(1)
+            print ("player %d: %d ticks, checksum %08x, rollbacks %d, resimulated %d, stalls %d, packets sent %d dropped %d" % (
+                options.player, session.confirmed_tick, checksum, session.rollbacks, session.resimulated,
+                session.stalls, link.sent, link.dropped))
+            if session.desync_tick != None:
+                sys.exit(1)
+        else:
+            import BattleCity
+            game = BattleCity.Game()
+            game.playNetwork(session)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
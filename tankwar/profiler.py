@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+性能分析
+啟用時把指定的方法換成計時版本，記錄每一幀各部分的耗時，停用時換回原來的方法，沒有任何額外開銷
+每一幀的耗時和物體數量保存在固定大小的環形緩衝區中，可以畫成遊戲畫面上的浮層，也可以保存為CSV文件
+"""
+import array
+import os
+import time
+
+import pygame
+
+
+class Profiler(object):
+    """
+    spans為計時範圍列表，每項為(名稱, 類, 方法名)
+    名稱相同的方法嵌套調用時只計算最外層
+    """
+
+    # 每一幀記錄的物體數量
+    COUNTS = ("players", "enemies", "bullets", "bonuses", "timers", "timer_queue")
+
+    # 每一幀的時間預算，單位ms
+    BUDGET = 20.0
+
+    def __init__(self, spans, capacity = 3000):
+        self.spans = spans
+        self.names = []
+        for name, cls, method in spans:
+            if name not in self.names:
+                self.names.append(name)
+
+        # 啟用後被替換的方法，(類, 方法名, 原來的方法)，原來的方法是繼承來的則為None
+        self.patches = []
+
+        # 從啟用開始每個範圍的總耗時，單位秒
+        self.totals = dict((name, 0.0) for name in self.names)
+        # 當前這一幀每個範圍的耗時
+        self.frame = dict((name, 0.0) for name in self.names)
+        # 正在計時的範圍，防止嵌套調用重複計時
+        self.depth = dict((name, 0) for name in self.names)
+        self.frame_start = 0.0
+
+        # 環形緩衝區，每一幀一行：幀耗時、各範圍耗時(ms)、各物體數量
+        self.columns = ["frame_ms"] + [name + "_ms" for name in self.names] + list(self.COUNTS)
+        self.capacity = capacity
+        self.buffer = array.array("d", [0.0]) * (capacity * len(self.columns))
+        # 一共記錄了多少幀
+        self.frames = 0
+
+        self.font = None
+
+    def enabled(self):
+        return len(self.patches) > 0
+
+    def enable(self):
+        """ 開始計時 """
+        if self.enabled():
+            return
+        for name, cls, method in self.spans:
+            original = getattr(cls, method)
+            inherited = method not in cls.__dict__
+            setattr(cls, method, self.timed(name, original))
+            self.patches.append((cls, method, None if inherited else original))
+
+    def disable(self):
+        """ 停止計時，恢復原來的方法 """
+        for cls, method, original in reversed(self.patches):
+            if original == None:
+                delattr(cls, method)
+            else:
+                setattr(cls, method, original)
+        self.patches = []
+
+    def timed(self, name, original):
+        """ 計時版本的方法 """
+        frame = self.frame
+        totals = self.totals
+        depth = self.depth
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            if depth[name] > 0:
+                return original(*args, **kwargs)
+            depth[name] = 1
+            start = clock()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                frame[name] += elapsed
+                totals[name] += elapsed
+                depth[name] = 0
+
+        return timed
+
+    def beginFrame(self):
+        """ 一幀開始 """
+        for name in self.names:
+            self.frame[name] = 0.0
+        self.frame_start = time.perf_counter()
+
+    def endFrame(self, world):
+        """ 一幀結束，把這一幀的耗時和物體數量寫入環形緩衝區 """
+        row = [(time.perf_counter() - self.frame_start) * 1000]
+        for name in self.names:
+            row.append(self.frame[name] * 1000)
+        row += [len(world.players), len(world.enemies), len(world.bullets), len(world.bonuses),
+                len(world.timer.timers), len(world.timer.queue)]
+
+        width = len(self.columns)
+        start = (self.frames % self.capacity) * width
+        self.buffer[start:start + width] = array.array("d", row)
+        self.frames += 1
+
+    def rows(self, count = None):
+        """ 最近count幀的記錄，從舊到新 """
+        available = min(self.frames, self.capacity)
+        if count == None or count > available:
+            count = available
+        width = len(self.columns)
+        result = []
+        for frame in range(self.frames - count, self.frames):
+            start = (frame % self.capacity) * width
+            result.append(self.buffer[start:start + width].tolist())
+        return result
+
+    def dump(self, directory = "profiles"):
+        """ 把環形緩衝區保存為CSV文件，返回文件名 """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, "profile-" + time.strftime("%Y%m%d-%H%M%S") + ".csv")
+        f = open(filename, "w")
+        try:
+            f.write(",".join(["frame"] + self.columns) + "\n")
+            first = self.frames - min(self.frames, self.capacity)
+            for i, row in enumerate(self.rows()):
+                f.write(",".join([str(first + i)] + ["%.3f" % value for value in row]) + "\n")
+        finally:
+            f.close()
+        return filename
+
+    def drawOverlay(self, surface, position = (4, 4)):
+        """ 在surface上畫出最近的幀耗時圖和各部分耗時、物體數量，返回畫過的區域 """
+        if self.font == None:
+            self.font = pygame.font.Font(None, 16)
+
+        graph_frames = 150
+        width, height = graph_frames * 2, 60
+        lines = 5
+        overlay = pygame.Surface((width, height + lines * 14 + 4), pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 160))
+
+        rows = self.rows(graph_frames)
+        # 幀耗時圖，超出預算的幀為紅色，縱軸為兩倍預算
+        scale = height / (self.BUDGET * 2)
+        for i, row in enumerate(rows):
+            bar = min(height, int(row[0] * scale) + 1)
+            color = (220, 60, 60) if row[0] > self.BUDGET else (60, 200, 60)
+            overlay.fill(color, (i * 2, height - bar, 2, bar))
+        budget_y = height - int(self.BUDGET * scale)
+        overlay.fill((200, 200, 200), (0, budget_y, width, 1))
+
+        if len(rows) > 0:
+            # 各部分耗時取最近30幀的平均值
+            recent = rows[-30:]
+            averages = [sum(row[i] for row in recent) / len(recent) for i in range(len(self.columns))]
+            spans = len(self.names)
+            items = ["%s %.1f" % (self.names[i], averages[i + 1]) for i in range(spans)]
+            counts = ["%s %d" % (self.COUNTS[i], rows[-1][i + 1 + spans]) for i in range(len(self.COUNTS))]
+            texts = ["frame %.1f ms  max %.1f ms" % (averages[0], max(row[0] for row in recent))]
+            # 每行三項
+            for group in (items, counts):
+                for i in range(0, len(group), 3):
+                    texts.append("  ".join(group[i:i + 3]))
+            for i, text in enumerate(texts[:lines]):
+                overlay.blit(self.font.render(text, True, (230, 230, 230)), (2, height + 2 + i * 14))
+
+        return surface.blit(overlay, position)
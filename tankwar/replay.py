@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲回放
+記錄每一步每個玩家的輸入位掩碼(World.INPUT_*)，連同隨機數種子和開始關卡保存為二進制文件，
+回放時用同樣的種子創建World並重新輸入，得到完全一樣的遊戲過程
+錄製時每SNAPSHOT_INTERVAL步保存一份World快照，回放時跳到任何位置最多推進SNAPSHOT_INTERVAL步
+
+文件格式：
+    文件頭 <4sBBHIII> 標識"TWRP"、版本、玩家數、開始關卡、隨機數種子、總步數、最後的校驗和
+    <II> 輸入記錄的長度、快照數
+    之後是zlib壓縮的輸入記錄，每條記錄為 <H>連續相同的步數 + 每個玩家一個字節的位掩碼
+    最後是每份快照 <II> 步數、長度 + snapshot.dumps()的結果
+    版本1的文件沒有第二行和快照
+
+用法：
+    python replay.py 回放文件 [--headless] [--seek 步數]
+"""
+import struct
+import sys
+import zlib
+
+
+class Replay(object):
+    """ 一局遊戲的輸入記錄 """
+
+    MAGIC = b"TWRP"
+    VERSION = 2
+    HEADER = struct.Struct("<4sBBHIII")
+    BODY = struct.Struct("<II")
+    SNAPSHOT = struct.Struct("<II")
+
+    # 每多少步保存一份快照
+    SNAPSHOT_INTERVAL = 250
+
+    # 一條記錄最多表示的連續步數
+    MAX_RUN = 0xffff
+
+    def __init__(self, seed, nr_of_players = 1, stage = 1):
+        self.seed = seed
+        self.nr_of_players = nr_of_players
+        # 從第幾關開始
+        self.stage = stage
+        # [連續步數, 每個玩家的位掩碼]，相同的輸入合併為一條記錄
+        self.runs = []
+        # 一共記錄了多少步
+        self.ticks = 0
+        # 記錄結束時World.checksum()，回放結束後用來檢查回放是否正確
+        self.checksum = 0
+        # 快照，key為步數，值為snapshot.dumps()的結果
+        self.snapshots = {}
+
+    def record(self, inputs, world = None):
+        """ 記錄一步的輸入，由World.step()在推進之前調用，world為推進之前的遊戲世界 """
+        if world != None and self.ticks > 0 and self.ticks % self.SNAPSHOT_INTERVAL == 0:
+            self.takeSnapshot(world)
+
+        masks = tuple(inputs)
+        runs = self.runs
+        if len(runs) > 0 and runs[-1][1] == masks and runs[-1][0] < self.MAX_RUN:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, masks])
+        self.ticks += 1
+
+    def takeSnapshot(self, world):
+        """ 保存推進了self.ticks步時的遊戲世界，無法保存的狀態就不保存，回放時從前一份快照推進 """
+        import snapshot
+
+        try:
+            self.snapshots[self.ticks] = snapshot.dumps(world)
+        except ValueError:
+            pass
+
+    def finish(self, world):
+        """ 記錄結束，保存遊戲世界最後的校驗和 """
+        self.checksum = world.checksum()
+
+    def inputs(self):
+        """ 展開成每一步的輸入 """
+        result = []
+        for run, masks in self.runs:
+            result.extend([masks] * run)
+        return result
+
+    def save(self, filename):
+        """ 保存為二進制文件 """
+        record = struct.Struct("<H%dB" % self.nr_of_players)
+        body = zlib.compress(b"".join([record.pack(run, *masks) for run, masks in self.runs]), 9)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.nr_of_players, self.stage,
+            self.seed, self.ticks, self.checksum)
+        data = [header, self.BODY.pack(len(body), len(self.snapshots)), body]
+        for tick in sorted(self.snapshots):
+            data.append(self.SNAPSHOT.pack(tick, len(self.snapshots[tick])))
+            data.append(self.snapshots[tick])
+        f = open(filename, "wb")
+        try:
+            f.write(b"".join(data))
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """ 從二進制文件加載回放 """
+        f = open(filename, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        if len(data) < cls.HEADER.size:
+            raise ValueError("%s: not a replay file" % filename)
+        magic, version, nr_of_players, stage, seed, ticks, checksum = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("%s: not a replay file" % filename)
+        if version not in (1, cls.VERSION):
+            raise ValueError("%s: unsupported replay version %d" % (filename, version))
+
+        replay = cls(seed, nr_of_players, stage)
+        replay.checksum = checksum
+        offset = cls.HEADER.size
+        if version == 1:
+            body = zlib.decompress(data[offset:])
+        else:
+            if len(data) < offset + cls.BODY.size:
+                raise ValueError("%s: replay truncated" % filename)
+            length, count = cls.BODY.unpack_from(data, offset)
+            offset += cls.BODY.size
+            body = zlib.decompress(data[offset:offset + length])
+            offset += length
+            for i in range(count):
+                if len(data) < offset + cls.SNAPSHOT.size:
+                    raise ValueError("%s: replay truncated" % filename)
+                tick, size = cls.SNAPSHOT.unpack_from(data, offset)
+                offset += cls.SNAPSHOT.size
+                replay.snapshots[tick] = data[offset:offset + size]
+                offset += size
+        record = struct.Struct("<H%dB" % nr_of_players)
+        for values in record.iter_unpack(body):
+            replay.runs.append([values[0], tuple(values[1:])])
+            replay.ticks += values[0]
+        if replay.ticks != ticks:
+            raise ValueError("%s: replay truncated" % filename)
+        return replay
+
+
+class ReplayPlayer(object):
+    """
+    回放器，按記錄的輸入一步一步推進World
+    跳轉時從最近的快照開始推進，快照來自回放文件，或者回放時每推進SNAPSHOT_INTERVAL步保存的World副本，
+    回放文件中沒有快照時先不畫畫面推進一遍，保存全部快照
+    world是用回放的玩家數和隨機數種子新創建的World
+    """
+
+    # 每多少步保存一份快照
+    SNAPSHOT_INTERVAL = Replay.SNAPSHOT_INTERVAL
+
+    def __init__(self, replay, world):
+        self.replay = replay
+        self.inputs = replay.inputs()
+        # 已經回放了多少步
+        self.position = 0
+        # 快照，key為步數
+        self.snapshots = {}
+
+        self.world = world
+        self.world.stage = replay.stage - 1
+        self.world.nextLevel()
+        self.snapshots[0] = self.world.copy()
+
+        if len(replay.snapshots) == 0 and len(self.inputs) > self.SNAPSHOT_INTERVAL:
+            self.buildSnapshots()
+
+    def finished(self):
+        """ 是否已經回放完 """
+        return self.position >= len(self.inputs)
+
+    def step(self):
+        """ 回放一步，返回False表示已經回放完 """
+        if self.finished():
+            return False
+
+        world = self.world
+        # 上一關已經結束，和Game一樣進入下一關
+        if not world.running and not world.game_over:
+            world.nextLevel()
+
+        world.step(world.TICK, self.inputs[self.position])
+        self.position += 1
+
+        if self.position % self.SNAPSHOT_INTERVAL == 0 and self.position not in self.snapshots:
+            self.snapshots[self.position] = world.copy()
+        return True
+
+    def buildSnapshots(self):
+        """ 不畫畫面推進到結束，保存每SNAPSHOT_INTERVAL步的快照，再回到開始 """
+        while self.step():
+            pass
+        self.world = self.snapshots[0].copy()
+        self.position = 0
+
+    def seek(self, tick):
+        """ 跳到第tick步，往回跳或者跳得比較遠時從最近的快照開始推進 """
+        import snapshot
+
+        saved = self.replay.snapshots
+        tick = max(0, min(tick, len(self.inputs)))
+        start = tick - tick % self.SNAPSHOT_INTERVAL
+        while start not in self.snapshots and start not in saved:
+            start -= self.SNAPSHOT_INTERVAL
+
+        if tick < self.position or start > self.position:
+            if start in self.snapshots:
+                self.world = self.snapshots[start].copy()
+            else:
+                self.world = snapshot.loads(saved[start])
+            self.position = start
+
+        while self.position < tick:
+            self.step()
+
+    def run(self):
+        """ 不畫畫面，以最快速度回放到結束，返回回放是否和記錄時一致 """
+        while self.step():
+            pass
+        return self.world.checksum() == self.replay.checksum
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) == 0:
+        print ("usage: python replay.py FILE [--headless] [--seek TICKS]")
+        sys.exit(2)
+
+    import BattleCity
+
+    replay = Replay.load(args[0])
+    world = BattleCity.World(replay.nr_of_players, replay.seed)
+    seek = 0
+    if "--seek" in args:
+        seek = int(args[args.index("--seek") + 1])
+
+    if "--headless" in args:
+        player = ReplayPlayer(replay, world)
+        player.seek(seek)
+        if player.run():
+            print ("%d ticks, checksum ok" % player.position)
+        else:
+            print ("%d ticks, checksum mismatch" % player.position)
+            sys.exit(1)
+    else:
+        game = BattleCity.Game()
+        game.playReplay(ReplayPlayer(replay, world), seek)
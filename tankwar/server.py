@@ -0,0 +1,616 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲服務器，同時運行多局遊戲，遊戲邏輯只在服務器上運行
+每局遊戲是一個不需要遊戲窗口的World，客戶端只發送輸入位掩碼(World.INPUT_*)，
+服務器按固定的頻率把畫面需要的狀態發給客戶端，只發送和上一次的差異
+
+主進程是大廳，負責分配對局；每局遊戲按編號分到一個工作進程，
+每個工作進程用asyncio在自己的端口上運行分到的所有對局，多個工作進程可以用上所有CPU核
+客戶端先連大廳，大廳回覆對局所在工作進程的端口、對局編號和玩家編號，客戶端再連工作進程
+
+消息格式：<HB> 內容長度、類型，之後是內容
+    JOIN      客戶端->大廳     <B>   玩家數
+    REDIRECT  大廳->客戶端     <HIB> 工作進程端口、對局編號、玩家編號
+    ENTER     客戶端->工作進程 <IBB> 對局編號、玩家編號、玩家數
+    WELCOME   工作進程->客戶端 <IBBI> 對局編號、玩家編號、玩家數、隨機數種子
+    INPUT     客戶端->工作進程 <B>   輸入位掩碼，按鍵有變化時發送，開火只在收到後的第一步有效
+    SNAPSHOT  工作進程->客戶端 <IB>  步數、是否完整狀態，之後是zlib壓縮的狀態或者和上一次狀態的異或
+    END       工作進程->客戶端 <BI>  是否遊戲結束、步數
+
+用法：
+    python server.py serve [--port 7300] [--workers CPU數] [--rate 每秒狀態數]
+    python server.py play [--host HOST] [--port 7300] [--players 1]
+    python server.py bots [--host HOST] [--port 7300] [--count 20] [--players 1] [--seconds 30]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import struct
+import time
+import zlib
+
+from BattleCity import World, Level
+from snapshot import xorBytes
+
+
+(MSG_JOIN, MSG_REDIRECT, MSG_ENTER, MSG_WELCOME, MSG_INPUT, MSG_SNAPSHOT, MSG_END) = range(7)
+
+MESSAGE = struct.Struct("<HB")
+JOIN = struct.Struct("<B")
+REDIRECT = struct.Struct("<HIB")
+ENTER = struct.Struct("<IBB")
+WELCOME = struct.Struct("<IBBI")
+INPUT = struct.Struct("<B")
+SNAPSHOT = struct.Struct("<IB")
+END = struct.Struct("<BI")
+
+# 畫面需要的狀態：步數、關卡、標誌、剩餘敵人數，玩家、敵方坦克、砲彈、寶物數量
+VIEW_HEADER = struct.Struct("<IBBBBBHB")
+VIEW_PLAYER = struct.Struct("<hhBBBI")
+VIEW_ENEMY = struct.Struct("<hhBB")
+VIEW_BULLET = struct.Struct("<hhB")
+VIEW_BONUS = struct.Struct("<hhB")
+(FLAG_GAME_OVER, FLAG_ACTIVE, FLAG_CASTLE) = (1, 2, 4)
+
+
+def message(kind, payload = b""):
+    return MESSAGE.pack(len(payload), kind) + payload
+
+
+async def readMessage(reader):
+    """ 讀取一條消息，返回(類型, 內容)，連線關閉返回(None, None) """
+    try:
+        length, kind = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+        payload = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None, None
+    return kind, payload
+
+
+def encodeView(world):
+    """ 把畫面需要的狀態編碼為字節串，固定長度的部分在前，差異更容易壓縮 """
+    level = world.level
+    flags = 0
+    if world.game_over:
+        flags |= FLAG_GAME_OVER
+    if world.active:
+        flags |= FLAG_ACTIVE
+    if world.castle.active:
+        flags |= FLAG_CASTLE
+    bullets = world.bullets[:0xffff]
+    enemies = world.enemies[:255]
+    bonuses = world.bonuses[:255]
+    data = [
+        VIEW_HEADER.pack(world.ticks, world.stage & 0xff, flags, min(len(level.enemies_left), 255),
+            len(world.players), len(enemies), len(bullets), len(bonuses)),
+        bytes(level.tiles),
+    ]
+    for p in world.players:
+        data.append(VIEW_PLAYER.pack(p.rect.x, p.rect.y, p.direction | p.state << 2 | p.shielded << 4,
+            min(max(p.lives, 0), 255), p.superpowers, p.score))
+    for e in enemies:
+        data.append(VIEW_ENEMY.pack(e.rect.x, e.rect.y, e.direction | e.state << 2, e.type | bool(e.bonus) << 2))
+    for b in bullets:
+        data.append(VIEW_BULLET.pack(b.rect.x, b.rect.y, b.direction | b.owner << 2 | b.state << 3))
+    for b in bonuses:
+        data.append(VIEW_BONUS.pack(b.rect.x, b.rect.y, b.bonus | b.visible << 3))
+    return b"".join(data)
+
+
+def decodeView(data):
+    """ encodeView()的逆操作，返回dict """
+    tick, stage, flags, enemies_left, nr_players, nr_enemies, nr_bullets, nr_bonuses = VIEW_HEADER.unpack_from(data)
+    offset = VIEW_HEADER.size
+    size = Level.GRID_SIZE * Level.GRID_SIZE
+    view = {
+        "tick" : tick,
+        "stage" : stage,
+        "game_over" : bool(flags & FLAG_GAME_OVER),
+        "active" : bool(flags & FLAG_ACTIVE),
+        "castle" : bool(flags & FLAG_CASTLE),
+        "enemies_left" : enemies_left,
+        "tiles" : data[offset:offset + size],
+        "players" : [],
+        "enemies" : [],
+        "bullets" : [],
+        "bonuses" : [],
+    }
+    offset += size
+    for i in range(nr_players):
+        x, y, bits, lives, superpowers, score = VIEW_PLAYER.unpack_from(data, offset)
+        offset += VIEW_PLAYER.size
+        view["players"].append({"x" : x, "y" : y, "direction" : bits & 3, "state" : bits >> 2 & 3,
+            "shielded" : bool(bits & 16), "lives" : lives, "superpowers" : superpowers, "score" : score})
+    for i in range(nr_enemies):
+        x, y, bits, kind = VIEW_ENEMY.unpack_from(data, offset)
+        offset += VIEW_ENEMY.size
+        view["enemies"].append({"x" : x, "y" : y, "direction" : bits & 3, "state" : bits >> 2 & 3,
+            "type" : kind & 3, "bonus" : bool(kind & 4)})
+    for i in range(nr_bullets):
+        x, y, bits = VIEW_BULLET.unpack_from(data, offset)
+        offset += VIEW_BULLET.size
+        view["bullets"].append({"x" : x, "y" : y, "direction" : bits & 3, "owner" : bits >> 2 & 1,
+            "state" : bits >> 3 & 3})
+    for i in range(nr_bonuses):
+        x, y, bits = VIEW_BONUS.unpack_from(data, offset)
+        offset += VIEW_BONUS.size
+        view["bonuses"].append({"x" : x, "y" : y, "bonus" : bits & 7, "visible" : bool(bits & 8)})
+    return view
+
+
+class Match(object):
+    """ 一局遊戲，clients為每個玩家的連線，還沒連上的為None """
+
+    def __init__(self, match_id, nr_of_players, seed = None, stage = 1):
+        self.match_id = match_id
+        self.nr_of_players = nr_of_players
+        if seed == None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.stage = stage
+        self.world = None
+        self.clients = [None] * nr_of_players
+        # 每個客戶端是否已經有上一次發送的狀態，沒有則下一次發送完整狀態
+        self.synced = [False] * nr_of_players
+        self.inputs = [0] * nr_of_players
+        # 上一次發送的狀態
+        self.previous = None
+
+    def full(self):
+        return None not in self.clients
+
+    def empty(self):
+        return self.clients.count(None) == len(self.clients)
+
+    def start(self):
+        """ 玩家都到齊了，開始遊戲 """
+        self.world = World(self.nr_of_players, self.seed)
+        self.world.stage = self.stage - 1
+        self.world.nextLevel()
+
+    def finished(self):
+        return self.world != None and self.world.game_over and not self.world.running
+
+    def step(self):
+        """ 推進一步，上一關已經結束則進入下一關，開火只在第一步有效 """
+        world = self.world
+        if not world.running and not world.game_over:
+            world.nextLevel()
+        world.step(World.TICK, self.inputs)
+        for i in range(len(self.inputs)):
+            self.inputs[i] &= ~World.INPUT_FIRE
+
+    def broadcast(self, limit):
+        """ 把當前狀態發給所有客戶端，發送緩衝區超過limit字節的客戶端這一次跳過 """
+        state = encodeView(self.world)
+        tick = self.world.ticks
+        delta = None
+        full = None
+        for slot, writer in enumerate(self.clients):
+            if writer == None:
+                continue
+            if writer.transport.get_write_buffer_size() > limit:
+                self.synced[slot] = False
+                continue
+            if self.synced[slot] and self.previous != None:
+                if delta == None:
+                    delta = message(MSG_SNAPSHOT, SNAPSHOT.pack(tick, 0) + zlib.compress(xorBytes(self.previous, state), 1))
+                writer.write(delta)
+            else:
+                if full == None:
+                    full = message(MSG_SNAPSHOT, SNAPSHOT.pack(tick, 1) + zlib.compress(state, 1))
+                writer.write(full)
+                self.synced[slot] = True
+        self.previous = state
+
+    def end(self):
+        """ 通知所有客戶端遊戲結束並斷開 """
+        data = message(MSG_END, END.pack(self.world.game_over, self.world.ticks))
+        for writer in self.clients:
+            if writer != None:
+                writer.write(data)
+                writer.close()
+
+
+class Worker(object):
+    """ 工作進程，運行分到這個進程的所有對局 """
+
+    # 客戶端發送緩衝區超過這個字節數時跳過發送狀態
+    WRITE_LIMIT = 64 * 1024
+    # 多少秒輸出一次統計
+    STATS_INTERVAL = 10.0
+
+    def __init__(self, index, rate):
+        self.index = index
+        self.matches = {}
+        # 每多少步發送一次狀態
+        self.snapshot_every = max(1, 1000 // World.TICK // rate)
+
+    async def handle(self, reader, writer):
+        """ 一個客戶端連線 """
+        kind, payload = await readMessage(reader)
+        if kind != MSG_ENTER or len(payload) != ENTER.size:
+            writer.close()
+            return
+        match_id, slot, nr_of_players = ENTER.unpack(payload)
+        match = self.matches.get(match_id)
+        if match == None:
+            match = Match(match_id, nr_of_players)
+            self.matches[match_id] = match
+        if slot >= match.nr_of_players or match.clients[slot] != None:
+            writer.close()
+            return
+
+        match.clients[slot] = writer
+        match.synced[slot] = False
+        writer.write(message(MSG_WELCOME, WELCOME.pack(match_id, slot, match.nr_of_players, match.seed)))
+        if match.world == None and match.full():
+            match.start()
+
+        while True:
+            kind, payload = await readMessage(reader)
+            if kind == None:
+                break
+            if kind == MSG_INPUT and len(payload) == INPUT.size:
+                mask = INPUT.unpack(payload)[0]
+                # 還沒應用的開火保留到下一步
+                match.inputs[slot] = mask | (match.inputs[slot] & World.INPUT_FIRE)
+
+        # 斷開的玩家不再有輸入，所有玩家都斷開則結束這局
+        if match.clients[slot] is writer:
+            match.clients[slot] = None
+            match.inputs[slot] = 0
+            if match.empty():
+                self.matches.pop(match_id, None)
+        writer.close()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        stats_time = next_tick
+        busy = 0.0
+        ticks = 0
+        async with server:
+            while True:
+                start = time.perf_counter()
+                for match in list(self.matches.values()):
+                    if match.world == None:
+                        continue
+                    match.step()
+                    finished = match.finished()
+                    if finished or match.world.ticks % self.snapshot_every == 0:
+                        match.broadcast(self.WRITE_LIMIT)
+                    if finished:
+                        match.end()
+                        self.matches.pop(match.match_id, None)
+                busy += time.perf_counter() - start
+                ticks += 1
+
+                now = loop.time()
+                if now - stats_time >= self.STATS_INTERVAL:
+                    if len(self.matches) > 0:
+                        print ("worker %d: %d matches, %.2f ms per tick" % (self.index, len(self.matches),
+                            busy * 1000 / max(ticks, 1)))
+                    stats_time = now
+                    busy = 0.0
+                    ticks = 0
+
+                # 落後太多時不再追趕
+                next_tick += World.TICK / 1000.0
+                if next_tick < now - 0.2:
+                    next_tick = now
+                await asyncio.sleep(max(0, next_tick - now))
+
+
+class Lobby(object):
+    """ 大廳，按玩家數把客戶端湊成對局，對局按編號分到工作進程 """
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.next_match = 1
+        # 還沒湊齊的對局，key為玩家數，值為[對局編號, 下一個玩家編號]
+        self.waiting = {}
+
+    def assign(self, nr_of_players):
+        """ 返回(工作進程端口, 對局編號, 玩家編號) """
+        waiting = self.waiting.get(nr_of_players)
+        if waiting == None:
+            waiting = [self.next_match, 0]
+            self.next_match += 1
+            self.waiting[nr_of_players] = waiting
+        match_id, slot = waiting
+        waiting[1] += 1
+        if waiting[1] >= nr_of_players:
+            del self.waiting[nr_of_players]
+        return self.ports[match_id % len(self.ports)], match_id, slot
+
+    async def handle(self, reader, writer):
+        kind, payload = await readMessage(reader)
+        if kind == MSG_JOIN and len(payload) == JOIN.size:
+            nr_of_players = min(max(JOIN.unpack(payload)[0], 1), 2)
+            writer.write(message(MSG_REDIRECT, REDIRECT.pack(*self.assign(nr_of_players))))
+            await writer.drain()
+        writer.close()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def runWorker(index, host, port, rate):
+    """ 工作進程入口 """
+    try:
+        asyncio.run(Worker(index, rate).run(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(host, port, workers, rate):
+    """ 啟動工作進程和大廳，工作進程的端口為port+1開始 """
+    ports = [port + 1 + i for i in range(workers)]
+    processes = []
+    for i in range(workers):
+        process = multiprocessing.Process(target = runWorker, args = (i, host, ports[i], rate))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    print ("Lobby on port %d, %d workers on ports %d-%d, %d snapshots per second" % (port, workers,
+        ports[0], ports[-1], rate))
+    try:
+        asyncio.run(Lobby(ports).run(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+class Client(object):
+    """ 客戶端，連上服務器後接收狀態、發送輸入 """
+
+    def __init__(self, host, port, nr_of_players = 1):
+        self.host = host
+        self.port = port
+        self.nr_of_players = nr_of_players
+        self.reader = None
+        self.writer = None
+        self.match_id = None
+        self.slot = None
+        self.seed = None
+        # 最近一次收到的狀態
+        self.state = None
+        self.state_bytes = b""
+        self.mask = 0
+        # 統計
+        self.snapshots = 0
+        self.full_bytes = 0
+        self.delta_bytes = 0
+        self.fulls = 0
+
+    async def connect(self):
+        """ 通過大廳加入一局遊戲 """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(message(MSG_JOIN, JOIN.pack(self.nr_of_players)))
+        kind, payload = await readMessage(reader)
+        writer.close()
+        if kind != MSG_REDIRECT:
+            raise ConnectionError("lobby refused to join")
+        port, match_id, slot = REDIRECT.unpack(payload)
+
+        self.reader, self.writer = await asyncio.open_connection(self.host, port)
+        self.writer.write(message(MSG_ENTER, ENTER.pack(match_id, slot, self.nr_of_players)))
+        kind, payload = await readMessage(self.reader)
+        if kind != MSG_WELCOME:
+            raise ConnectionError("match refused to join")
+        self.match_id, self.slot, self.nr_of_players, self.seed = WELCOME.unpack(payload)
+
+    def send(self, mask):
+        """ 發送輸入，方向沒變並且沒有開火時不發送 """
+        if mask == self.mask and not mask & World.INPUT_FIRE:
+            return
+        self.mask = mask & ~World.INPUT_FIRE
+        self.writer.write(message(MSG_INPUT, INPUT.pack(mask)))
+
+    async def receive(self):
+        """ 等待下一個狀態，返回decodeView()的結果，遊戲結束或斷開返回None """
+        while True:
+            kind, payload = await readMessage(self.reader)
+            if kind == MSG_SNAPSHOT:
+                tick, full = SNAPSHOT.unpack_from(payload)
+                data = zlib.decompress(payload[SNAPSHOT.size:])
+                if full:
+                    self.fulls += 1
+                    self.full_bytes += len(payload)
+                else:
+                    self.delta_bytes += len(payload)
+                    data = xorBytes(self.state_bytes, data)
+                self.state_bytes = data
+                self.state = decodeView(data)
+                self.snapshots += 1
+                return self.state
+            elif kind == MSG_END or kind == None:
+                return None
+
+    def close(self):
+        if self.writer != None:
+            self.writer.close()
+
+
+async def bot(client, seconds):
+    """ 隨機輸入的機器人客戶端：每30步換一個方向，每20步開火 """
+    rng = random.Random()
+    await client.connect()
+    end = time.monotonic() + seconds
+    direction = 0
+    last = 0
+    while time.monotonic() < end:
+        state = await client.receive()
+        if state == None:
+            break
+        tick = state["tick"]
+        if tick // 30 != last // 30:
+            direction = rng.choice((World.INPUT_UP, World.INPUT_RIGHT, World.INPUT_DOWN, World.INPUT_LEFT, 0))
+        mask = direction
+        if tick // 20 != last // 20:
+            mask |= World.INPUT_FIRE
+        last = tick
+        client.send(mask)
+    client.close()
+
+
+async def runBots(host, port, count, nr_of_players, seconds):
+    """ 同時運行count個機器人，結束後輸出收到的狀態數和大小 """
+    clients = [Client(host, port, nr_of_players) for i in range(count)]
+    await asyncio.gather(*[bot(client, seconds) for client in clients])
+    snapshots = sum(client.snapshots for client in clients)
+    fulls = sum(client.fulls for client in clients)
+    full_bytes = sum(client.full_bytes for client in clients)
+    delta_bytes = sum(client.delta_bytes for client in clients)
+    matches = len(set(client.match_id for client in clients))
+    print ("%d bots in %d matches: %d snapshots, full %.0f bytes, delta %.1f bytes on average" % (count, matches,
+        snapshots, full_bytes / max(fulls, 1), delta_bytes / max(snapshots - fulls, 1)))
+
+
+class View(object):
+    """ 用收到的狀態畫遊戲畫面，只畫地形和精靈 """
+
+    def __init__(self, screen):
+        import pygame
+        import atlas
+
+        self.pygame = pygame
+        self.screen = screen
+        atlas.load(True)
+        self.tiles = {
+            1 : atlas.image((48*2, 64*2, 8*2, 8*2)),
+            2 : atlas.image((48*2, 72*2, 8*2, 8*2)),
+            3 : atlas.image((64*2, 64*2, 8*2, 8*2)),
+            4 : atlas.image((56*2, 72*2, 8*2, 8*2)),
+            5 : atlas.image((72*2, 64*2, 8*2, 8*2)),
+        }
+        self.players = [atlas.directions(rect) for rect in atlas.PLAYER_TANKS]
+        self.enemies = [atlas.directions(rect) for rect in atlas.ENEMY_TANKS]
+        self.flash = [atlas.directions(rect) for rect in atlas.ENEMY_TANKS_FLASH]
+        self.bullets = atlas.directions(atlas.BULLET)
+        self.castle = [atlas.image(rect) for rect in atlas.CASTLE]
+        self.bonuses = [atlas.image((16*2*i, 32*2, 16*2, 15*2)) for i in range(6)]
+        self.spawn = atlas.image(atlas.SPAWN[0])
+        self.shield = atlas.image(atlas.SHIELD[0])
+        self.font = pygame.font.Font(None, 18)
+
+    def draw(self, state):
+        screen = self.screen
+        screen.fill((0, 0, 0))
+        screen.fill((100, 100, 100), (416, 0, 64, 416))
+        grass = []
+        for index, tile in enumerate(state["tiles"]):
+            if tile in self.tiles:
+                position = (index % 26 * 16, index // 26 * 16)
+                if tile == 4:
+                    grass.append(position)
+                else:
+                    screen.blit(self.tiles[tile], position)
+
+        screen.blit(self.castle[0 if state["castle"] else 1], (12*16, 24*16))
+        for i, player in enumerate(state["players"]):
+            position = (player["x"], player["y"])
+            if player["state"] == 0:
+                screen.blit(self.spawn, (player["x"] - 3, player["y"] - 3))
+            elif player["state"] == 2:
+                screen.blit(self.players[i % 2][player["direction"]], position)
+                if player["shielded"]:
+                    screen.blit(self.shield, (player["x"] - 3, player["y"] - 3))
+        for enemy in state["enemies"]:
+            position = (enemy["x"], enemy["y"])
+            if enemy["state"] == 0:
+                screen.blit(self.spawn, (enemy["x"] - 3, enemy["y"] - 3))
+            elif enemy["state"] == 2:
+                images = self.flash if enemy["bonus"] and state["tick"] // 10 % 2 else self.enemies
+                screen.blit(images[enemy["type"]][enemy["direction"]], position)
+        for bullet in state["bullets"]:
+            if bullet["state"] == 1:
+                screen.blit(self.bullets[bullet["direction"]], (bullet["x"], bullet["y"]))
+        for bonus in state["bonuses"]:
+            if bonus["visible"]:
+                screen.blit(self.bonuses[bonus["bonus"]], (bonus["x"], bonus["y"]))
+        for position in grass:
+            screen.blit(self.tiles[4], position)
+
+        texts = ["stage %d" % state["stage"], "enemies %d" % state["enemies_left"]]
+        for i, player in enumerate(state["players"]):
+            texts.append("%dP %d" % (i + 1, player["lives"]))
+            texts.append("%d" % player["score"])
+        for i, text in enumerate(texts):
+            screen.blit(self.font.render(text, True, (0, 0, 0)), (420, 20 + i * 20))
+        if state["game_over"]:
+            screen.blit(self.font.render("GAME OVER", True, (200, 60, 60)), (170, 200))
+        self.pygame.display.flip()
+
+
+async def play(host, port, nr_of_players):
+    """ 有遊戲窗口的客戶端，方向鍵移動，空格開火 """
+    import pygame
+
+    pygame.init()
+    screen = pygame.display.set_mode((480, 416))
+    pygame.display.set_caption("坦克大战")
+    view = View(screen)
+    client = Client(host, port, nr_of_players)
+    await client.connect()
+    print ("Joined match %d as player %d" % (client.match_id, client.slot + 1))
+
+    keys = [pygame.K_UP, pygame.K_RIGHT, pygame.K_DOWN, pygame.K_LEFT]
+    receiving = asyncio.ensure_future(client.receive())
+    mask = 0
+    while True:
+        fire = 0
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                client.close()
+                return
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                fire = World.INPUT_FIRE
+            elif event.type == pygame.KEYDOWN and event.key in keys:
+                mask |= 1 << keys.index(event.key)
+            elif event.type == pygame.KEYUP and event.key in keys:
+                mask &= ~(1 << keys.index(event.key))
+        client.send(mask | fire)
+
+        if receiving.done():
+            if receiving.result() == None:
+                break
+            view.draw(client.state)
+            receiving = asyncio.ensure_future(client.receive())
+        await asyncio.sleep(World.TICK / 1000.0)
+
+    if client.state != None and client.state["game_over"]:
+        print ("Game over")
+    client.close()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Authoritative game server hosting many matches.")
+    parser.add_argument("command", choices = ("serve", "play", "bots"))
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 7300, help = "lobby port")
+    parser.add_argument("--workers", type = int, default = os.cpu_count() or 1, help = "worker processes")
+    parser.add_argument("--rate", type = int, default = 10, help = "snapshots per second")
+    parser.add_argument("--players", type = int, choices = (1, 2), default = 1, help = "players per match")
+    parser.add_argument("--count", type = int, default = 20, help = "bot clients")
+    parser.add_argument("--seconds", type = float, default = 30, help = "how long the bots play")
+    options = parser.parse_args(argv)
+
+    if options.command == "serve":
+        serve(options.host, options.port, max(options.workers, 1), max(options.rate, 1))
+    elif options.command == "play":
+        asyncio.run(play(options.host, options.port, options.players))
+    else:
+        asyncio.run(runBots(options.host, options.port, options.count, options.players, options.seconds))
+
+
+if __name__ == "__main__":
+    main()
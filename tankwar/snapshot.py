@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""
+遊戲世界的二進制快照
+把一個World的全部狀態(地形、玩家基地、坦克、砲彈、寶物、得分標籤、爆炸效果、計時器、隨機數生成器)
+編碼為緊湊的字節串，解碼得到一個可以繼續推進的World，結果和原來的World完全一致
+圖像等不會改變的資源不保存，解碼時按狀態從atlas重新取得
+
+計時器的回調函數是綁定方法或者綁定方法的functools.partial，
+保存為(物體編號, 方法名, 參數)，解碼時重新綁定到解碼出來的物體上
+隨機數生成器只保存種子和已經生成了多少組隨機數，解碼時從種子重新生成
+
+兩個快照的差異為按字節異或後用zlib壓縮，相鄰兩步的快照大部分字節相同，差異很小
+
+用法：
+    data = snapshot.dumps(world)        壓縮後的完整快照
+    world = snapshot.loads(data)
+    change = snapshot.delta(snapshot.encode(old), snapshot.encode(new))
+    raw = snapshot.patch(snapshot.encode(old), change)
+"""
+import collections
+import functools
+import heapq
+import random
+import struct
+import zlib
+
+import pygame
+
+import atlas
+from BattleCity import World, Level, Castle, Tank, Player, Enemy, Bullet, Bonus, Label, Explosion, TankPath, Timer, \
+    DistanceField
+
+
+MAGIC = b"TWSS"
+VERSION = 2
+
+# 遊戲世界：標識、版本、玩家數、標誌、關卡、步數、隨機數種子、計時器時間、追擊機率、未推進的時間
+WORLD = struct.Struct("<4sBBBHIIIdH")
+(WORLD_GAME_OVER, WORLD_ACTIVE, WORLD_RUNNING, WORLD_TIMEFREEZE, WORLD_VECTOR, WORLD_LEVEL) = (1, 2, 4, 8, 16, 32)
+
+# 地圖：每行的格子數、同時最多出現的敵人數、敵方坦克出現位置數，之後是每個出現位置的格子坐標
+MAP = struct.Struct("<HHH")
+SPAWN_POINT = struct.Struct("<HH")
+
+# 隨機數生成器：方式、生成了多少組、組內位置，方式為RANDOM_FULL時之後是完整的624個狀態
+RANDOM = struct.Struct("<BII")
+(RANDOM_SEED, RANDOM_FULL, RANDOM_GAUSS) = (0, 1, 2)
+RANDOM_KEY = struct.Struct("<624I")
+GAUSS = struct.Struct("<d")
+
+# 地形圖：同時最多出現的敵人數、海水圖片、剩餘敵人數，之後是剩餘敵人類型和每個格子的地形
+LEVEL = struct.Struct("<HBH")
+# 玩家基地：狀態、是否未被消滅、爆炸效果
+CASTLE = struct.Struct("<BBH")
+# 玩家坦克、敵方坦克、砲彈、寶物、得分標籤的數量和物體總數
+LISTS = struct.Struct("<BHHBBH")
+
+# 物體類型
+(OBJECT_PLAYER, OBJECT_ENEMY, OBJECT_BULLET, OBJECT_BONUS, OBJECT_LABEL, OBJECT_EXPLOSION) = range(6)
+OBJECT = struct.Struct("<B")
+# 坦克：坐標、方向、狀態、生命值、標誌、按鍵、速度、最多砲彈數、超能力、無敵和出現效果圖片、
+# 6個計時器id、爆炸效果
+TANK = struct.Struct("<hhBBhBBBBBBBIIIIIIH")
+(TANK_PARALISED, TANK_PAUSED, TANK_SHIELDED, TANK_FLASH, TANK_FLASH_IMAGE, TANK_PATH, TANK_QUEUED) = (1, 2, 4, 8, 16, 32, 64)
+TANK_TIMERS = ("timer_uuid_spawn", "timer_uuid_spawn_end", "timer_uuid_shield", "timer_uuid_paralise",
+               "timer_uuid_fire", "timer_uuid_flash")
+# 玩家坦克：編號、出現坐標、出現方向、生命、得分、5項得分統計、吃到的寶物
+PLAYER = struct.Struct("<BffBhI5HH")
+TROPHIES = ("bonus", "enemy0", "enemy1", "enemy2", "enemy3")
+# 敵方坦克：類型、寶物(0為None，1為False，2為True)
+ENEMY = struct.Struct("<BB")
+# 移動路徑：起點、方向、距離、速度、已經走了幾步、一共幾步
+PATH = struct.Struct("<hhBHBHH")
+# 砲彈：坐標、方向、傷害、屬性、發射的坦克、類型、速度、狀態、爆炸效果
+BULLET = struct.Struct("<hhBhBHBBBH")
+# 寶物：坐標、類型、標誌
+BONUS = struct.Struct("<hhBB")
+(BONUS_ACTIVE, BONUS_VISIBLE) = (1, 2)
+# 得分標籤：坐標、是否顯示、文字長度
+LABEL = struct.Struct("<hhBB")
+# 爆炸效果：坐標、一共幾張圖片、當前第幾張、是否還在爆炸
+EXPLOSION = struct.Struct("<hhBBB")
+
+# 計時器：下一個id、計時器數量；每個計時器：id、間隔、重複次數、已調用次數、到期時間、物體、方法、參數個數
+TIMERS = struct.Struct("<IH")
+TIMER = struct.Struct("<IIhIIHBB")
+# 回調函數的參數：類型、值
+ARGUMENT = struct.Struct("<Bi")
+(ARG_INT, ARG_BOOL, ARG_REF, ARG_NONE) = range(4)
+# 計時器可以調用的方法
+METHODS = ("destroy", "update", "toggleWaves", "toggleSpawnImage", "endSpawning", "fire", "toggleFlash",
+           "toggleShieldImage", "setParalised", "toggleVisibility", "spawnEnemy", "stop", "shieldPlayer",
+           "buildFortress", "toggleEnemyFreeze")
+
+# 固定的物體編號，其餘物體從FIRST_OBJECT開始編號
+(REF_WORLD, REF_LEVEL, REF_CASTLE) = range(3)
+FIRST_OBJECT = 3
+NO_REF = 0xffff
+
+# 搜索隨機數生成器位置時最多生成多少組隨機數，超過則保存完整狀態
+MAX_TWISTS = 1 << 16
+
+# 每個種子生成過的每一組隨機數的前4個數，key為種子，最多保存RANDOM_CACHE個種子
+RANDOM_CACHE = 64
+twists = collections.OrderedDict()
+
+
+def randomPosition(rng, seed):
+    """
+    rng從種子seed開始生成了幾組隨機數(每組624個)，返回(組數, 組內位置)，找不到返回None
+    每個種子的搜索結果保存下來，下次從上次的位置繼續搜索
+    """
+    version, state, gauss = rng.getstate()
+    key = state[:4]
+    cache = twists.get(seed)
+    if cache == None:
+        shadow = random.Random(seed)
+        cache = [shadow, {shadow.getstate()[1][:4] : 0}, 0]
+        twists[seed] = cache
+        if len(twists) > RANDOM_CACHE:
+            twists.popitem(False)
+    else:
+        twists.move_to_end(seed)
+
+    shadow, keys, count = cache
+    while key not in keys and count < MAX_TWISTS:
+        shadow.getrandbits(32 * 624)
+        count += 1
+        keys[shadow.getstate()[1][:4]] = count
+    cache[2] = count
+    if key not in keys:
+        return None
+    return keys[key], state[624]
+
+
+def restoreRandom(rng, seed, count, index):
+    """ 從種子重新生成count組隨機數，組內位置設為index """
+    rng.seed(seed)
+    for i in range(count):
+        rng.getrandbits(32 * 624)
+    version, state, gauss = rng.getstate()
+    rng.setstate((version, state[:624] + (index,), None))
+
+
+def flashImages(enemy):
+    """ 帶寶物的敵方坦克閃爍時的圖片 """
+    return (enemy.image2_up, enemy.image2_right, enemy.image2_down, enemy.image2_left)
+
+
+class Encoder(object):
+    """ 把一個World編碼為字節串 """
+
+    def __init__(self, world):
+        self.world = world
+        # 需要保存的物體，按編號排列
+        self.objects = []
+        self.refs = {id(world) : REF_WORLD, id(world.castle) : REF_CASTLE}
+        if world.level != None:
+            self.refs[id(world.level)] = REF_LEVEL
+
+    def ref(self, obj):
+        """ 物體的編號，第一次遇到時分配編號 """
+        if obj is None:
+            return NO_REF
+        ref = self.refs.get(id(obj))
+        if ref == None:
+            ref = FIRST_OBJECT + len(self.objects)
+            if ref >= NO_REF:
+                raise ValueError("too many objects to save")
+            self.refs[id(obj)] = ref
+            self.objects.append(obj)
+        return ref
+
+    def encode(self):
+        world = self.world
+        level = world.level
+
+        flags = 0
+        for flag, value in ((WORLD_GAME_OVER, world.game_over), (WORLD_ACTIVE, world.active),
+                            (WORLD_RUNNING, world.running), (WORLD_TIMEFREEZE, world.timefreeze),
+                            (WORLD_VECTOR, world.bullet_manager != None), (WORLD_LEVEL, level != None)):
+            if value:
+                flags |= flag
+        data = [WORLD.pack(MAGIC, VERSION, world.nr_of_players, flags, world.stage, world.ticks, world.seed,
+            world.timer.time, world.aggression, world.accumulator)]
+        data.append(MAP.pack(world.grid_size, world.max_active_enemies, len(world.spawn_points)))
+        data += [SPAWN_POINT.pack(x, y) for x, y in world.spawn_points]
+        data.append(self.encodeRandom())
+
+        if level != None:
+            data.append(LEVEL.pack(level.max_active_enemies, level.tile_water is level.tile_water2,
+                len(level.enemies_left)))
+            data.append(bytes(level.enemies_left))
+            data.append(bytes(level.tiles))
+
+        # 列表中的物體先編號，編號就是在列表中的順序
+        lists = (world.players, world.enemies, world.bullets, world.bonuses, world.labels)
+        for objects in lists:
+            for obj in objects:
+                self.ref(obj)
+
+        castle = world.castle
+        data.append(CASTLE.pack(castle.state, castle.active, self.ref(getattr(castle, "explosion", None))))
+        timers = self.encodeTimers()
+
+        # 編碼物體時可能遇到新的物體，比如砲彈的發射者已經不在敵方坦克列表中
+        encoded = []
+        i = 0
+        while i < len(self.objects):
+            encoded.append(self.encodeObject(self.objects[i]))
+            i += 1
+
+        data.append(LISTS.pack(*([len(objects) for objects in lists] + [len(self.objects)])))
+        data += encoded
+        data.append(timers)
+        return b"".join(data)
+
+    def encodeRandom(self):
+        world = self.world
+        version, state, gauss = world.random.getstate()
+        mode = 0
+        position = randomPosition(world.random, world.seed)
+        if position == None:
+            mode |= RANDOM_FULL
+            position = (0, state[624])
+        if gauss != None:
+            mode |= RANDOM_GAUSS
+        data = RANDOM.pack(mode, position[0], position[1])
+        if mode & RANDOM_FULL:
+            data += RANDOM_KEY.pack(*state[:624])
+        if gauss != None:
+            data += GAUSS.pack(gauss)
+        return data
+
+    def encodeTimers(self):
+        timer = self.world.timer
+        data = [TIMERS.pack(timer.next_id, len(timer.timers))]
+        for timer_id in sorted(timer.timers):
+            t = timer.timers[timer_id]
+            callback = t["callback"]
+            args = ()
+            if isinstance(callback, functools.partial):
+                if callback.keywords:
+                    raise ValueError("timer callback %r can't be saved" % (callback,))
+                args = callback.args
+                callback = callback.func
+            name = getattr(callback, "__name__", None)
+            if not hasattr(callback, "__self__") or name not in METHODS:
+                raise ValueError("timer callback %r can't be saved" % (callback,))
+            data.append(TIMER.pack(t["id"], t["interval"], t["repeat"], t["times"], t["due"],
+                self.ref(callback.__self__), METHODS.index(name), len(args)))
+            for arg in args:
+                if arg is None:
+                    data.append(ARGUMENT.pack(ARG_NONE, 0))
+                elif isinstance(arg, bool):
+                    data.append(ARGUMENT.pack(ARG_BOOL, arg))
+                elif isinstance(arg, int):
+                    data.append(ARGUMENT.pack(ARG_INT, arg))
+                else:
+                    data.append(ARGUMENT.pack(ARG_REF, self.ref(arg)))
+        return b"".join(data)
+
+    def encodeObject(self, obj):
+        if isinstance(obj, Tank):
+            return self.encodeTank(obj)
+        elif isinstance(obj, Bullet):
+            return OBJECT.pack(OBJECT_BULLET) + BULLET.pack(obj.rect.left, obj.rect.top, obj.direction, obj.damage,
+                255 if obj.owner == None else obj.owner, self.ref(obj.owner_class), obj.power, obj.speed,
+                obj.state, self.ref(getattr(obj, "explosion", None)))
+        elif isinstance(obj, Bonus):
+            flags = (BONUS_ACTIVE if obj.active else 0) | (BONUS_VISIBLE if obj.visible else 0)
+            return OBJECT.pack(OBJECT_BONUS) + BONUS.pack(obj.rect.left, obj.rect.top, obj.bonus, flags)
+        elif isinstance(obj, Label):
+            text = obj.text.encode("utf-8")
+            return OBJECT.pack(OBJECT_LABEL) + LABEL.pack(obj.position[0], obj.position[1], obj.active,
+                len(text)) + text
+        elif isinstance(obj, Explosion):
+            frames = atlas.frames(atlas.EXPLOSION)
+            current = frames.index(obj.image)
+            return OBJECT.pack(OBJECT_EXPLOSION) + EXPLOSION.pack(obj.position[0], obj.position[1],
+                current + 1 + len(obj.images), current, obj.active)
+        raise ValueError("%r can't be saved" % (obj,))
+
+    def encodeTank(self, tank):
+        flags = 0
+        for flag, value in ((TANK_PARALISED, tank.paralised), (TANK_PAUSED, tank.paused),
+                            (TANK_SHIELDED, tank.shielded), (TANK_FLASH, tank.flash),
+                            (TANK_FLASH_IMAGE, tank.bonus == True and tank.image in flashImages(tank)),
+                            (TANK_PATH, hasattr(tank, "path")), (TANK_QUEUED, getattr(tank, "bullet_queued", False))):
+            if value:
+                flags |= flag
+        pressed = 0
+        for i in range(4):
+            if tank.pressed[i]:
+                pressed |= 1 << i
+        timers = [getattr(tank, name, 0) for name in TANK_TIMERS]
+        data = TANK.pack(tank.rect.left, tank.rect.top, tank.direction, tank.state, tank.health, flags, pressed,
+            tank.speed, tank.max_active_bullets, tank.superpowers, tank.shield_index, tank.spawn_index,
+            *(timers + [self.ref(getattr(tank, "explosion", None))]))
+
+        if isinstance(tank, Player):
+            trophies = [tank.trophies[name] for name in TROPHIES]
+            return OBJECT.pack(OBJECT_PLAYER) + data + PLAYER.pack(self.world.players.index(tank),
+                tank.start_position[0], tank.start_position[1], tank.start_direction, tank.lives, tank.score,
+                *(trophies + [self.ref(tank.bonus)]))
+
+        bonus = 0 if tank.bonus == None else 1 + bool(tank.bonus)
+        data = OBJECT.pack(OBJECT_ENEMY) + data + ENEMY.pack(tank.type, bonus)
+        if hasattr(tank, "path"):
+            path = tank.path
+            direction = DistanceField.OFFSETS.index((path.dx, path.dy))
+            data += PATH.pack(path.x, path.y, direction, path.pixels, path.speed, path.index, path.length)
+        return data
+
+
+class Decoder(object):
+    """ 把字節串解碼為World """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt):
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def readBytes(self, count):
+        data = self.data[self.offset:self.offset + count]
+        self.offset += count
+        return data
+
+    def decode(self):
+        if len(self.data) < WORLD.size:
+            raise ValueError("not a snapshot")
+        (magic, version, nr_of_players, flags, stage, ticks, seed, timer_time,
+         aggression, accumulator) = self.read(WORLD)
+        if magic != MAGIC:
+            raise ValueError("not a snapshot")
+        if version != VERSION:
+            raise ValueError("unsupported snapshot version %d" % version)
+
+        grid_size, max_active_enemies, nr_spawn_points = self.read(MAP)
+        spawn_points = [self.read(SPAWN_POINT) for i in range(nr_spawn_points)]
+        world = World(nr_of_players, seed, bool(flags & WORLD_VECTOR), grid_size, spawn_points, max_active_enemies)
+        self.world = world
+        world.stage = stage
+        world.ticks = ticks
+        world.aggression = aggression
+        world.accumulator = accumulator
+        world.game_over = bool(flags & WORLD_GAME_OVER)
+        world.active = bool(flags & WORLD_ACTIVE)
+        world.running = bool(flags & WORLD_RUNNING)
+        world.timefreeze = bool(flags & WORLD_TIMEFREEZE)
+        self.decodeRandom()
+
+        if flags & WORLD_LEVEL:
+            max_active_enemies, water, enemies_left = self.read(LEVEL)
+            # 創建地形圖時添加的計時器之後被替換掉
+            level = Level(world, stage)
+            level.max_active_enemies = max_active_enemies
+            level.enemies_left = list(self.readBytes(enemies_left))
+            level.tiles = list(self.readBytes(level.grid_size * level.grid_size))
+            level.updateObstacleRects()
+            level.tile_water = level.tile_water2 if water else level.tile_water1
+            world.level = level
+
+        castle_state, castle_active, castle_explosion = self.read(CASTLE)
+        nr_players, nr_enemies, nr_bullets, nr_bonuses, nr_labels, nr_objects = self.read(LISTS)
+
+        # 先讀出所有物體的數據，再創建物體，最後填入屬性，物體之間可以互相引用
+        records = [self.readObject() for i in range(nr_objects)]
+        self.objects = [None] * FIRST_OBJECT + [self.create(record) for record in records]
+        self.objects[REF_WORLD] = world
+        self.objects[REF_LEVEL] = world.level
+        self.objects[REF_CASTLE] = world.castle
+        for obj, record in zip(self.objects[FIRST_OBJECT:], records):
+            self.fill(obj, record)
+
+        objects = self.objects[FIRST_OBJECT:]
+        start = 0
+        for objects_list, count in ((world.players, nr_players), (world.enemies, nr_enemies),
+                                    (world.bullets, nr_bullets), (world.bonuses, nr_bonuses),
+                                    (world.labels, nr_labels)):
+            objects_list[:] = objects[start:start + count]
+            start += count
+
+        castle = world.castle
+        castle.state = castle_state
+        castle.active = bool(castle_active)
+        castle.image = castle.img_undamaged if castle_state == Castle.STATE_STANDING else castle.img_destroyed
+        if castle_explosion != NO_REF:
+            castle.explosion = self.objects[castle_explosion]
+
+        self.decodeTimers(timer_time)
+        return world
+
+    def decodeRandom(self):
+        world = self.world
+        mode, count, index = self.read(RANDOM)
+        if mode & RANDOM_FULL:
+            key = self.read(RANDOM_KEY)
+            world.random.setstate((3, key + (index,), None))
+        else:
+            restoreRandom(world.random, world.seed, count, index)
+        if mode & RANDOM_GAUSS:
+            version, state, gauss = world.random.getstate()
+            world.random.setstate((version, state, self.read(GAUSS)[0]))
+
+    def decodeTimers(self, time):
+        timer = Timer()
+        timer.time = time
+        timer.next_id, count = self.read(TIMERS)
+        for i in range(count):
+            timer_id, interval, repeat, times, due, ref, method, nr_args = self.read(TIMER)
+            args = []
+            for j in range(nr_args):
+                kind, value = self.read(ARGUMENT)
+                if kind == ARG_BOOL:
+                    args.append(bool(value))
+                elif kind == ARG_REF:
+                    args.append(self.objects[value])
+                elif kind == ARG_NONE:
+                    args.append(None)
+                else:
+                    args.append(value)
+            callback = getattr(self.objects[ref], METHODS[method])
+            if len(args) > 0:
+                callback = functools.partial(callback, *args)
+            timer.timers[timer_id] = {
+                "interval" : interval,
+                "callback" : callback,
+                "repeat" : repeat,
+                "times" : times,
+                "due" : due,
+                "id" : timer_id,
+            }
+            timer.queue.append((due, timer_id))
+        heapq.heapify(timer.queue)
+        self.world.timer = timer
+
+    def readObject(self):
+        """ 讀出一個物體的類型和數據 """
+        kind = self.read(OBJECT)[0]
+        if kind == OBJECT_PLAYER:
+            return kind, self.read(TANK), self.read(PLAYER)
+        elif kind == OBJECT_ENEMY:
+            tank = self.read(TANK)
+            enemy = self.read(ENEMY)
+            path = self.read(PATH) if tank[5] & TANK_PATH else None
+            return kind, tank, enemy, path
+        elif kind == OBJECT_BULLET:
+            return kind, self.read(BULLET)
+        elif kind == OBJECT_BONUS:
+            return kind, self.read(BONUS)
+        elif kind == OBJECT_LABEL:
+            label = self.read(LABEL)
+            return kind, label, self.readBytes(label[3]).decode("utf-8")
+        elif kind == OBJECT_EXPLOSION:
+            return kind, self.read(EXPLOSION)
+        raise ValueError("unknown object type %d" % kind)
+
+    def create(self, record):
+        """ 創建物體但不調用__init__，__init__會添加計時器和使用隨機數 """
+        cls = (Player, Enemy, Bullet, Bonus, Label, Explosion)[record[0]]
+        return cls.__new__(cls)
+
+    def ref(self, value):
+        if value == NO_REF:
+            return None
+        return self.objects[value]
+
+    def fill(self, obj, record):
+        world = self.world
+        kind = record[0]
+        if kind in (OBJECT_PLAYER, OBJECT_ENEMY):
+            self.fillTank(obj, record)
+        elif kind == OBJECT_BULLET:
+            x, y, direction, damage, owner, owner_class, power, speed, state, explosion = record[1]
+            obj.level = world.level
+            obj.world = world
+            obj.direction = direction
+            obj.damage = damage
+            obj.owner = None if owner == 255 else owner
+            obj.owner_class = self.ref(owner_class)
+            obj.power = power
+            obj.image = atlas.directions(atlas.BULLET)[direction]
+            if direction in (Bullet.DIR_UP, Bullet.DIR_DOWN):
+                obj.rect = pygame.Rect(x, y, 6, 8)
+            else:
+                obj.rect = pygame.Rect(x, y, 8, 6)
+            obj.explosion_images = atlas.frames(atlas.EXPLOSION[:2])
+            obj.speed = speed
+            obj.state = state
+            if explosion != NO_REF:
+                obj.explosion = self.objects[explosion]
+        elif kind == OBJECT_BONUS:
+            x, y, bonus, flags = record[1]
+            obj.level = world.level
+            obj.active = bool(flags & BONUS_ACTIVE)
+            obj.visible = bool(flags & BONUS_VISIBLE)
+            obj.rect = pygame.Rect(x, y, 32, 32)
+            obj.bonus = bonus
+            obj.image = atlas.image((16*2*bonus, 32*2, 16*2, 15*2))
+        elif kind == OBJECT_LABEL:
+            x, y, active, length = record[1]
+            obj.world = world
+            obj.position = (x, y)
+            obj.active = bool(active)
+            obj.text = record[2]
+        elif kind == OBJECT_EXPLOSION:
+            x, y, count, current, active = record[1]
+            obj.world = world
+            obj.position = [x, y]
+            obj.active = bool(active)
+            frames = atlas.frames(atlas.EXPLOSION[:count])
+            obj.image = frames[current]
+            obj.images = frames[current + 1:][::-1]
+
+    def fillTank(self, tank, record):
+        world = self.world
+        (x, y, direction, state, health, flags, pressed, speed, max_active_bullets, superpowers,
+         shield_index, spawn_index) = record[1][:12]
+        timers = record[1][12:18]
+        explosion = record[1][18]
+
+        tank.health = health
+        tank.paralised = bool(flags & TANK_PARALISED)
+        tank.paused = bool(flags & TANK_PAUSED)
+        tank.shielded = bool(flags & TANK_SHIELDED)
+        tank.speed = speed
+        tank.max_active_bullets = max_active_bullets
+        tank.flash = bool(flags & TANK_FLASH)
+        tank.superpowers = superpowers
+        tank.pressed = [bool(pressed & 1 << i) for i in range(4)]
+        tank.shield_images = atlas.frames(atlas.SHIELD)
+        tank.shield_index = shield_index
+        tank.shield_image = tank.shield_images[shield_index]
+        tank.spawn_images = atlas.frames(atlas.SPAWN)
+        tank.spawn_index = spawn_index
+        tank.spawn_image = tank.spawn_images[spawn_index]
+        tank.level = world.level
+        tank.world = world
+        tank.rect = pygame.Rect(x, y, 26, 26)
+        tank.direction = direction
+        tank.state = state
+        for name, timer_id in zip(TANK_TIMERS, timers):
+            if timer_id != 0:
+                setattr(tank, name, timer_id)
+        if explosion != NO_REF:
+            tank.explosion = self.objects[explosion]
+
+        if record[0] == OBJECT_PLAYER:
+            index, start_x, start_y, start_direction, lives, score = record[2][:6]
+            trophies = record[2][6:11]
+            tank.side = Tank.SIDE_PLAYER
+            tank.controls = Player.CONTROLS[index % len(Player.CONTROLS)][:]
+            tank.bonus = self.ref(record[2][11])
+            tank.start_position = [start_x, start_y]
+            tank.start_direction = start_direction
+            tank.lives = lives
+            tank.score = score
+            tank.trophies = dict(zip(TROPHIES, trophies))
+            images = atlas.directions(atlas.PLAYER_TANKS[index % len(atlas.PLAYER_TANKS)])
+            tank.image_up, tank.image_right, tank.image_down, tank.image_left = images
+            tank.image = images[direction]
+            return
+
+        enemy_type, bonus = record[2]
+        tank.side = Tank.SIDE_ENEMY
+        tank.controls = Player.CONTROLS[0][:]
+        tank.bullet_queued = bool(flags & TANK_QUEUED)
+        tank.type = enemy_type
+        tank.bonus = (None, False, True)[bonus]
+        images = atlas.directions(atlas.ENEMY_TANKS[enemy_type])
+        tank.image_up, tank.image_right, tank.image_down, tank.image_left = images
+        if tank.bonus:
+            tank.image1_up, tank.image1_right, tank.image1_down, tank.image1_left = images
+            flash = atlas.directions(atlas.ENEMY_TANKS_FLASH[enemy_type])
+            tank.image2 = flash[Tank.DIR_UP]
+            tank.image2_up, tank.image2_right, tank.image2_down, tank.image2_left = flash
+            if tank.flash:
+                tank.image_up, tank.image_right, tank.image_down, tank.image_left = flash
+            if flags & TANK_FLASH_IMAGE:
+                images = flash
+        tank.image = images[direction]
+
+        path = record[3]
+        if path != None:
+            px, py, path_direction, pixels, path_speed, index, length = path
+            tank.path = TankPath(px, py, path_direction, pixels, path_speed)
+            tank.path.index = index
+            tank.path.length = length
+
+
+def encode(world):
+    """ 完整快照，未壓縮 """
+    return Encoder(world).encode()
+
+
+def decode(data):
+    """ 從未壓縮的完整快照創建World """
+    return Decoder(data).decode()
+
+
+def dumps(world):
+    """ 壓縮後的完整快照 """
+    return zlib.compress(encode(world), 9)
+
+
+def loads(data):
+    return decode(zlib.decompress(data))
+
+
+def xorBytes(a, b):
+    """ 兩個字節串按字節異或，長度不同時短的補0，結果和b一樣長 """
+    a = a[:len(b)].ljust(len(b), b"\0")
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(b), "little")
+
+
+def delta(old, new):
+    """ 從未壓縮的快照old到new的差異，差異很小，不要zlib的文件頭和校驗和 """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(xorBytes(old, new)) + compressor.flush()
+
+
+def patch(old, change):
+    """ 把delta()得到的差異應用到未壓縮的快照old上，返回新的未壓縮快照 """
+    return xorBytes(old, zlib.decompress(change, -15))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+文字資源
+字體按文件或系統字體名和大小只加載一次，所有地方共用同一個字體對象
+渲染出來的文字圖像按(字體, 文字, 顏色, 是否抗鋸齒)保存在LRU緩存中，
+側邊欄、得分標籤、計分頁面等內容不變的文字每幀直接從緩存中取出，不用重新渲染
+"""
+import collections
+import os
+
+import pygame
+
+
+# 緩存最多保存多少個文字圖像，超出時丟棄最久沒用過的
+CACHE_SIZE = 256
+
+# 已加載的字體，key為(文件名或系統字體名, 大小, 是否系統字體)
+fonts = {}
+# 渲染出來的文字圖像，最近用過的在最後
+surfaces = collections.OrderedDict()
+# 緩存命中和未命中的次數
+hits = 0
+misses = 0
+
+
+def font(filename = None, size = 16):
+    """ 字體文件，文件不存在時使用pygame默認字體 """
+    if filename != None and not os.path.isfile(filename):
+        filename = None
+    key = (filename, size, False)
+    result = fonts.get(key)
+    if result == None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        result = pygame.font.Font(filename, size)
+        fonts[key] = result
+    return result
+
+
+def sysFont(name, size):
+    """ 系統字體，查找字體文件很慢，每種字體只查找一次 """
+    key = (name, size, True)
+    result = fonts.get(key)
+    if result == None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        result = pygame.font.SysFont(name, size)
+        fonts[key] = result
+    return result
+
+
+def render(font, text, color, antialias = False):
+    """ 渲染文字，同樣的文字只渲染一次，返回的圖像是共用的，不能修改 """
+    global hits, misses
+
+    key = (font, text, tuple(color), antialias)
+    surface = surfaces.get(key)
+    if surface != None:
+        hits += 1
+        surfaces.move_to_end(key)
+        return surface
+
+    misses += 1
+    surface = font.render(text, antialias, color)
+    surfaces[key] = surface
+    if len(surfaces) > CACHE_SIZE:
+        surfaces.popitem(last = False)
+    return surface
+
+
+def stats():
+    """ 緩存命中和未命中的次數，以及緩存中的文字圖像數 """
+    return {"hits" : hits, "misses" : misses, "cached" : len(surfaces)}
+
+
+def clear():
+    """ 清空緩存和計數，字體保留 """
+    global hits, misses
+    surfaces.clear()
+    hits = 0
+    misses = 0
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+AI策略的批量對戰，不需要顯示器
+每一局從指定的關卡開始，用玩家策略控制玩家坦克、用敵人策略設置敵方坦克，玩到過關、遊戲結束或超時
+對局分到多個進程並行運行，每局的結果一完成就寫到JSON Lines文件中，中斷後再運行會跳過已經完成的對局
+最後統計每一關和全部對局的過關率、基地被毀率、過關時間和得分分布
+
+策略可以是內置的名稱，也可以是"模塊:函數"：
+    玩家策略 policy(world, index, rng, memory)，返回第index個玩家這一步的輸入位掩碼(World.INPUT_*)，
+            memory是這個玩家在這一局中專用的dict
+    敵人策略 policy(world)，在關卡開始前設置World，比如World.aggression
+
+用法：
+    python tournament.py [--matches 1000] [--stages 1-35] [--players 1] [--player-policy hunter]
+                         [--enemy-policy random] [--processes CPU數] [--max-seconds 300] [--seed 0]
+                         [--output tournament.jsonl] [--summary-only]
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import time
+
+# 沒有顯示器也能加載圖像
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from BattleCity import World
+
+
+DIRECTIONS = (World.INPUT_UP, World.INPUT_RIGHT, World.INPUT_DOWN, World.INPUT_LEFT)
+
+
+def idlePlayer(world, index, rng, memory):
+    """ 不動也不開火 """
+    return 0
+
+
+def randomPlayer(world, index, rng, memory):
+    """ 每30步隨機換一個方向，每20步開火，不朝自己的基地開火 """
+    ticks = memory.get("ticks", 0)
+    memory["ticks"] = ticks + 1
+    if ticks % 30 == 0:
+        memory["direction"] = rng.choice(DIRECTIONS + (0,))
+    mask = memory["direction"]
+    if ticks % 20 == 0 and mask != 0:
+        mask = aim(world, world.players[index], mask)
+    return mask
+
+
+def castleInLine(world, player, direction):
+    """ 朝direction開火會不會打到自己的基地 """
+    castle = world.castle.rect
+    rect = player.rect
+    if direction == World.INPUT_DOWN:
+        return castle.left < rect.right and rect.left < castle.right and castle.top >= rect.bottom
+    if direction == World.INPUT_UP:
+        return castle.left < rect.right and rect.left < castle.right and castle.bottom <= rect.top
+    if direction == World.INPUT_RIGHT:
+        return castle.top < rect.bottom and rect.top < castle.bottom and castle.left >= rect.right
+    return castle.top < rect.bottom and rect.top < castle.bottom and castle.right <= rect.left
+
+
+def aim(world, player, direction):
+    """ 轉向direction，不會打到自己的基地就開火 """
+    if castleInLine(world, player, direction):
+        return direction
+    return direction | World.INPUT_FIRE
+
+
+def hunterPlayer(world, index, rng, memory):
+    """
+    追擊最近的敵方坦克：和目標在同一行或同一列時轉向目標並開火，否則朝目標移動
+    被擋住時隨機換一個方向走一會兒
+    """
+    player = world.players[index]
+    if player.state != player.STATE_ALIVE:
+        return 0
+
+    position = player.rect.topleft
+    if memory.get("position") == position:
+        memory["stuck"] = memory.get("stuck", 0) + 1
+    else:
+        memory["stuck"] = 0
+    memory["position"] = position
+
+    if memory.get("detour", 0) > 0:
+        memory["detour"] -= 1
+        return aim(world, player, memory["detour_direction"])
+    if memory["stuck"] > 5:
+        memory["detour"] = rng.randint(10, 40)
+        memory["detour_direction"] = rng.choice(DIRECTIONS)
+        return memory["detour_direction"]
+
+    target = None
+    best = None
+    for enemy in world.enemies:
+        if enemy.state == enemy.STATE_ALIVE:
+            distance = abs(enemy.rect.centerx - player.rect.centerx) + abs(enemy.rect.centery - player.rect.centery)
+            if best == None or distance < best:
+                target = enemy
+                best = distance
+    if target == None:
+        return 0
+
+    dx = target.rect.centerx - player.rect.centerx
+    dy = target.rect.centery - player.rect.centery
+    if abs(dx) < 8:
+        return aim(world, player, World.INPUT_DOWN if dy > 0 else World.INPUT_UP)
+    if abs(dy) < 8:
+        return aim(world, player, World.INPUT_RIGHT if dx > 0 else World.INPUT_LEFT)
+    # 先縮小距離較小的方向，早點對齊
+    if abs(dx) < abs(dy):
+        return World.INPUT_RIGHT if dx > 0 else World.INPUT_LEFT
+    return World.INPUT_DOWN if dy > 0 else World.INPUT_UP
+
+
+def randomEnemies(world):
+    """ 原版的敵方坦克，隨機移動 """
+    world.aggression = 0.0
+
+
+def mixedEnemies(world):
+    """ 一半時間按距離場追擊 """
+    world.aggression = 0.5
+
+
+def chasingEnemies(world):
+    """ 一直按距離場追擊玩家基地或玩家坦克 """
+    world.aggression = 1.0
+
+
+PLAYER_POLICIES = {
+    "idle" : idlePlayer,
+    "random" : randomPlayer,
+    "hunter" : hunterPlayer,
+}
+
+ENEMY_POLICIES = {
+    "random" : randomEnemies,
+    "mixed" : mixedEnemies,
+    "chase" : chasingEnemies,
+}
+
+
+def loadPolicy(name, builtin):
+    """ 內置策略的名稱或者"模塊:函數" """
+    if name in builtin:
+        return builtin[name]
+    if ":" not in name:
+        raise ValueError("unknown policy %r" % name)
+    module, function = name.split(":", 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def parseStages(text):
+    """ "1-35"、"1,3,5"或者"2-4,10" """
+    stages = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            stages.extend(range(int(first), int(last) + 1))
+        else:
+            stages.append(int(part))
+    return stages
+
+
+def matchSpec(options, match_id):
+    """ 第match_id局的設置，只由編號決定，中斷後再運行得到一樣的對局 """
+    return {
+        "id" : match_id,
+        "stage" : options.stages[match_id % len(options.stages)],
+        "seed" : (options.seed * 1000003 + match_id) & 0xffffffff,
+        "players" : options.players,
+        "player_policy" : options.player_policy,
+        "enemy_policy" : options.enemy_policy,
+        "max_ticks" : int(options.max_seconds * 1000 / World.TICK),
+    }
+
+
+def playMatch(spec):
+    """ 玩一局，返回結果，在工作進程中運行 """
+    player_policy = loadPolicy(spec["player_policy"], PLAYER_POLICIES)
+    enemy_policy = loadPolicy(spec["enemy_policy"], ENEMY_POLICIES)
+
+    start = time.perf_counter()
+    world = World(spec["players"], spec["seed"])
+    enemy_policy(world)
+    world.stage = spec["stage"] - 1
+    world.nextLevel()
+
+    rng = random.Random(spec["seed"])
+    memories = [{} for player in world.players]
+    inputs = [0] * len(world.players)
+    cleared_tick = None
+    while world.ticks < spec["max_ticks"]:
+        for i in range(len(inputs)):
+            inputs[i] = player_policy(world, i, rng, memories[i])
+        world.step(World.TICK, inputs)
+        # 消滅了所有敵人，或者遊戲結束，不用等關卡結束的3秒
+        if cleared_tick == None and not world.active:
+            cleared_tick = world.ticks
+        if world.game_over or cleared_tick != None:
+            break
+
+    if world.game_over:
+        outcome = "castle" if not world.castle.active else "lives"
+    elif cleared_tick != None:
+        outcome = "clear"
+    else:
+        outcome = "timeout"
+
+    kills = 0
+    for player in world.players:
+        for kind in range(4):
+            kills += player.trophies["enemy" + str(kind)]
+
+    result = dict(spec)
+    result.update({
+        "outcome" : outcome,
+        "ticks" : world.ticks,
+        "seconds" : world.ticks * World.TICK / 1000.0,
+        "score" : sum(player.score for player in world.players),
+        "kills" : kills,
+        "lives" : sum(max(player.lives, 0) for player in world.players),
+        "wall_seconds" : round(time.perf_counter() - start, 4),
+    })
+    return result
+
+
+def readResults(filename):
+    """ 讀取已經完成的對局，中斷時寫了一半的行忽略 """
+    results = []
+    if not os.path.isfile(filename):
+        return results
+    f = open(filename, "r")
+    try:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                pass
+    finally:
+        f.close()
+    return results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(results):
+    """ 按關卡和全部對局統計 """
+    groups = {}
+    for result in results:
+        groups.setdefault(result["stage"], []).append(result)
+    groups["all"] = results
+
+    summary = {}
+    for key, group in groups.items():
+        count = len(group)
+        outcomes = {}
+        for result in group:
+            outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+        clear_times = [result["seconds"] for result in group if result["outcome"] == "clear"]
+        scores = [result["score"] for result in group]
+        summary[key] = {
+            "matches" : count,
+            "win_rate" : round(outcomes.get("clear", 0) / float(count), 4),
+            "castle_loss_rate" : round(outcomes.get("castle", 0) / float(count), 4),
+            "lives_out_rate" : round(outcomes.get("lives", 0) / float(count), 4),
+            "timeout_rate" : round(outcomes.get("timeout", 0) / float(count), 4),
+            "clear_seconds" : None if len(clear_times) == 0 else {
+                "mean" : round(sum(clear_times) / len(clear_times), 2),
+                "p50" : percentile(clear_times, 50),
+                "p90" : percentile(clear_times, 90),
+            },
+            "score" : {
+                "mean" : round(sum(scores) / float(count), 1),
+                "p10" : percentile(scores, 10),
+                "p50" : percentile(scores, 50),
+                "p90" : percentile(scores, 90),
+                "max" : max(scores),
+            },
+        }
+    return summary
+
+
+def printSummary(summary):
+    print ("%-6s %8s %7s %7s %7s %7s %9s %9s" % ("stage", "matches", "win", "castle", "lives", "timeout",
+        "clear p50", "score p50"))
+    keys = sorted(key for key in summary if key != "all") + ["all"]
+    for key in keys:
+        row = summary[key]
+        clear = "-" if row["clear_seconds"] == None else "%.1fs" % row["clear_seconds"]["p50"]
+        print ("%-6s %8d %6.1f%% %6.1f%% %6.1f%% %6.1f%% %9s %9d" % (key, row["matches"], row["win_rate"] * 100,
+            row["castle_loss_rate"] * 100, row["lives_out_rate"] * 100, row["timeout_rate"] * 100, clear,
+            row["score"]["p50"]))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Play batches of headless matches between AI policies.")
+    parser.add_argument("--matches", type = int, default = 1000, help = "total matches in the sweep")
+    parser.add_argument("--stages", type = parseStages, default = parseStages("1-35"), help = "e.g. 1-35 or 1,5,10")
+    parser.add_argument("--players", type = int, choices = (1, 2), default = 1)
+    parser.add_argument("--player-policy", default = "hunter",
+        help = "%s or module:function" % "/".join(sorted(PLAYER_POLICIES)))
+    parser.add_argument("--enemy-policy", default = "random",
+        help = "%s or module:function" % "/".join(sorted(ENEMY_POLICIES)))
+    parser.add_argument("--processes", type = int, default = os.cpu_count() or 1)
+    parser.add_argument("--max-seconds", type = float, default = 300, help = "game time before a match times out")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = "tournament.jsonl", help = "results, one JSON object per line")
+    parser.add_argument("--summary-only", action = "store_true", help = "only summarize the existing results")
+    options = parser.parse_args(argv)
+    options.output = os.path.abspath(options.output)
+
+    # 提前檢查策略名稱，不要等到工作進程中才出錯
+    loadPolicy(options.player_policy, PLAYER_POLICIES)
+    loadPolicy(options.enemy_policy, ENEMY_POLICIES)
+
+    # 只統計這次設置的對局，輸出文件中其他設置的結果不算
+    wanted = dict((match_id, matchSpec(options, match_id)) for match_id in range(options.matches))
+    results = [result for result in readResults(options.output)
+               if result.get("id") in wanted and all(result.get(k) == v for k, v in wanted[result["id"]].items())]
+    done = set(result["id"] for result in results)
+    pending = [wanted[match_id] for match_id in sorted(wanted) if match_id not in done]
+
+    if not options.summary_only and len(pending) > 0:
+        print ("%d matches done, %d to play on %d processes" % (len(done), len(pending), options.processes))
+        # 資源文件用的是相對路徑
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+        # 上次中斷時最後一行可能只寫了一半，先換行
+        partial = False
+        if os.path.isfile(options.output) and os.path.getsize(options.output) > 0:
+            f = open(options.output, "rb")
+            try:
+                f.seek(-1, os.SEEK_END)
+                partial = f.read(1) != b"\n"
+            finally:
+                f.close()
+
+        f = open(options.output, "a")
+        try:
+            if partial:
+                f.write("\n")
+            start = time.time()
+            pool = multiprocessing.Pool(options.processes)
+            try:
+                for i, result in enumerate(pool.imap_unordered(playMatch, pending, chunksize = 4)):
+                    f.write(json.dumps(result, sort_keys = True) + "\n")
+                    f.flush()
+                    results.append(result)
+                    if (i + 1) % 100 == 0 or i + 1 == len(pending):
+                        elapsed = time.time() - start
+                        print ("%d/%d matches, %.1f matches/s" % (i + 1, len(pending), (i + 1) / elapsed))
+            finally:
+                pool.terminate()
+        finally:
+            f.close()
+
+    if len(results) == 0:
+        print ("No results")
+        return {}
+    summary = summarize(results)
+    printSummary(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    main()